@@ -2,7 +2,14 @@ import unittest
 import logging
 #Python 3.0: import io
 import os.path
+import mmap
+import collections
+import struct
+import sys
+import numpy
+from cStringIO import StringIO
 from ps_parser import PSParser 
+import instrument
 
 module_logger = logging.getLogger("pypsd.sectionbase")
 
@@ -10,6 +17,55 @@ INFINITY = 'infinity'
 ZERO = 0 
 MINUS_ZERO = -0
 
+'''
+Precompiled layouts of the fixed size parts of the format.
+'''
+'''Unsigned and signed integers by size'''
+INT_RECORDS = {1: (struct.Struct(">B"), struct.Struct(">b")),
+			   2: (struct.Struct(">H"), struct.Struct(">h")),
+			   4: (struct.Struct(">I"), struct.Struct(">i")),
+			   8: (struct.Struct(">Q"), struct.Struct(">q"))}
+DOUBLE_RECORD = struct.Struct(">d")
+RECTANGLE_RECORD = struct.Struct(">4i")
+'''Signature, version, reserved, channels, height, width, depth, color mode'''
+HEADER_RECORD = struct.Struct(">4sH6xHIIHH")
+'''Layer rectangle, channels count'''
+LAYER_RECORD = struct.Struct(">4iH")
+'''Blend mode signature and key, opacity, clipping, flags, filler'''
+BLEND_RECORD = struct.Struct(">4s4sBBBB")
+'''Rectangle, default color, flags, padding'''
+MASK_RECORD = struct.Struct(">4iBBH")
+'''Rectangle, default color, flags, real flags, real background, real rectangle'''
+MASK_RECORD_REAL = struct.Struct(">4iBBBB4i")
+'''Mask flags bit: layer mask disabled'''
+MASK_DISABLED = 0x02
+'''Additional layer information keys with 8 bytes length in PSB'''
+LARGE_LENGTH_KEYS = frozenset(["LMsk", "Lr16", "Lr32", "Layr", "Mt16", "Mt32", "Mtrn",
+							   "Alph", "FMsk", "lnk2", "FEid", "FXid", "PxSD"])
+'''
+Thumbnail resource: format, width, height, row bytes, total size, size
+after compression, bits per pixel, planes
+'''
+THUMBNAIL_RECORD = struct.Struct(">6I2H")
+
+'''Channel information tables by channels count and format'''
+channelsInfoRecords = {}
+
+def channelsInfoRecord(channelsNum, large=False):
+	'''
+	Layout of channels information: channel id and length of data for every
+	channel. Lengths are 8 bytes in large documents (PSB).
+	'''
+	record = channelsInfoRecords.get((channelsNum, large))
+	if record is None:
+		record = struct.Struct(">" + ("hQ" if large else "hI") * channelsNum)
+		channelsInfoRecords[(channelsNum, large)] = record
+	return record
+
+def makeRectangle(top, left, bottom, right):
+	return {"top":top, "left":left, "bottom":bottom, "right":right, 
+			"width":right-left, "height":bottom-top}
+
 def bytesToInt(bytes):
 	shift = 0
 	value = 0
@@ -19,7 +75,7 @@ def bytesToInt(bytes):
 		value += (b << shift)
 		shift += 8
 
-	module_logger.debug("bytesToInt method. In: %s, out: %s" % (bytes, value))
+	module_logger.debug("bytesToInt method. In: %s, out: %s", bytes, value)
 	return value
 
 def int2Binary(n):
@@ -39,7 +95,140 @@ def makeEven(n):
 		n += 1
 	return n
 
+class MappedStream(object):
+	'''
+	Read only file object over memory mapped file. read() returns a copy as
+	file does, view() returns uint8 array over the mapping without copying.
+	'''
+	def __init__(self, fileName):
+		self.name = fileName
+		f = open(fileName, mode = 'rb')
+		try:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		self.bytes = numpy.frombuffer(self.map, numpy.uint8)
+		self.size = self.bytes.size
+		self.pos = 0
+
+	def read(self, size=-1):
+		if size < 0:
+			size = self.size - self.pos
+		data = self.map[self.pos:self.pos + size]
+		self.pos += len(data)
+		return data
+
+	def view(self, size):
+		data = self.bytes[self.pos:self.pos + size]
+		self.pos += data.size
+		return data
+
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self.pos
+		elif whence == 2:
+			offset += self.size
+		self.pos = offset
+
+	def tell(self):
+		return self.pos
+
+	def close(self):
+		'''
+		The mapping is released when the last view over it is gone.
+		'''
+		self.map = None
+		self.bytes = None
+
+'''
+Size of blocks ByteCursor reads ahead.
+'''
+CURSOR_BLOCK = 1 << 16
+
+class ByteCursor(object):
+	'''
+	Stream over blocks of another stream, each read with one call. Reads
+	and seeks inside the block are served from memory, a read past it
+	loads the next block. Positions are positions in the underlying stream.
+	'''
+	def __init__(self, stream, size=0, limit=None, blockSize=CURSOR_BLOCK):
+		'''
+		size - bytes to load at once, e.g. length of a section. Reading
+		past them is not read ahead.
+		limit - position blocks read ahead never go past.
+		'''
+		self.stream = stream
+		self.name = getattr(stream, "name", None)
+		self.blockSize = blockSize
+		self.pos = stream.tell()
+		if size and limit is None:
+			limit = self.pos + size
+		self.limit = limit
+		self.streamPos = self.pos
+		self.start = self.pos
+		self.data = ""
+		if size:
+			self.load(size)
+
+	def load(self, size):
+		blockSize = self.blockSize
+		if self.limit is not None:
+			blockSize = min(blockSize, self.limit - self.pos)
+		if self.streamPos != self.pos:
+			self.stream.seek(self.pos)
+		self.data = self.stream.read(max(size, blockSize))
+		self.start = self.pos
+		self.streamPos = self.pos + len(self.data)
+
+	def read(self, size=-1):
+		if size < 0:
+			self.release()
+			data = self.stream.read()
+			self.pos = self.streamPos = self.pos + len(data)
+			return data
+		offset = self.pos - self.start
+		if offset < 0 or offset + size > len(self.data):
+			self.load(size)
+			offset = 0
+		data = self.data[offset:offset + size]
+		self.pos += len(data)
+		return data
+
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self.pos
+		elif whence == 2:
+			self.stream.seek(offset, 2)
+			offset = self.streamPos = self.stream.tell()
+		self.pos = offset
+
+	def tell(self):
+		return self.pos
+
+	def release(self):
+		'''
+		Moves the underlying stream to the position of the cursor and
+		returns it.
+		'''
+		if self.streamPos != self.pos:
+			self.stream.seek(self.pos)
+			self.streamPos = self.pos
+		return self.stream
+
 class PSDParserBase(object):
+	'''
+	Constants, on the class so they are not pickled with every section.
+	'''
+	SIGNATURE = "8BPS"
+	SIGNATIRE_8BIM = "8BIM"
+	VERSION = 1
+	'''Large document format (PSB)'''
+	VERSION_LARGE = 2
+	CHANNELS_RANGE = [1, 56]
+	SIZE_RANGE = [1, 30000]
+	SIZE_RANGE_LARGE = [1, 300000]
+	DEPTH_LIST = [1,8,16]
+	OPACITY_RANGE = [0, 255]
 	
 	def __init__(self, stream = None, psd = None):
 		self.logger = logging.getLogger("pypsd.base.PSDParserBase")
@@ -51,74 +240,90 @@ class PSDParserBase(object):
 		
 		self.stream = stream
 		self.psd = psd
-		
-		'''
-		Constants.
-		'''
-		self.SIGNATURE = "8BPS"
-		self.SIGNATIRE_8BIM = "8BIM"
-		self.VERSION = 1
-		self.CHANNELS_RANGE = [1, 56]
-		self.SIZE_RANGE = [1, 30000]
-		self.DEPTH_LIST = [1,8,16]
-		self.OPACITY_RANGE = [0, 255]
+		self.debugEnabled = self.logger.isEnabledFor(logging.DEBUG)
 		
 		'''
 		Start parse Method of the child.
 		'''
-
-		self.parse()
+		hooks = instrument.current
+		if hooks is None:
+			self.parse()
+		else:
+			hooks.enter(psd, self.__class__.__name__)
+			try:
+				self.parse()
+			finally:
+				hooks.leave()
 
 	def parse(self):
 		pass
 	
+	def __getstate__(self):
+		'''
+		Stream and logger are not picklable. Logger is restored by name.
+		'''
+		state = self.__dict__.copy()
+		state["stream"] = None
+		state["logger"] = self.logger.name
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.logger = logging.getLogger(state["logger"])
+	
 	def skip(self, size):
-		self.stream.seek(size, 1) #whence=
-		self.debugMethodInOut("skip", {"size":size})
+		if size:
+			self.stream.seek(size, 1) #whence=
+		if self.debugEnabled:
+			self.debugMethodInOut("skip", {"size":size})
 	
+	def readRecord(self, record):
+		'''
+		Reads and decodes fixed size record with one call.
+		record - precompiled struct.Struct.
+		'''
+		values = record.unpack(self.stream.read(record.size))
+		if self.debugEnabled:
+			self.debugMethodInOut("readRecord", {"format":record.format}, values)
+		return values
+
 	def readUnicodeString(self):
 		charsNumber = self.readInt()
-		unicode_string = u''
-		for i in range(charsNumber):
-			char_code = self.readShortInt()
-			if char_code > 0:
-				unicode_string += unichr(char_code)
+		data = self.stream.read(charsNumber * 2)
+		unicode_string = data.decode("utf_16_be", "replace").replace(u"\x00", u"")
 		return unicode_string
 	
 	def skipIntSize(self):
 		size = self.readInt()
 		self.skip(size)
-		self.debugMethodInOut("skipIntSize",result="skipped=%s" % size)	
+		if self.debugEnabled:
+			self.debugMethodInOut("skipIntSize",result="skipped=%s" % size)	
 	
 	def readCustomInt(self, size, negative=False):
 		#Python 3: value = bytesToInt(self.stream.read(size))
 		#Python 2.6: bb = bytearray(size)
 		#Python 2.6: self.stream.readinto(bb)
 		bb = self.stream.read(size)
-		value = bytesToInt(bb)
-		
-		if negative:
-			if value > pow(2, (size * 8) - 1):
-				value = int(-(pow(2, size * 8) - value))
+		if size in INT_RECORDS and len(bb) == size:
+			value = INT_RECORDS[size][negative].unpack(bb)[0]
+		else:
+			value = bytesToInt(bb)
+			if negative:
+				if value > pow(2, (size * 8) - 1):
+					value = int(-(pow(2, size * 8) - value))
 		
-		self.debugMethodInOut("readCustomInt", {"size":size}, result=value)
+		if self.debugEnabled:
+			self.debugMethodInOut("readCustomInt", {"size":size}, result=value)
 		return value
 
 	def readDouble(self):
-		b1 = self.readInt(4)
-		b2 = self.readInt(4)
-		long = b1 << 32 | b2
-		signbit = long >> 63
-		expan = long >> 52 & 0xfff >> 1
-		if expan >= 0x7ff:
+		value = DOUBLE_RECORD.unpack(self.stream.read(8))[0]
+		if value != value or value in (float("inf"), float("-inf")):
 			return INFINITY
-		elif expan == 0x000:
+		elif abs(value) < sys.float_info.min: #zero and denormalized
 			return ZERO
-		elif expan == 0x800:
-			return MINUS_ZERO
-		signif = ((long & 0xfffffffffffff) | (1<<52)) * pow(2, -52)
 		
-		return pow(-1, signbit) * pow(2, expan-1023) * signif
+		return value
 		
 		
 	def readInt(self, returnEven=False, isLong=True):
@@ -127,30 +332,79 @@ class PSDParserBase(object):
 		if returnEven:
 			value = makeEven(value)
 		
-		self.debugMethodInOut("readInt", result=value)
 		return value
 
 	def readShortInt(self):
-		value = self.readCustomInt(2, negative=True)
-		self.debugMethodInOut("readShortInt", result=value)
-		return value
+		return self.readCustomInt(2, negative=True)
 	
+	def readShortIntArray(self, count):
+		'''
+		Reads count unsigned 2 bytes integers with one read.
+		'''
+		values = numpy.frombuffer(self.stream.read(count * 2), ">u2")
+		self.debugMethodInOut("readShortIntArray", {"count":count})
+		return values.astype(numpy.intp)
+
+	def isLarge(self):
+		'''
+		Large document format (PSB, version 2): lengths of the layer and mask
+		sections and of channel data are 8 bytes, RLE byte counts of scan
+		lines 4 bytes.
+		'''
+		header = self.psd.header
+		return header is not None and header.version == self.VERSION_LARGE
+
+	def readLength(self, returnEven=False):
+		'''
+		Length field which is 8 bytes in large documents, 4 bytes otherwise.
+		'''
+		if not self.isLarge():
+			return self.readInt(returnEven)
+		value = self.readCustomInt(8)
+		if returnEven:
+			value = makeEven(value)
+		return value
+
+	def getLineCountType(self):
+		'''
+		Numpy type of RLE byte counts of scan lines.
+		'''
+		return ">u4" if self.isLarge() else ">u2"
+
+	def readLineLengths(self, count):
+		'''
+		Reads RLE byte counts of count scan lines with one read.
+		'''
+		lineCountType = numpy.dtype(self.getLineCountType())
+		values = numpy.frombuffer(self.stream.read(count * lineCountType.itemsize), lineCountType)
+		self.debugMethodInOut("readLineLengths", {"count":count})
+		return values.astype(numpy.intp)
+
 	def readTinyInt(self):
-		tinyInt = self.readCustomInt(1)
-		
-		self.debugMethodInOut("readTinyInt", result=tinyInt)
-		return tinyInt
+		return self.readCustomInt(1)
 	
 	def readBytesList(self, size):
 		#Python 2.6: barray = bytearray(size)
 		#Python 2.6: bytesRead = self.stream.readinto(barray)
 		bytesRead = self.stream.read(size)
-		self.logger.debug("Bytes read: %s" % bytesRead)
+		self.logger.debug("Bytes read: %s", bytesRead)
 		result = [ord(b) for b in bytesRead]
 		
 		self.debugMethodInOut("readBits", {"size":size}, result)
 		return result
 	
+	def readByteArray(self, size):
+		'''
+		Reads size bytes as uint8 array. For mapped stream it is a view of
+		the mapping, not a copy.
+		'''
+		if hasattr(self.stream, "view"):
+			values = self.stream.view(size)
+		else:
+			values = numpy.frombuffer(self.stream.read(size), numpy.uint8)
+		self.debugMethodInOut("readByteArray", {"size":size})
+		return values
+	
 	def readBits(self, size):
 		i = self.readCustomInt(size)
 		#Python 2.6: bits = [int(b) for b in bin(i)[2:]]
@@ -178,8 +432,9 @@ class PSDParserBase(object):
 		dataRead = self.stream.read(size)
 		#Python 3:value = str(dataRead, "UTF-8")
 		value = str(dataRead)
-		value = "".join([s for s in value if ord(s) != 0]) #0 is padding char
-		self.debugMethodInOut("readString", {"size":size}, value)
+		value = value.replace("\x00", "") #0 is padding char
+		if self.debugEnabled:
+			self.debugMethodInOut("readString", {"size":size}, value)
 		
 		return value
 
@@ -187,15 +442,7 @@ class PSDParserBase(object):
 		return os.path.getsize(self.stream.name)
 	
 	def getRectangle(self):
-		top = self.readInt(isLong=False)
-		left = self.readInt(isLong=False)
-		bottom = self.readInt(isLong=False)
-		right  = self.readInt(isLong=False)
-		width  = right-left
-		height = bottom-top
-		
-		return {"top":top, "left":left, "bottom":bottom, "right":right, 
-			    "width":width, "height":height}
+		return makeRectangle(*self.readRecord(RECTANGLE_RECORD))
 	
 	def getPos(self):
 		return self.stream.tell()
@@ -208,6 +455,8 @@ class PSDParserBase(object):
 		return {"code":code, "label":map[code]}
 	
 	def debugMethodInOut(self, label, invars={}, result=None):
+		if not self.logger.isEnabledFor(logging.DEBUG):
+			return
 		message = "%s method." % label
 		
 		if invars:
@@ -230,9 +479,7 @@ class PSDParserBase(object):
 			enum = self.readLengthWithString()
 			value = {"typeID": typeID, "enum": enum}
 		elif osType in ['Objc', 'GlbO']:  #Descriptor, GlobalObject same as Descriptor
-			typeID = self.readLengthWithString()
-			enum = self.readLengthWithString()
-			value = {"typeID": typeID, "enum": enum}
+			value = self.readDescriptorStructure()
 		elif osType == 'VlLs':  #List
 			list_size = self.readInt()
 			value = []
@@ -285,7 +532,7 @@ class PSDParserBase(object):
 		elif osType == 'tdta': #Some strange types.
 			data_length = self.readInt()
 			pos = self.getPos()
-			data_string = self.readString(data_length)
+			data_string = self.stream.read(data_length)
 			p = PSParser(source=data_string)
 			value = p.parse()
 			self.skipRest(pos, data_length)
@@ -293,15 +540,71 @@ class PSDParserBase(object):
 		return {'type': osType, 'value': value}
 		
 	
+	def skipOsType(self):
+		'''
+		Skips a value readOsType would read, without decoding it.
+		'''
+		osType = self.readString(4)
+		if osType == "TEXT":
+			self.skip(self.readInt() * 2)
+		elif osType == "enum":
+			self.skipLengthWithString()
+			self.skipLengthWithString()
+		elif osType in ['Objc', 'GlbO']:
+			self.skipDescriptorStructure()
+		elif osType == 'VlLs':
+			for k in range(self.readInt()):
+				self.skipOsType()
+		elif osType == 'doub':
+			self.skip(8)
+		elif osType == 'UntF':
+			self.skip(12)
+		elif osType == 'long':
+			self.skip(4)
+		elif osType == 'bool':
+			self.skip(1)
+		elif osType in ['type', 'GlbC']:
+			self.skip(self.readInt() * 2)
+			self.skipLengthWithString()
+		elif osType in ['alis', 'tdta']:
+			self.skip(self.readInt())
+		elif osType == 'obj ':
+			for j in range(self.readInt()):
+				ref_obj_type = self.readString(4)
+				if ref_obj_type in ['prop', 'Clss', 'Enmr', 'rele']:
+					self.skip(self.readInt() * 2)
+					self.skipLengthWithString()
+				if ref_obj_type in ['prop', 'Enmr']:
+					self.skipLengthWithString()
+				if ref_obj_type == 'Enmr':
+					self.skipLengthWithString()
+				elif ref_obj_type == 'rele':
+					self.skip(4)
+
+	def skipDescriptorStructure(self):
+		self.skip(self.readInt() * 2)
+		self.skipLengthWithString()
+		for i in range(self.readInt()):
+			self.skipLengthWithString()
+			self.skipOsType()
+
 	def readDescriptorStructure(self):
+		'''
+		Descriptor as DescriptorView: keys and offsets of the values are
+		scanned now, the values are decoded when they are read.
+		'''
+		start = self.getPos()
 		name_from_classID = self.readUnicodeString()
 		classID = self.readLengthWithString()
 		items_num = self.readInt()
-		descriptors = {}
+		offsets = {}
 		for i in range(items_num):
 			txt_key = self.readLengthWithString().strip()
-			descriptors[txt_key] = self.readOsType()
-		return descriptors
+			offsets[txt_key] = self.getPos() - start
+			self.skipOsType()
+		end = self.getPos()
+		self.stream.seek(start)
+		return DescriptorView(self.stream.read(end - start), offsets)
 	
 	def readBoolean(self):
 		byte = self.readTinyInt()
@@ -315,6 +618,77 @@ class PSDParserBase(object):
 			value = self.readString(length)
 			
 		return value
+
+	def skipLengthWithString(self, default_length=4):
+		self.skip(self.readInt() or default_length)
+
+class DescriptorReader(PSDParserBase):
+	'''
+	Reads values of descriptors from their bytes.
+	'''
+	def __init__(self, data):
+		super(DescriptorReader, self).__init__(StringIO(data))
+		'''After the base class, which sets its own logger'''
+		self.logger = logging.getLogger("pypsd.base.DescriptorReader")
+		self.debugEnabled = self.logger.isEnabledFor(logging.DEBUG)
+
+class DescriptorView(collections.MutableMapping):
+	'''
+	Descriptor, {key: {"type": osType, "value": value}}, decoded on demand.
+	At first only keys and offsets of the values in data are known. A
+	value is decoded when its key is read and kept for next reads.
+	Not a dict subclass: dict(view), update(view) and f(**view) read the
+	values through keys and __getitem__, so they get all of them decoded.
+	Pickled as plain dict.
+	'''
+	def __init__(self, data, offsets):
+		self.data = data
+		'''{key: offset of the value in data}'''
+		self.offsets = offsets
+		'''{key: decoded value}'''
+		self.decoded = {}
+		self.reader = None
+
+	def __getitem__(self, key):
+		if key not in self.decoded:
+			offset = self.offsets[key]
+			if self.reader is None:
+				self.reader = DescriptorReader(self.data)
+			self.reader.stream.seek(offset)
+			self.decoded[key] = self.reader.readOsType()
+		return self.decoded[key]
+
+	def __setitem__(self, key, value):
+		self.offsets.setdefault(key, None)
+		self.decoded[key] = value
+
+	def __delitem__(self, key):
+		del self.offsets[key]
+		self.decoded.pop(key, None)
+
+	def __contains__(self, key):
+		return key in self.offsets
+
+	has_key = __contains__
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def __iter__(self):
+		return iter(self.offsets)
+
+	def keys(self):
+		return self.offsets.keys()
+
+	def copy(self):
+		return dict(self.iteritems())
+
+	def __repr__(self):
+		return repr(self.copy())
+
+	def __reduce__(self):
+		return (dict, (self.items(),))
+
 #class CodeMapObject(object):
 #	def __init__(self, code=None, map={}, *args, **kwargs):
 #		self.logger = logging.getLogger("pypsd.base.CodeMapObject")
@@ -349,6 +723,72 @@ class PSDBaseTest(unittest.TestCase):
 		value2 = bytesToInt('\xff\x14\x2a\x10')
 		self.failUnlessEqual(0xff142a10, value2)
 	
+	def testByteCursor(self):
+		from StringIO import StringIO
+		stream = StringIO("abcdefghijklmnopqrstuvwxyz")
+		stream.seek(2)
+		cursor = ByteCursor(stream, 4)
+		self.failUnlessEqual("cd", cursor.read(2))
+		cursor.seek(1, 1)
+		self.failUnlessEqual(5, cursor.tell())
+		'''Past the loaded block'''
+		self.failUnlessEqual("fgh", cursor.read(3))
+		cursor.seek(10)
+		self.failUnlessEqual(cursor.release(), stream)
+		self.failUnlessEqual("k", stream.read(1))
+
+		stream.seek(0)
+		cursor = ByteCursor(stream, limit=20, blockSize=8)
+		self.failUnlessEqual("a", cursor.read(1))
+		self.failUnlessEqual(8, stream.tell())
+		cursor.seek(18)
+		self.failUnlessEqual("stuvwx", cursor.read(6))
+
+	def testDescriptorView(self):
+		import struct
+		from cPickle import dumps, loads
+		def key(name):
+			return struct.pack(">I", len(name)) + name
+		def text(value):
+			return struct.pack(">I", len(value)) + value.encode("utf_16_be")
+		def descriptor(items):
+			return text(u"") + key("null") + struct.pack(">I", len(items)) + \
+				"".join([key(name) + value for name, value in items])
+		nested = descriptor([("Hrzn", "doub" + struct.pack(">d", 1.5))])
+		data = descriptor([("Txt ", "TEXT" + text(u"abc")),
+						   ("Cnt", "long" + struct.pack(">i", 3)),
+						   ("List", "VlLs" + struct.pack(">I", 2) + "boolx" + "bool\x00"),
+						   ("Data", "tdta" + struct.pack(">I", 9) + "[1 (a) 2]"),
+						   ("Obj", "Objc" + nested)]) + "rest"
+		p = PSDParserBase(StringIO(data))
+		view = p.readDescriptorStructure()
+		self.failUnlessEqual("rest", p.stream.read())
+		self.failUnlessEqual(set(["Txt", "Cnt", "List", "Data", "Obj"]), set(view.keys()))
+		self.failUnlessEqual(0, len(view.decoded))
+		self.failUnlessEqual({"type": "long", "value": 3}, view["Cnt"])
+		self.failUnlessEqual(1, len(view.decoded))
+		self.failUnlessEqual("pypsd.base.DescriptorReader", view.reader.logger.name)
+		self.failUnlessEqual(1.5, view["Obj"]["value"]["Hrzn"]["value"])
+		self.failUnlessEqual([1, "a", 2], view["Data"]["value"])
+		copy = loads(dumps(view, 2))
+		self.failUnlessEqual(dict, type(copy))
+		self.failUnlessEqual(u"abc", copy["Txt"]["value"])
+		self.failUnlessEqual([True, False], [v["value"] for v in copy["List"]["value"]])
+		self.failUnlessEqual(copy, view)
+		'''Views not decoded yet'''
+		views = []
+		for i in range(3):
+			p.stream.seek(0)
+			views.append(p.readDescriptorStructure())
+		self.failUnlessEqual(copy, dict(views[0]))
+		other = {}
+		other.update(views[1])
+		self.failUnlessEqual(copy, other)
+		self.failUnlessEqual(copy, dict(**views[2]))
+		self.failUnlessEqual(copy["Cnt"], view.pop("Cnt"))
+		self.failIf("Cnt" in view)
+		self.failUnlessEqual(copy["Txt"], view.setdefault("Txt", None))
+
 	def testReadCustomInt(self):
 		from base import PSDParserBase
 		from StringIO import StringIO
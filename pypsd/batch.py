@@ -0,0 +1,182 @@
+'''
+Batch conversion of PSD files.
+
+    python batch.py [options] PATH...
+
+PATH is a PSD file, a directory searched recursively for PSD files or
+a glob pattern. Files are processed by a pool of worker processes. A
+report line (JSON) with timings or the error is written for every file;
+a broken file is reported and the batch goes on.
+'''
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import traceback
+import multiprocessing
+from optparse import OptionParser
+
+from psdfile import PSDFile
+from cache import ParseCache
+
+logger = logging.getLogger("pypsd.batch")
+'''
+Extensions of files searched in directories: PSD and large document (PSB).
+'''
+EXTENSIONS = [".psd", ".psb"]
+
+def collectFiles(paths):
+	'''
+	Returns list of (fileName, relative directory) for PSD and PSB files found by
+	paths. Relative directory is where the file lies under the directory
+	given, so the output repeats the input tree.
+	'''
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, names in os.walk(path):
+				dirs.sort()
+				for name in sorted(names):
+					if os.path.splitext(name)[1].lower() in EXTENSIONS:
+						files.append((os.path.join(root, name), os.path.relpath(root, path)))
+		elif os.path.isfile(path):
+			files.append((path, ""))
+		else:
+			for fileName in sorted(glob.glob(path)):
+				if os.path.isfile(fileName):
+					files.append((fileName, ""))
+	return files
+
+def getOutputName(fileName):
+	'''
+	Name of the info file or folder of layers of the file, without the
+	extension for PSD files and with it for others, so a.psd and a.psb
+	of one directory do not write to the same place.
+	'''
+	name = os.path.basename(fileName)
+	base, extension = os.path.splitext(name)
+	if extension.lower() == ".psd":
+		return base
+	return name
+
+def processFile(task):
+	'''
+	Parses one file and saves its layers or its info. Never raises: the
+	outcome is returned as a report dictionary.
+	task - (fileName, relative directory, options dictionary)
+	'''
+	fileName, relativeDir, options = task
+	report = {"file": fileName, "status": "ok"}
+	start = time.time()
+	try:
+		report["bytes"] = os.path.getsize(fileName)
+		if options.get("cache"):
+			psd = ParseCache(options["cache"]).parse(fileName, lazy=options["info"])
+		else:
+			psd = PSDFile(fileName)
+			psd.parse(lazy=options["info"])
+		report["parse"] = time.time() - start
+		report["layers"] = len(psd.layerMask.layers)
+
+		dest = os.path.normpath(os.path.join(options["output"], relativeDir))
+		if not os.path.exists(dest):
+			try:
+				os.makedirs(dest)
+			except OSError:
+				'''Created by another worker meanwhile'''
+				if not os.path.isdir(dest):
+					raise
+
+		saveStart = time.time()
+		name = getOutputName(fileName)
+		if options["info"]:
+			stream = open(os.path.join(dest, name + ".json"), "w")
+			try:
+				json.dump(psd.extractInfo(), stream, indent=1)
+			finally:
+				stream.close()
+		else:
+			psd.save(dest=os.path.abspath(dest), saveInvis=options["invisible"], dirName=name,
+					 compression=options.get("compression", 6))
+		report["save"] = time.time() - saveStart
+	except (KeyboardInterrupt, SystemExit):
+		raise
+	except BaseException, e:
+		'''Parser reports broken files with BaseException'''
+		report["status"] = "error"
+		report["error"] = "%s: %s" % (e.__class__.__name__, e)
+		report["traceback"] = traceback.format_exc()
+	report["seconds"] = time.time() - start
+	return report
+
+def runBatch(files, options, workers=None, reportStream=None):
+	'''
+	Processes files by a pool of workers processes (one per CPU by
+	default), reports are written to reportStream as they come.
+	Returns list of the reports.
+	'''
+	tasks = [(fileName, relativeDir, options) for fileName, relativeDir in files]
+	if workers == 1:
+		results = (processFile(task) for task in tasks)
+		pool = None
+	else:
+		pool = multiprocessing.Pool(workers)
+		'''Unordered, so a big file does not hold reports of the others'''
+		results = pool.imap_unordered(processFile, tasks, 1)
+
+	reports = []
+	try:
+		for report in results:
+			if report["status"] != "ok":
+				logger.error("Can't process %s: %s" % (report["file"], report["error"]))
+			if reportStream:
+				reportStream.write(json.dumps(report) + "\n")
+				reportStream.flush()
+			reports.append(report)
+	finally:
+		if pool:
+			pool.terminate()
+			pool.join()
+	return reports
+
+def main(args=None):
+	parser = OptionParser(usage="%prog [options] PATH...")
+	parser.add_option("-o", "--output", default=".",
+					  help="directory to save layers to [default: %default]")
+	parser.add_option("-j", "--workers", type="int", default=None,
+					  help="number of worker processes [default: number of CPUs]")
+	parser.add_option("-r", "--report", default=None,
+					  help="file to write report lines to [default: stdout]")
+	parser.add_option("-i", "--info", action="store_true", default=False,
+					  help="save layers info as JSON instead of layers images")
+	parser.add_option("--invisible", action="store_true", default=False,
+					  help="save invisible layers too")
+	parser.add_option("--cache", default=None,
+					  help="directory of the parse cache")
+	parser.add_option("-z", "--compression", type="int", default=6,
+					  help="zlib level of PNG files, 0 to 9 [default: %default]")
+	options, paths = parser.parse_args(args)
+	if not paths:
+		parser.error("no PATH given")
+
+	files = collectFiles(paths)
+	taskOptions = {"output": options.output, "info": options.info,
+				   "invisible": options.invisible, "cache": options.cache,
+				   "compression": options.compression}
+
+	reportStream = open(options.report, "w") if options.report else sys.stdout
+	start = time.time()
+	try:
+		reports = runBatch(files, taskOptions, options.workers, reportStream)
+	finally:
+		if options.report:
+			reportStream.close()
+
+	failed = len([r for r in reports if r["status"] != "ok"])
+	sys.stderr.write("%d files, %d failed, %.2f s\n" % (len(reports), failed, time.time() - start))
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,271 @@
+'''
+Benchmark of parsing and saving the sample files.
+
+    python benchmark.py [-n REPEAT] [-o RESULT.json] [PATH...]
+    python benchmark.py --compare OLD.json NEW.json
+
+Every file is parsed lazily, its channels are decoded, images are made
+and saved as PNG into memory. Time is broken down by phase, a phase
+nested in another one is not counted in the outer one. Each run goes in a
+fresh process, so peak memory is the one of that file. The best of
+REPEAT runs is kept. Results are JSON, two of them can be compared to
+catch regressions.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import multiprocessing
+from optparse import OptionParser
+from StringIO import StringIO
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+from psdfile import PSDFile
+from sections import PSDHeader, PSDColorMode, PSDImageResources, PSDLayerMask, PSDLayer
+from batch import collectFiles
+
+SAMPLES_DIRS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", name)
+				for name in ["samples", "all_samples"]]
+
+'''
+(class, method, phase) timed by the benchmark.
+'''
+PHASES = [
+	(PSDHeader, "parse", "header"),
+	(PSDColorMode, "parse", "colorMode"),
+	(PSDImageResources, "parse", "imageResources"),
+	(PSDLayerMask, "parse", "layerRecords"),
+	(PSDLayerMask, "groupLayers", "layerRecords"),
+	(PSDLayer, "loadTypeTool", "text"),
+	(PSDLayer, "loadImageData", "channels"),
+	(PSDLayer, "makePixels", "makeImage"),
+	(PSDLayer, "makeImage", "makeImage"),
+]
+PHASE_NAMES = ["header", "colorMode", "imageResources", "layerRecords", "text",
+			   "channels", "makeImage", "png"]
+
+'''
+Relative change of a metric reported by compare.
+'''
+THRESHOLD = 0.1
+'''
+Smaller changes of times (seconds) are noise.
+'''
+MIN_TIME_CHANGE = 0.001
+
+class PhaseTimer(object):
+	'''
+	Accumulates time spent in phases. Time of nested calls is subtracted
+	from the calling phase.
+	'''
+	def __init__(self):
+		self.phases = dict((name, 0.0) for name in PHASE_NAMES)
+		self.nested = []
+		self.patched = []
+
+	def wrap(self, function, phase):
+		timer = self
+		def timed(*args, **kwargs):
+			timer.nested.append(0.0)
+			start = time.time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				elapsed = time.time() - start
+				timer.phases[phase] += elapsed - timer.nested.pop()
+				if timer.nested:
+					timer.nested[-1] += elapsed
+		return timed
+
+	def install(self):
+		for cls, name, phase in PHASES:
+			function = cls.__dict__[name]
+			self.patched.append((cls, name, function))
+			setattr(cls, name, self.wrap(function, phase))
+
+	def uninstall(self):
+		for cls, name, function in reversed(self.patched):
+			setattr(cls, name, function)
+		self.patched = []
+
+	def measure(self, phase, function, *args):
+		return self.wrap(function, phase)(*args)
+
+def getPeakMemory():
+	'''Peak resident memory of the process in KB, None if unknown.'''
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		peak /= 1024
+	return peak
+
+def savePNG(image):
+	image.save(StringIO(), "PNG")
+
+def runFile(fileName):
+	'''
+	One benchmark run of the file, meant to run in a fresh process.
+	'''
+	memoryBefore = getPeakMemory()
+	timer = PhaseTimer()
+	timer.install()
+	try:
+		start = time.time()
+		psd = PSDFile(fileName)
+		psd.parse(lazy=True)
+		layers = psd.layerMask.layers + [psd.layerMask.baseLayer]
+		for layer in layers:
+			layer.styled_text
+			layer.channels
+			image = layer.image
+			if image.size[0] * image.size[1]:
+				timer.measure("png", savePNG, image)
+		seconds = time.time() - start
+	finally:
+		timer.uninstall()
+
+	result = {"bytes": os.path.getsize(fileName),
+			  "layers": len(psd.layerMask.layers),
+			  "seconds": seconds,
+			  "phases": timer.phases}
+	memoryAfter = getPeakMemory()
+	if memoryBefore is not None:
+		result["peakMemory"] = memoryAfter
+		result["memoryIncrease"] = memoryAfter - memoryBefore
+	return result
+
+def addRates(result):
+	seconds = result["seconds"] or 1e-9
+	result["mbPerSecond"] = result["bytes"] / seconds / (1 << 20)
+	result["layersPerSecond"] = result["layers"] / seconds
+
+def bestOf(results):
+	'''
+	Minimum over runs of every time and memory figure.
+	'''
+	best = dict(results[0])
+	for key in ["seconds", "peakMemory", "memoryIncrease"]:
+		if key in best:
+			best[key] = min([r[key] for r in results])
+	best["phases"] = dict((name, min([r["phases"][name] for r in results]))
+						  for name in PHASE_NAMES)
+	addRates(best)
+	return best
+
+def runBenchmark(paths, repeat=3):
+	files = collectFiles(paths)
+	'''
+	A new process for every run: peak memory is not shared and the
+	runs do not warm up each other.
+	'''
+	pool = multiprocessing.Pool(1, maxtasksperchild=1)
+	try:
+		results = {}
+		for fileName, relativeDir in files:
+			runs = pool.map(runFile, [fileName] * repeat, 1)
+			name = os.path.join(os.path.basename(os.path.dirname(os.path.abspath(fileName))),
+								os.path.basename(fileName))
+			results[name] = bestOf(runs)
+	finally:
+		pool.terminate()
+		pool.join()
+
+	total = {"bytes": 0, "layers": 0, "seconds": 0.0,
+			 "phases": dict((name, 0.0) for name in PHASE_NAMES)}
+	for result in results.values():
+		for key in ["bytes", "layers", "seconds"]:
+			total[key] += result[key]
+		for name in PHASE_NAMES:
+			total["phases"][name] += result["phases"][name]
+	addRates(total)
+	if results and "peakMemory" in results.values()[0]:
+		total["peakMemory"] = max([r["peakMemory"] for r in results.values()])
+
+	return {"python": platform.python_version(),
+			"platform": platform.platform(),
+			"repeat": repeat,
+			"files": results,
+			"total": total}
+
+def flatten(result):
+	'''
+	{metric name: value} of one file result, phases included.
+	'''
+	metrics = dict((key, value) for key, value in result.items() if key != "phases")
+	for name, value in result.get("phases", {}).items():
+		metrics["phase." + name] = value
+	return metrics
+
+def compare(old, new, threshold=THRESHOLD):
+	'''
+	Lines describing metrics changed by more than threshold. Growth of
+	time or memory and drop of throughput are marked as regressions.
+	'''
+	lines = []
+	names = sorted(set(old["files"]) | set(new["files"]))
+	for name in names + ["total"]:
+		if name == "total":
+			oldResult, newResult = old["total"], new["total"]
+		elif name not in old["files"] or name not in new["files"]:
+			lines.append("%s: only in %s" % (name, "new" if name in new["files"] else "old"))
+			continue
+		else:
+			oldResult, newResult = old["files"][name], new["files"][name]
+		oldMetrics, newMetrics = flatten(oldResult), flatten(newResult)
+		for metric in sorted(set(oldMetrics) & set(newMetrics)):
+			if metric in ["bytes", "layers"]:
+				continue
+			before, after = oldMetrics[metric], newMetrics[metric]
+			if not before or abs(after - before) <= threshold * abs(before):
+				continue
+			isTime = metric == "seconds" or metric.startswith("phase.")
+			if isTime and abs(after - before) < MIN_TIME_CHANGE:
+				continue
+			higherIsBetter = metric.endswith("PerSecond")
+			worse = (after < before) if higherIsBetter else (after > before)
+			lines.append("%s %s: %.4g -> %.4g (%+.0f%%)%s" %
+						 (name, metric, before, after, 100.0 * (after - before) / before,
+						  " REGRESSION" if worse else ""))
+	return lines
+
+def main(args=None):
+	parser = OptionParser(usage="%prog [options] [PATH...]\n       %prog --compare OLD NEW")
+	parser.add_option("-n", "--repeat", type="int", default=3,
+					  help="runs of every file, the best is kept [default: %default]")
+	parser.add_option("-o", "--output", default=None,
+					  help="file to write results to [default: stdout]")
+	parser.add_option("--compare", action="store_true", default=False,
+					  help="compare two result files")
+	parser.add_option("-t", "--threshold", type="float", default=THRESHOLD,
+					  help="relative change reported by compare [default: %default]")
+	options, paths = parser.parse_args(args)
+
+	if options.compare:
+		if len(paths) != 2:
+			parser.error("--compare needs OLD and NEW result files")
+		old, new = [json.load(open(path)) for path in paths]
+		lines = compare(old, new, options.threshold)
+		for line in lines:
+			print line
+		return 1 if [line for line in lines if line.endswith("REGRESSION")] else 0
+
+	results = runBenchmark(paths or SAMPLES_DIRS, options.repeat)
+	data = json.dumps(results, indent=1, sort_keys=True)
+	if options.output:
+		stream = open(options.output, "w")
+		try:
+			stream.write(data + "\n")
+		finally:
+			stream.close()
+	else:
+		print data
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
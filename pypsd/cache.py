@@ -0,0 +1,183 @@
+import os
+import zlib
+import hashlib
+import tempfile
+import logging
+from cPickle import dumps, loads, HIGHEST_PROTOCOL, UnpicklingError
+
+from psdfile import PSDFile
+
+CACHE_MAGIC = "PSDC"
+'''
+Bumped whenever parsed objects change so old entries are not loaded.
+'''
+CACHE_VERSION = 3
+CACHE_SUFFIX = ".psdcache"
+HASH_CHUNK = 1 << 22
+
+class ParseCache(object):
+	'''
+	On-disk cache of parsed PSD files. An entry keeps the whole parsed
+	document: header, resources, layer records, layers tree built by
+	groupLayers and text data, optionally decoded channel planes. Entries
+	are pickles compressed with zlib, one file per document.
+	Entries are keyed by device, inode, size and modification time of the
+	file, or by hash of its content with contentHash=True (robust to copies
+	and touches, but the whole file is read to check it).
+	When total size of entries exceeds maxSize, least recently used ones
+	are removed.
+	'''
+
+	def __init__(self, directory, maxSize=256 << 20, contentHash=False, planes=False):
+		self.logger = logging.getLogger("pypsd.cache.ParseCache")
+		self.directory = directory
+		self.maxSize = maxSize
+		self.contentHash = contentHash
+		'''
+		Store decoded channel planes too. Without them layers decode
+		channels from the file on first access.
+		'''
+		self.planes = planes
+		self.hits = 0
+		self.misses = 0
+
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	def getKey(self, fileName):
+		info = os.stat(fileName)
+		if not self.contentHash:
+			return "%s:%d:%d:%d:%r" % (os.path.realpath(fileName), info.st_dev,
+									   info.st_ino, info.st_size, info.st_mtime)
+
+		digest = hashlib.sha1()
+		stream = open(fileName, "rb")
+		try:
+			chunk = stream.read(HASH_CHUNK)
+			while chunk:
+				digest.update(chunk)
+				chunk = stream.read(HASH_CHUNK)
+		finally:
+			stream.close()
+		return "%d:%s" % (info.st_size, digest.hexdigest())
+
+	def getEntryName(self, fileName):
+		key = hashlib.sha1(self.getKey(fileName)).hexdigest()
+		return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+	def load(self, fileName, mapped=False):
+		'''
+		Returns parsed PSDFile from the cache or None. Broken and stale
+		entries are removed and count as misses.
+		'''
+		entryName = self.getEntryName(fileName)
+		if not os.path.exists(entryName):
+			self.misses += 1
+			return None
+
+		try:
+			stream = open(entryName, "rb")
+			try:
+				data = stream.read()
+			finally:
+				stream.close()
+			if data[:4] != CACHE_MAGIC or ord(data[4]) != CACHE_VERSION:
+				raise ValueError("Unknown cache entry format.")
+			psd = loads(zlib.decompress(data[5:]))
+		except (EnvironmentError, ValueError, EOFError, zlib.error, UnpicklingError,
+				AttributeError, ImportError, IndexError), e:
+			self.logger.warning("Broken cache entry %s: %s" % (entryName, e))
+			self.remove(entryName)
+			self.misses += 1
+			return None
+
+		'''Mark entry as recently used'''
+		os.utime(entryName, None)
+		self.hits += 1
+		psd.fileName = fileName
+		psd.mapped = mapped
+		return psd
+
+	def store(self, psd):
+		'''
+		Writes parsed PSDFile to the cache and evicts old entries.
+		'''
+		psd.layerMask.loadTypeTools()
+		layers = psd.layerMask.layers + [psd.layerMask.baseLayer]
+		channels = [layer._channels for layer in layers]
+		try:
+			if not self.planes:
+				for layer in layers:
+					layer._channels = None
+			data = zlib.compress(dumps(psd, HIGHEST_PROTOCOL), 1)
+		finally:
+			for layer, layerChannels in zip(layers, channels):
+				layer._channels = layerChannels
+
+		entryName = self.getEntryName(psd.fileName)
+		'''
+		Written aside and renamed, so concurrent jobs never see a partial
+		entry.
+		'''
+		handle, tempName = tempfile.mkstemp(dir=self.directory)
+		stream = os.fdopen(handle, "wb")
+		try:
+			stream.write(CACHE_MAGIC)
+			stream.write(chr(CACHE_VERSION))
+			stream.write(data)
+		finally:
+			stream.close()
+		try:
+			os.rename(tempName, entryName)
+		except OSError:
+			self.remove(tempName)
+		self.evict()
+
+	def parse(self, fileName, lazy=False, workers=None, mapped=False, select=None):
+		'''
+		Returns PSDFile parsed from the cache when the file is unchanged,
+		otherwise parses it and stores the result. Layers not decoded by
+		the parse or not stored decode their data on first access.
+		'''
+		psd = self.load(fileName, mapped)
+		if psd is None:
+			psd = PSDFile(fileName, mapped=mapped)
+			psd.parse(lazy=lazy, workers=workers, select=select)
+			self.store(psd)
+		return psd
+
+	def getEntries(self):
+		'''
+		List of (last use time, size, file name) of entries, oldest first.
+		'''
+		entries = []
+		for name in os.listdir(self.directory):
+			if not name.endswith(CACHE_SUFFIX):
+				continue
+			entryName = os.path.join(self.directory, name)
+			try:
+				info = os.stat(entryName)
+			except OSError:
+				continue
+			entries.append((info.st_mtime, info.st_size, entryName))
+		entries.sort()
+		return entries
+
+	def evict(self):
+		entries = self.getEntries()
+		size = sum([entrySize for used, entrySize, entryName in entries])
+		for used, entrySize, entryName in entries:
+			if size <= self.maxSize:
+				break
+			self.remove(entryName)
+			size -= entrySize
+
+	def clear(self):
+		for used, entrySize, entryName in self.getEntries():
+			self.remove(entryName)
+
+	def remove(self, entryName):
+		try:
+			os.remove(entryName)
+		except OSError:
+			pass
@@ -0,0 +1,407 @@
+import unittest
+import collections
+import numpy
+from PIL import Image
+
+'''
+Blend modes of separable colors. b - backdrop, s - source, float arrays
+of colors in [0, 1].
+'''
+def blendNormal(b, s):
+	return s
+
+def blendMultiply(b, s):
+	return b * s
+
+def blendScreen(b, s):
+	return b + s - b * s
+
+def blendHardLight(b, s):
+	return numpy.where(s <= 0.5, b * 2 * s, blendScreen(b, 2 * s - 1))
+
+def blendOverlay(b, s):
+	return blendHardLight(s, b)
+
+def blendSoftLight(b, s):
+	d = numpy.where(b <= 0.25, ((16 * b - 12) * b + 4) * b, numpy.sqrt(b))
+	return numpy.where(s <= 0.5, b - (1 - 2 * s) * b * (1 - b),
+					   b + (2 * s - 1) * (d - b))
+
+def blendColorDodge(b, s):
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		result = numpy.minimum(1, b / (1 - s))
+	return numpy.where(b <= 0, 0, numpy.where(s >= 1, 1, result))
+
+def blendColorBurn(b, s):
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		result = 1 - numpy.minimum(1, (1 - b) / s)
+	return numpy.where(b >= 1, 1, numpy.where(s <= 0, 0, result))
+
+def blendVividLight(b, s):
+	return numpy.where(s <= 0.5, blendColorBurn(b, 2 * s), blendColorDodge(b, 2 * s - 1))
+
+def blendLinearLight(b, s):
+	return numpy.clip(b + 2 * s - 1, 0, 1)
+
+def blendPinLight(b, s):
+	return numpy.where(s <= 0.5, numpy.minimum(b, 2 * s), numpy.maximum(b, 2 * s - 1))
+
+def blendHardMix(b, s):
+	return numpy.where(b + s >= 1, 1, 0).astype(b.dtype)
+
+def blendDivide(b, s):
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		result = numpy.minimum(1, b / s)
+	return numpy.where(s <= 0, numpy.where(b > 0, 1, 0), result)
+
+'''
+Blend modes of non separable colors, see PDF and W3C compositing
+specifications.
+'''
+def getLum(c):
+	return c[..., 0:1] * 0.3 + c[..., 1:2] * 0.59 + c[..., 2:3] * 0.11
+
+def clipColor(c):
+	l = getLum(c)
+	n = c.min(axis=-1)[..., None]
+	x = c.max(axis=-1)[..., None]
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		c = numpy.where(n < 0, l + (c - l) * l / (l - n), c)
+		c = numpy.where(x > 1, l + (c - l) * (1 - l) / (x - l), c)
+	return c
+
+def setLum(c, l):
+	return clipColor(c + (l - getLum(c)))
+
+def getSat(c):
+	return (c.max(axis=-1) - c.min(axis=-1))[..., None]
+
+def setSat(c, s):
+	n = c.min(axis=-1)[..., None]
+	x = c.max(axis=-1)[..., None]
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		result = (c - n) * s / (x - n)
+	return numpy.where(x > n, result, 0)
+
+def blendHue(b, s):
+	return setLum(setSat(s, getSat(b)), getLum(b))
+
+def blendSaturation(b, s):
+	return setLum(setSat(b, getSat(s)), getLum(b))
+
+def blendColor(b, s):
+	return setLum(s, getLum(b))
+
+def blendLuminosity(b, s):
+	return setLum(b, getLum(s))
+
+def blendDarkerColor(b, s):
+	return numpy.where(getLum(s) < getLum(b), s, b)
+
+def blendLighterColor(b, s):
+	return numpy.where(getLum(s) > getLum(b), s, b)
+
+'''
+Blend functions by blend mode code of PSDLayer.blendMode. Dissolve is
+drawn as normal.
+'''
+BLEND_MODES = {
+	"norm": blendNormal, "diss": blendNormal,
+	"dark": numpy.minimum, "lite": numpy.maximum,
+	"mul": blendMultiply, "scrn": blendScreen,
+	"over": blendOverlay, "hLit": blendHardLight, "sLit": blendSoftLight,
+	"diff": lambda b, s: numpy.abs(b - s),
+	"smud": lambda b, s: b + s - 2 * b * s,
+	"div": blendColorDodge, "idiv": blendColorBurn,
+	"lbrn": lambda b, s: numpy.clip(b + s - 1, 0, 1),
+	"lddg": lambda b, s: numpy.minimum(b + s, 1),
+	"vLit": blendVividLight, "lLit": blendLinearLight, "pLit": blendPinLight,
+	"hMix": blendHardMix,
+	"fsub": lambda b, s: numpy.clip(b - s, 0, 1), "fdiv": blendDivide,
+	"hue": blendHue, "sat": blendSaturation, "colr": blendColor, "lum": blendLuminosity,
+	"dkCl": blendDarkerColor, "lgCl": blendLighterColor,
+}
+
+def blendRegion(color, alpha, top, left, sourceColor, sourceAlpha, mode="norm"):
+	'''
+	Composites source over the region of the canvas starting at top, left
+	with the blend mode, in place. Colors are not premultiplied.
+	color, alpha - canvas, float32 arrays height x width x 3 and height x width.
+	'''
+	height, width = sourceAlpha.shape
+	backdrop = color[top:top + height, left:left + width]
+	backdropAlpha = alpha[top:top + height, left:left + width]
+	if mode in ["norm", "diss"]:
+		mixed = sourceColor
+	else:
+		blended = BLEND_MODES.get(mode, blendNormal)(backdrop, sourceColor)
+		mixed = sourceColor + backdropAlpha[..., None] * (blended - sourceColor)
+	resultAlpha = sourceAlpha + backdropAlpha * (1 - sourceAlpha)
+	'''Weights of source and of backdrop colors'''
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		sourceWeight = numpy.where(resultAlpha > 0, sourceAlpha / resultAlpha, 0)[..., None]
+	backdrop += sourceWeight * (mixed - backdrop)
+	backdropAlpha[...] = resultAlpha
+
+class Compositor(object):
+	'''
+	Flattens layers of parsed document into a canvas with NumPy. Any set of
+	layers can be drawn in any order, every render starts from the layers
+	prepared by the previous ones: colors and alpha converted to floats and
+	cropped to the canvas once per layer. When prepared layers take more
+	than maxSize bytes, least recently used ones are dropped.
+	Layers are drawn within their folders (see PSDLayerMask.groupLayers).
+	A folder in pass through mode at full opacity draws its layers right
+	onto the backdrop, other folders are drawn apart and blended as one
+	layer. Clipped layers are masked by alpha of their base layer.
+	Folders drawn apart get buffers of the size of their layers, kept and
+	reused by next renders.
+	'''
+
+	def __init__(self, psd, maxSize=64 << 20):
+		self.psd = psd
+		self.width = psd.header.width
+		self.height = psd.header.height
+		self.maxSize = maxSize
+		'''{layer: (top, left, color, alpha) or None}, least recently used first'''
+		self.prepared = collections.OrderedDict()
+		'''Bytes of color and alpha in prepared'''
+		self.preparedSize = 0
+		'''{folder or None for the document: its layers, top to bottom}'''
+		self.children = {}
+		for layer in psd.layerMask.layers:
+			self.children.setdefault(getattr(layer, "parent", None), []).append(layer)
+		'''{folder or None for the canvas: (color, alpha) buffers}'''
+		self.buffers = {}
+
+	def prepare(self, layer):
+		'''
+		Layer pixels inside the canvas as (top, left, color, alpha), None if
+		there are none.
+		'''
+		if layer in self.prepared:
+			result = self.prepared.pop(layer)
+			self.prepared[layer] = result
+			return result
+		rectangle = layer.rectangle
+		top, left = rectangle["top"], rectangle["left"]
+		bottom = min(rectangle["bottom"], self.height)
+		right = min(rectangle["right"], self.width)
+		result = None
+		if max(top, 0) < bottom and max(left, 0) < right:
+			pixels = layer.pixels[max(-top, 0):bottom - top, max(-left, 0):right - left]
+			color = pixels[..., :3].astype(numpy.float32) / 255
+			alpha = pixels[..., 3].astype(numpy.float32) / 255
+			if -1 not in [channelId for channelId, length in layer.channelsInfo]:
+				'''Opacity is applied to alpha channel if there is one'''
+				alpha *= layer.opacity / 255.0
+			result = (max(top, 0), max(left, 0), color, alpha)
+			self.preparedSize += color.nbytes + alpha.nbytes
+		self.prepared[layer] = result
+		while self.preparedSize > self.maxSize:
+			dropped = self.prepared.popitem(last=False)[1]
+			if dropped is not None:
+				self.preparedSize -= dropped[2].nbytes + dropped[3].nbytes
+		return result
+
+	def getGroupLayers(self, folder, order):
+		'''
+		Layers to draw in the folder, top to bottom. Layers of folders not
+		in order are drawn as if they were in the folder itself.
+		'''
+		layers = []
+		for layer in self.children.get(folder, []):
+			code = layer.layerType["code"]
+			if code == 3 or layer is folder:
+				continue
+			if order is not None and layer not in order:
+				if code in [1, 2]:
+					layers.extend(self.getGroupLayers(layer, order))
+				continue
+			layers.append(layer)
+		if order is not None:
+			layers.sort(key=order.get)
+		return layers
+
+	def getBuffers(self, key, height, width):
+		'''
+		Transparent color and alpha buffers of height x width, kept for key
+		(folder or None) and reused when the size is the same.
+		'''
+		buffers = self.buffers.get(key)
+		if buffers is None or buffers[1].shape != (height, width):
+			buffers = (numpy.empty((height, width, 3), numpy.float32),
+					   numpy.empty((height, width), numpy.float32))
+			self.buffers[key] = buffers
+		color, alpha = buffers
+		color.fill(0)
+		alpha.fill(0)
+		return buffers
+
+	def newCanvas(self, background=None):
+		color, alpha = self.getBuffers(None, self.height, self.width)
+		if background is not None:
+			color[...] = numpy.asarray(background[:3], numpy.float32) / 255
+			alpha[...] = (background[3] if len(background) > 3 else 255) / 255.0
+		return color, alpha
+
+	def getGroupBounds(self, folder, order, hidden):
+		'''
+		Union of rectangles of the layers drawn in the folder, cropped to
+		the canvas: (top, left, bottom, right), None if it is empty. Layers
+		are not decoded for it.
+		'''
+		top, left, bottom, right = self.height, self.width, 0, 0
+		for layer in self.getGroupLayers(folder, order):
+			if not (hidden or layer.visible):
+				continue
+			if layer.layerType["code"] in [1, 2]:
+				bounds = self.getGroupBounds(layer, order, hidden)
+				if bounds is None:
+					continue
+			else:
+				rectangle = layer.rectangle
+				bounds = (max(rectangle["top"], 0), max(rectangle["left"], 0),
+						  min(rectangle["bottom"], self.height), min(rectangle["right"], self.width))
+				if bounds[0] >= bounds[2] or bounds[1] >= bounds[3]:
+					continue
+			top, left = min(top, bounds[0]), min(left, bounds[1])
+			bottom, right = max(bottom, bounds[2]), max(right, bounds[3])
+		if top >= bottom or left >= right:
+			return None
+		return top, left, bottom, right
+
+	def drawGroup(self, folder, color, alpha, order, hidden, origin=(0, 0)):
+		'''
+		Draws layers of the folder bottom to top.
+		origin - canvas position of the top left corner of color and alpha.
+		'''
+		originTop, originLeft = origin
+		'''Alpha of the last not clipped layer, as (top, left, alpha)'''
+		clipBase = None
+		for layer in reversed(self.getGroupLayers(folder, order)):
+			visible = hidden or layer.visible
+			if layer.clipping and clipBase is not None:
+				if not visible or clipBase[2] is None:
+					continue
+				source = self.prepare(layer)
+				if source is None:
+					continue
+				source = clipSource(source, clipBase)
+				if source is not None:
+					top, left, sourceColor, sourceAlpha = source
+					blendRegion(color, alpha, top - originTop, left - originLeft, sourceColor,
+								sourceAlpha, mode=layer.blendMode["code"])
+				continue
+
+			clipBase = (0, 0, None)
+			if not visible:
+				continue
+			if layer.layerType["code"] in [1, 2]:
+				clipBase = self.drawFolder(layer, color, alpha, order, hidden, origin)
+			else:
+				source = self.prepare(layer)
+				if source is not None:
+					top, left, sourceColor, sourceAlpha = source
+					blendRegion(color, alpha, top - originTop, left - originLeft, sourceColor,
+								sourceAlpha, mode=layer.blendMode["code"])
+					clipBase = (top, left, sourceAlpha)
+
+	def drawFolder(self, folder, color, alpha, order, hidden, origin=(0, 0)):
+		'''
+		Draws the folder, returns its alpha as clipping base.
+		'''
+		mode = folder.blendMode["code"]
+		if mode == "pass" and folder.opacity == 255:
+			self.drawGroup(folder, color, alpha, order, hidden, origin)
+			return (0, 0, None)
+		bounds = self.getGroupBounds(folder, order, hidden)
+		if bounds is None:
+			return (0, 0, None)
+		top, left, bottom, right = bounds
+		groupColor, groupAlpha = self.getBuffers(folder, bottom - top, right - left)
+		self.drawGroup(folder, groupColor, groupAlpha, order, hidden, (top, left))
+		'''A copy, the buffer is reused'''
+		groupAlpha = groupAlpha * (folder.opacity / 255.0)
+		blendRegion(color, alpha, top - origin[0], left - origin[1], groupColor, groupAlpha,
+					mode="norm" if mode == "pass" else mode)
+		return (top, left, groupAlpha)
+
+	def render(self, layers=None, hidden=False, background=None):
+		'''
+		Returns the document flattened as RGBA pixels: uint8 array of
+		height x width x 4.
+		layers - layers to draw, top to bottom; all the layers by default.
+		Layers of a folder are drawn in the order of this list.
+		hidden - draw hidden layers and folders too.
+		background - RGB or RGBA color of the canvas, transparent by default.
+		'''
+		order = None
+		if layers is not None:
+			order = dict((layer, i) for i, layer in enumerate(layers))
+		color, alpha = self.newCanvas(background)
+		self.drawGroup(None, color, alpha, order, hidden)
+
+		pixels = numpy.empty((self.height, self.width, 4), numpy.uint8)
+		pixels[..., :3] = color * 255 + 0.5
+		pixels[..., 3] = alpha * 255 + 0.5
+		return pixels
+
+	def renderImage(self, layers=None, hidden=False, background=None):
+		pixels = self.render(layers, hidden, background)
+		return Image.frombuffer("RGBA", (self.width, self.height), pixels, "raw", "RGBA", 0, 1)
+
+def clipSource(source, clipBase):
+	'''
+	Source (top, left, color, alpha) masked by alpha of the clipping base
+	and cropped to it, None if nothing is left.
+	'''
+	top, left, color, alpha = source
+	baseTop, baseLeft, baseAlpha = clipBase
+	height, width = alpha.shape
+	baseHeight, baseWidth = baseAlpha.shape
+	y0, x0 = max(top, baseTop), max(left, baseLeft)
+	y1 = min(top + height, baseTop + baseHeight)
+	x1 = min(left + width, baseLeft + baseWidth)
+	if y0 >= y1 or x0 >= x1:
+		return None
+	alpha = alpha[y0 - top:y1 - top, x0 - left:x1 - left] * \
+		baseAlpha[y0 - baseTop:y1 - baseTop, x0 - baseLeft:x1 - baseLeft]
+	return (y0, x0, color[y0 - top:y1 - top, x0 - left:x1 - left], alpha)
+
+def composite(psd, layers=None, hidden=False, background=None):
+	'''
+	Flattens the layers of the document, see Compositor.render.
+	'''
+	return Compositor(psd).render(layers, hidden, background)
+
+
+class CompositeTest(unittest.TestCase):
+	def testBlendRegion(self):
+		color = numpy.zeros((2, 2, 3), numpy.float32)
+		alpha = numpy.zeros((2, 2), numpy.float32)
+		source = numpy.ones((1, 2, 3), numpy.float32) * 0.5
+		blendRegion(color, alpha, 1, 0, source, numpy.ones((1, 2), numpy.float32))
+		self.assertEquals([[0, 0], [1, 1]], alpha.tolist())
+		self.assertEquals(0.5, color[1, 1, 0])
+		'''Multiply with half transparent source'''
+		blendRegion(color, alpha, 1, 1, source[:, :1], numpy.ones((1, 1), numpy.float32) * 0.5, "mul")
+		self.assertAlmostEqual(0.375, color[1, 1, 0])
+		self.assertEquals(1, alpha[1, 1])
+		'''Multiply over transparent backdrop is normal'''
+		blendRegion(color, alpha, 0, 0, source[:, :1], numpy.ones((1, 1), numpy.float32), "mul")
+		self.assertEquals(0.5, color[0, 0, 0])
+
+	def testBlendModes(self):
+		b = numpy.array([[0.0, 0.25, 0.5, 1.0]] * 3, numpy.float32).T
+		s = numpy.array([[1.0, 0.5, 0.5, 0.0]] * 3, numpy.float32).T
+		for code, function in BLEND_MODES.items():
+			result = function(b, s)
+			self.assertEquals(b.shape, result.shape, code)
+			self.assertTrue(numpy.all((result >= -1e-6) & (result <= 1 + 1e-6)), code)
+		self.assertEquals([0.0, 0.125, 0.25, 0.0], blendMultiply(b, s)[:, 0].tolist())
+		self.assertEquals([1.0, 0.625, 0.75, 1.0], blendScreen(b, s)[:, 0].tolist())
+
+
+if __name__ == "__main__":
+	unittest.main()
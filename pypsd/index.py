@@ -0,0 +1,402 @@
+'''
+Metadata index of PSD files in SQLite.
+
+    python index.py [options] [PATH...]
+
+PATH is a PSD file, a directory searched recursively for PSD files or
+a glob pattern. Header fields, layer records, text runs and slices of
+every file are stored in the database; only changed files are parsed
+again. Queries are answered from the database without opening any PSD.
+'''
+import os
+import sys
+import time
+import hashlib
+import logging
+import sqlite3
+import traceback
+import multiprocessing
+from optparse import OptionParser
+
+from psdfile import PSDFile
+from batch import collectFiles
+
+logger = logging.getLogger("pypsd.index")
+
+'''
+Bumped whenever the tables change, the database is built anew then.
+'''
+INDEX_VERSION = 1
+HASH_CHUNK = 1 << 22
+
+SCHEMA = """
+CREATE TABLE files (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE NOT NULL,
+	size INTEGER,
+	mtime REAL,
+	hash TEXT,
+	version INTEGER,
+	width INTEGER,
+	height INTEGER,
+	depth INTEGER,
+	channels INTEGER,
+	color_mode INTEGER,
+	layers INTEGER,
+	error TEXT
+);
+CREATE TABLE layers (
+	file_id INTEGER NOT NULL,
+	position INTEGER,
+	layer_id INTEGER,
+	name TEXT,
+	parent_id INTEGER,
+	layer_type INTEGER,
+	rect_top INTEGER,
+	rect_left INTEGER,
+	rect_bottom INTEGER,
+	rect_right INTEGER,
+	blend_mode TEXT,
+	opacity INTEGER,
+	visible INTEGER,
+	text TEXT
+);
+CREATE TABLE runs (
+	file_id INTEGER NOT NULL,
+	layer_id INTEGER,
+	position INTEGER,
+	text TEXT,
+	font TEXT,
+	size REAL,
+	color TEXT,
+	bold INTEGER,
+	italic INTEGER,
+	underline INTEGER
+);
+CREATE TABLE slices (
+	file_id INTEGER NOT NULL,
+	slice_id INTEGER,
+	group_id INTEGER,
+	name TEXT,
+	layer_id INTEGER,
+	rect_top INTEGER,
+	rect_left INTEGER,
+	rect_bottom INTEGER,
+	rect_right INTEGER,
+	url TEXT
+);
+CREATE INDEX files_width ON files (width);
+CREATE INDEX files_height ON files (height);
+CREATE INDEX layers_file ON layers (file_id);
+CREATE INDEX layers_name ON layers (name);
+CREATE INDEX runs_file ON runs (file_id);
+CREATE INDEX runs_font ON runs (font);
+CREATE INDEX slices_file ON slices (file_id);
+CREATE INDEX slices_name ON slices (name);
+"""
+
+TABLES = ["layers", "runs", "slices"]
+
+def getHash(fileName):
+	digest = hashlib.sha1()
+	stream = open(fileName, "rb")
+	try:
+		chunk = stream.read(HASH_CHUNK)
+		while chunk:
+			digest.update(chunk)
+			chunk = stream.read(HASH_CHUNK)
+	finally:
+		stream.close()
+	return digest.hexdigest()
+
+def decodePath(path):
+	'''
+	Path as unicode for the database. Paths which are not in the file
+	system encoding are taken as latin-1, so encodePath gives their bytes
+	back.
+	'''
+	if not isinstance(path, str):
+		return path
+	try:
+		return path.decode(sys.getfilesystemencoding() or "utf-8")
+	except UnicodeDecodeError:
+		return path.decode("latin-1")
+
+def encodePath(path):
+	'''
+	Path from the database for file system calls, see decodePath.
+	'''
+	try:
+		return path.encode(sys.getfilesystemencoding() or "utf-8")
+	except UnicodeEncodeError:
+		return path.encode("latin-1", "replace")
+
+def toText(value):
+	'''
+	Strings for the database as unicode. 8 bits ones, Pascal layer names
+	and EngineData strings without BOM, are taken as Windows-1252.
+	'''
+	if isinstance(value, str):
+		return value.decode("cp1252", "replace")
+	return value
+
+def readMetadata(fileName):
+	'''
+	Parses the file without decoding any channel data. Returns
+	(fileName, {table: list of rows}, error). Rows have no file_id,
+	their strings are unicode. Never raises for broken files.
+	'''
+	rows = dict((table, []) for table in ["files"] + TABLES)
+	try:
+		psd = PSDFile(fileName)
+		psd.parse(lazy=True)
+		header = psd.header
+		layers = [l for l in psd.layerMask.layers if not l.is_base_layer]
+		rows["files"].append((header.version, header.width, header.height, header.depth,
+							  header.channelsNum, header.colorMode["code"], len(layers)))
+
+		for position, layer in enumerate(layers):
+			rectangle = layer.rectangle
+			rows["layers"].append((position, layer.layerId, layer.name,
+								   layer.parent.layerId if layer.parent else None,
+								   layer.layerType["code"], rectangle["top"], rectangle["left"],
+								   rectangle["bottom"], rectangle["right"],
+								   layer.blendMode["code"], layer.opacity, layer.visible,
+								   layer.text))
+			for i, run in enumerate(layer.styled_text or []):
+				style = run["style"]
+				rows["runs"].append((layer.layerId, i, run["text"], style["font"], style["size"],
+									 style["color"], bool(style["bold"]), bool(style["italic"]),
+									 bool(style["underline"])))
+
+		try:
+			slices = psd.imageResources.getData(1050)
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except BaseException, e:
+			'''Slices are optional, the rest of the file is still indexed'''
+			logger.warning("Can't read slices of %s: %s" % (fileName, e))
+			slices = None
+		if slices:
+			for piece in slices["slices"]:
+				position = piece["position"]
+				rows["slices"].append((piece["id"], piece["group_id"], piece["name"],
+									   piece.get("assoc_layer_id"), position["top"],
+									   position["left"], position["bottom"],
+									   position["right"], piece["URL"]))
+	except (KeyboardInterrupt, SystemExit):
+		raise
+	except BaseException, e:
+		'''Parser reports broken files with BaseException'''
+		logger.debug(traceback.format_exc())
+		return fileName, None, toText("%s: %s" % (e.__class__.__name__, e))
+	for table in rows:
+		rows[table] = [tuple(toText(value) for value in row) for row in rows[table]]
+	return fileName, rows, None
+
+class MetadataIndex(object):
+	'''
+	SQLite database of metadata of PSD files: header fields (files),
+	layer records with the text of text layers (layers), styled text
+	runs (runs) and slices. Rows refer to files by files.id, layers to
+	their folder by parent_id, the layerId of the folder.
+	A file is parsed again when its size or modification time changes,
+	with contentHash=True only when its content does (touches and copies
+	cost reading the file, not parsing it).
+	'''
+
+	def __init__(self, fileName, contentHash=False):
+		self.fileName = fileName
+		self.contentHash = contentHash
+		self.connection = sqlite3.connect(fileName)
+		self.connection.text_factory = unicode
+		version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+		if version != INDEX_VERSION:
+			self.createTables()
+
+	def createTables(self):
+		connection = self.connection
+		for table in ["files"] + TABLES:
+			connection.execute("DROP TABLE IF EXISTS %s" % table)
+		connection.executescript(SCHEMA)
+		connection.execute("PRAGMA user_version = %d" % INDEX_VERSION)
+		connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+	def getStale(self, fileNames):
+		'''
+		Files to parse: new and changed ones. Files with the same content
+		get their size and modification time updated. Files gone since
+		they were found are left out.
+		'''
+		stale = []
+		for fileName in fileNames:
+			try:
+				info = os.stat(fileName)
+			except OSError:
+				continue
+			row = self.connection.execute("SELECT id, size, mtime, hash FROM files WHERE path = ?",
+										  (decodePath(fileName),)).fetchone()
+			if row is None:
+				stale.append(fileName)
+				continue
+			fileId, size, mtime, digest = row
+			if size == info.st_size and mtime == info.st_mtime:
+				continue
+			if self.contentHash and size == info.st_size and digest == getHash(fileName):
+				self.connection.execute("UPDATE files SET mtime = ? WHERE id = ?",
+										(info.st_mtime, fileId))
+				continue
+			stale.append(fileName)
+		return stale
+
+	def store(self, fileName, rows, error):
+		'''
+		Replaces rows of the file by rows, see readMetadata. Raises
+		EnvironmentError if the file is gone.
+		'''
+		connection = self.connection
+		info = os.stat(fileName)
+		digest = getHash(fileName) if self.contentHash else None
+		self.remove(fileName)
+		fields = rows["files"][0] if rows else (None,) * 7
+		cursor = connection.execute(
+			"INSERT INTO files (path, size, mtime, hash, version, width, height, depth, "
+			"channels, color_mode, layers, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			(decodePath(fileName), info.st_size, info.st_mtime, digest) + fields + (error,))
+		if not rows:
+			return
+		fileId = cursor.lastrowid
+		for table in TABLES:
+			if not rows[table]:
+				continue
+			marks = ", ".join(["?"] * (len(rows[table][0]) + 1))
+			connection.executemany("INSERT INTO %s VALUES (%s)" % (table, marks),
+								   [(fileId,) + row for row in rows[table]])
+
+	def remove(self, fileName):
+		connection = self.connection
+		row = connection.execute("SELECT id FROM files WHERE path = ?",
+								 (decodePath(fileName),)).fetchone()
+		if row is None:
+			return
+		for table in TABLES:
+			connection.execute("DELETE FROM %s WHERE file_id = ?" % table, row)
+		connection.execute("DELETE FROM files WHERE id = ?", row)
+
+	def update(self, paths, workers=None):
+		'''
+		Indexes PSD files found by paths (see batch.collectFiles), parsing
+		new and changed files in a pool of workers processes (one per CPU
+		by default). Files indexed under the directories given which are
+		gone are removed.
+		Returns (parsed files, unchanged files, removed files) counts.
+		'''
+		fileNames = [os.path.abspath(fileName) for fileName, relativeDir in collectFiles(paths)]
+		stale = self.getStale(fileNames)
+
+		if workers == 1 or len(stale) < 2:
+			results = (readMetadata(fileName) for fileName in stale)
+			pool = None
+		else:
+			pool = multiprocessing.Pool(workers)
+			results = pool.imap_unordered(readMetadata, stale)
+		try:
+			for fileName, rows, error in results:
+				if error:
+					logger.error(u"Can't index %s: %s" % (decodePath(fileName), error))
+				try:
+					self.store(fileName, rows, error)
+				except (EnvironmentError, sqlite3.Error), e:
+					'''Gone or not storable, no partial rows are left'''
+					logger.error(u"Can't index %s: %s" % (decodePath(fileName), toText(str(e))))
+					self.remove(fileName)
+		finally:
+			if pool:
+				pool.terminate()
+				pool.join()
+
+		removed = 0
+		directories = [decodePath(os.path.join(os.path.abspath(path), ""))
+					   for path in paths if os.path.isdir(path)]
+		found = set(decodePath(fileName) for fileName in fileNames)
+		for fileName, in self.connection.execute("SELECT path FROM files").fetchall():
+			if fileName in found or not [d for d in directories if fileName.startswith(d)]:
+				continue
+			if not os.path.exists(encodePath(fileName)):
+				self.remove(fileName)
+				removed += 1
+		self.connection.commit()
+		return len(stale), len(fileNames) - len(stale), removed
+
+	def query(self, sql, parameters=()):
+		return self.connection.execute(sql, parameters).fetchall()
+
+	def findFilesByFont(self, font):
+		'''
+		Files with text runs in the font (name as styled_text gives it).
+		'''
+		return [row[0] for row in self.query(
+			"SELECT DISTINCT files.path FROM runs JOIN files ON files.id = runs.file_id "
+			"WHERE runs.font = ? ORDER BY files.path", (font,))]
+
+	def findLayers(self, name):
+		'''
+		(file, layerId) of layers named so. name may have % and _
+		wildcards of SQL LIKE.
+		'''
+		return self.query(
+			"SELECT files.path, layers.layer_id FROM layers JOIN files ON files.id = layers.file_id "
+			"WHERE layers.name LIKE ? ORDER BY files.path, layers.position", (name,))
+
+	def findFiles(self, minWidth=0, minHeight=0):
+		'''
+		Files at least minWidth wide and minHeight high.
+		'''
+		return [row[0] for row in self.query(
+			"SELECT path FROM files WHERE width >= ? AND height >= ? ORDER BY path",
+			(minWidth, minHeight))]
+
+def main(args=None):
+	parser = OptionParser(usage="%prog [options] [PATH...]")
+	parser.add_option("-d", "--database", default="psdindex.sqlite",
+					  help="index database file [default: %default]")
+	parser.add_option("-j", "--workers", type="int", default=None,
+					  help="number of worker processes [default: number of CPUs]")
+	parser.add_option("--hash", action="store_true", default=False,
+					  help="detect changed files by content hash")
+	parser.add_option("--font", default=None,
+					  help="print files using the font")
+	parser.add_option("--layer", default=None,
+					  help="print files and ids of layers named so (SQL LIKE pattern)")
+	parser.add_option("--min-width", type="int", default=None,
+					  help="print files at least so wide")
+	parser.add_option("--min-height", type="int", default=None,
+					  help="print files at least so high")
+	options, paths = parser.parse_args(args)
+
+	index = MetadataIndex(options.database, options.hash)
+	try:
+		if paths:
+			start = time.time()
+			parsed, unchanged, removed = index.update(paths, options.workers)
+			sys.stderr.write("%d parsed, %d unchanged, %d removed, %.2f s\n" %
+							 (parsed, unchanged, removed, time.time() - start))
+		if options.font is not None:
+			for fileName in index.findFilesByFont(options.font):
+				print fileName.encode("utf-8")
+		if options.layer is not None:
+			for fileName, layerId in index.findLayers(options.layer):
+				'''Layers without lyid block have no id'''
+				print "%s\t%s" % (fileName.encode("utf-8"), "" if layerId is None else layerId)
+		if options.min_width is not None or options.min_height is not None:
+			for fileName in index.findFiles(options.min_width or 0, options.min_height or 0):
+				print fileName.encode("utf-8")
+	finally:
+		index.close()
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
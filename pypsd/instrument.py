@@ -0,0 +1,151 @@
+import time
+import unittest
+
+'''
+Instrumentation receiving parser events, None when disabled. Parser
+checks it once per section and per opened stream, never per field, so
+disabled instrumentation costs nothing.
+'''
+current = None
+
+def enable(instrumentation=None):
+	'''
+	Starts collecting counters into instrumentation (new Instrumentation
+	by default) and returns it.
+	'''
+	global current
+	if instrumentation is None:
+		instrumentation = Instrumentation()
+	current = instrumentation
+	return instrumentation
+
+def disable():
+	global current
+	current = None
+
+def getFileName(psd):
+	return getattr(psd, "fileName", None) if psd is not None else None
+
+COUNTERS = ["bytes", "reads", "seeks", "pixels", "seconds"]
+
+class Instrumentation(object):
+	'''
+	Counters of bytes read, read calls, seeks, decoded pixels and
+	elapsed seconds by file and section. A section nested in another one
+	(layer records in the layer and mask section) is not counted in the
+	outer one. Subclass it and override the event methods to send the
+	figures elsewhere.
+	'''
+
+	def __init__(self):
+		'''{(file name, section): {counter: value}}'''
+		self.counters = {}
+		'''Sections entered: [(counters, start time, nested seconds)]'''
+		self.stack = []
+
+	def getCounters(self, fileName, section):
+		key = (fileName, section)
+		counters = self.counters.get(key)
+		if counters is None:
+			counters = dict((name, 0) for name in COUNTERS)
+			self.counters[key] = counters
+		return counters
+
+	def enter(self, psd, section):
+		self.stack.append([self.getCounters(getFileName(psd), section), time.time(), 0.0])
+
+	def leave(self):
+		counters, start, nested = self.stack.pop()
+		elapsed = time.time() - start
+		counters["seconds"] += elapsed - nested
+		if self.stack:
+			self.stack[-1][2] += elapsed
+
+	def getCurrent(self, psd):
+		if self.stack:
+			return self.stack[-1][0]
+		'''Reads out of sections, e.g. by lazy decoding'''
+		return self.getCounters(getFileName(psd), None)
+
+	def read(self, psd, size):
+		counters = self.getCurrent(psd)
+		counters["reads"] += 1
+		counters["bytes"] += size
+
+	def seek(self, psd):
+		self.getCurrent(psd)["seeks"] += 1
+
+	def decoded(self, psd, pixels):
+		self.getCurrent(psd)["pixels"] += pixels
+
+	def reset(self):
+		self.counters = {}
+
+	def summary(self, by="section"):
+		'''
+		Counters summed by "section" or by "file".
+		'''
+		index = 1 if by == "section" else 0
+		result = {}
+		for key, counters in self.counters.items():
+			total = result.setdefault(key[index], dict((name, 0) for name in COUNTERS))
+			for name in COUNTERS:
+				total[name] += counters[name]
+		return result
+
+class InstrumentedStream(object):
+	'''
+	Stream wrapper reporting reads and seeks to instrumentation.
+	'''
+
+	def __init__(self, stream, instrumentation, psd):
+		self.wrapped = stream
+		self.instrumentation = instrumentation
+		self.psd = psd
+		self.name = getattr(stream, "name", None)
+		if hasattr(stream, "view"):
+			self.view = self.countedView
+
+	def read(self, size=-1):
+		data = self.wrapped.read(size)
+		self.instrumentation.read(self.psd, len(data))
+		return data
+
+	def countedView(self, size):
+		data = self.wrapped.view(size)
+		self.instrumentation.read(self.psd, len(data))
+		return data
+
+	def seek(self, offset, whence=0):
+		self.instrumentation.seek(self.psd)
+		return self.wrapped.seek(offset, whence)
+
+	def tell(self):
+		return self.wrapped.tell()
+
+	def close(self):
+		self.wrapped.close()
+
+
+class InstrumentationTest(unittest.TestCase):
+	def testCounters(self):
+		from StringIO import StringIO
+		instrumentation = Instrumentation()
+		stream = InstrumentedStream(StringIO("0123456789"), instrumentation, None)
+		instrumentation.enter(None, "outer")
+		stream.read(2)
+		instrumentation.enter(None, "inner")
+		stream.seek(5)
+		stream.read(10)
+		instrumentation.decoded(None, 7)
+		instrumentation.leave()
+		instrumentation.leave()
+		outer = instrumentation.counters[(None, "outer")]
+		inner = instrumentation.counters[(None, "inner")]
+		self.assertEquals((2, 1, 0), (outer["bytes"], outer["reads"], outer["seeks"]))
+		self.assertEquals((5, 1, 1, 7), (inner["bytes"], inner["reads"], inner["seeks"], inner["pixels"]))
+		self.assertEquals(7, instrumentation.summary(by="file")[None]["pixels"])
+
+
+if __name__ == "__main__":
+	unittest.main()
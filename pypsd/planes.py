@@ -0,0 +1,579 @@
+import unittest
+import zlib
+import numpy
+from itertools import islice
+
+'''
+Upper bound of output pixels expanded at once. Keeps temporary index arrays
+of the decoder small for huge channels.
+'''
+BLOCK_PIXELS = 1 << 21
+
+'''
+Size of compressed input fed to zlib at once and upper bound of the output
+it may return per call.
+'''
+ZIP_CHUNK = 1 << 20
+
+'''
+Blocks with less scan lines look for RLE packets along the lines instead
+of walking all lines at once.
+'''
+FEW_LINES = 32
+
+'''
+Bytes of scan lines decoded at once by row iterators.
+'''
+ROWS_BLOCK_BYTES = 1 << 18
+
+'''
+Exact 16 to 8 bits conversion table, rounds to the nearest value.
+'''
+LUT_16_TO_8 = ((numpy.arange(1 << 16) * 255 + 32767) // 65535).astype(numpy.uint8)
+
+def planeRowBytes(width, depth):
+	'''
+	Size of scan line in bytes. 1 bit scan lines are padded to whole byte.
+	'''
+	return (width * depth + 7) // 8
+
+def toPlane(data, width, height, depth=8):
+	'''
+	Pixel values of decoded plane bytes.
+	16 bits planes are big-endian uint16 views of the bytes, without copying.
+	1 bit planes (bitmap, 1 is black) are expanded to 0 and 255 bytes.
+	'''
+	data = toByteArray(data)
+	if depth == 16:
+		return data[:width * height * 2].view(">u2")
+	elif depth == 1:
+		rows = data[:planeRowBytes(width, depth) * height].reshape(height, -1)
+		bits = numpy.unpackbits(rows, axis=1)[:, :width]
+		return ((1 - bits) * 255).astype(numpy.uint8).ravel()
+	return data
+
+def to8Bit(plane, exact=False):
+	'''
+	Converts plane to 8 bits. By default 16 bits values are shifted,
+	exact=True rounds them to the nearest value through lookup table.
+	'''
+	if plane.dtype.itemsize == 1:
+		return plane
+	if exact:
+		return LUT_16_TO_8[plane]
+	return (plane >> 8).astype(numpy.uint8)
+
+def toByteArray(data):
+	'''
+	Returns uint8 array over data (string, buffer or array) without copying.
+	'''
+	if isinstance(data, numpy.ndarray):
+		return data.view(numpy.uint8).ravel()
+	return numpy.frombuffer(data, numpy.uint8)
+
+def decodePackBits(data, lineLengths, width, height):
+	'''
+	Decodes PackBits (RLE) compressed plane.
+	data - compressed bytes of all scan lines, one after another.
+	lineLengths - compressed byte count of every scan line.
+	width - size of decoded scan line in bytes.
+	Returns uint8 array of width * height bytes.
+	'''
+	src = toByteArray(data)
+	lengths = numpy.asarray(lineLengths, numpy.intp)
+	plane = numpy.zeros(width * height, numpy.uint8)
+	if width == 0 or height == 0 or src.size == 0:
+		return plane
+
+	starts = numpy.zeros(height + 1, numpy.intp)
+	numpy.cumsum(lengths[:height], out=starts[1:])
+
+	rows = max(1, BLOCK_PIXELS // width)
+	for first in range(0, height, rows):
+		last = min(first + rows, height)
+		decodePackBitsLines(src, starts[first:last], starts[first + 1:last + 1],
+							width, plane[first * width:last * width])
+	return plane
+
+def packetSizes(headers):
+	'''
+	Literal: header + n + 1 bytes. Run: header + value. 128: no operation.
+	'''
+	n = headers.astype(numpy.intp)
+	return numpy.where(n < 128, n + 2, numpy.where(n == 128, 1, 2))
+
+def findPacketsAcrossLines(src, lineStarts, lineEnds):
+	'''
+	Positions of RLE packet headers, sorted. Every line is walked at once:
+	one step per packet.
+	'''
+	pos = lineStarts.copy()
+	headers = []
+	active = numpy.nonzero(pos < lineEnds)[0]
+	while active.size:
+		p = pos[active]
+		headers.append(p)
+		pos[active] = p + packetSizes(src[p])
+		active = active[pos[active] < lineEnds[active]]
+	if not headers:
+		return numpy.zeros(0, numpy.intp)
+	return numpy.sort(numpy.concatenate(headers))
+
+def findPacketsAlongLines(src, lineStarts, lineEnds):
+	'''
+	Positions of RLE packet headers, sorted. Lines should follow each other
+	without gaps. Every byte is taken for a header and jumps to the next one.
+	Jumps are doubled until the known headers of every line reach its end,
+	so a line of n packets takes log(n) steps.
+	'''
+	first = lineStarts[0]
+	size = lineEnds[-1] - first
+	jump = numpy.arange(size + 1, dtype=numpy.intp)
+	jump[:size] += packetSizes(src[first:first + size])
+	ends = numpy.repeat(lineEnds - first, lineEnds - lineStarts)
+	jump[:size][jump[:size] >= ends] = size
+	headers = lineStarts[lineStarts < lineEnds] - first
+	while True:
+		more = jump[headers]
+		more = more[more < size]
+		if not more.size:
+			break
+		headers = numpy.concatenate([headers, more])
+		jump = jump[jump]
+	return numpy.sort(headers) + first
+
+def decodePackBitsLines(src, lineStarts, lineEnds, width, dst, step=1):
+	'''
+	Expands scan lines src[lineStarts[i]:lineEnds[i]] into dst, width bytes
+	per line. Lines decoded to less than width bytes are left zero padded,
+	longer ones are cut.
+	step - keep only every step-th byte of the lines: dst gets
+	ceil(width / step) bytes per line, other bytes are never expanded.
+	'''
+	linesNum = len(lineStarts)
+	last = src.size - 1
+
+	if linesNum < FEW_LINES and numpy.array_equal(lineStarts[1:], lineEnds[:-1]):
+		headers = findPacketsAlongLines(src, lineStarts, lineEnds)
+	else:
+		headers = findPacketsAcrossLines(src, lineStarts, lineEnds)
+	if not headers.size:
+		return
+	headerLines = numpy.searchsorted(lineStarts, headers, side="right") - 1
+
+	n = src[headers].astype(numpy.intp)
+	literal = n < 128
+	count = numpy.where(literal, n + 1, numpy.where(n == 128, 0, 257 - n))
+
+	'''
+	Offset of every packet inside its scan line.
+	'''
+	packetStart = numpy.cumsum(count) - count
+	lineOut = numpy.bincount(headerLines, weights=count, minlength=linesNum)
+	lineOut = lineOut.astype(numpy.intp)
+	lineStartOut = numpy.cumsum(lineOut) - lineOut
+	inLine = packetStart - lineStartOut[headerLines]
+	count = numpy.clip(width - inLine, 0, count)
+
+	if step > 1:
+		'''
+		Bytes of the packet kept: first one is at column firstColumn of
+		the output line, skip bytes into the packet.
+		'''
+		firstColumn = (inLine + step - 1) // step
+		skip = firstColumn * step - inLine
+		count = numpy.maximum((inLine + count + step - 1) // step - firstColumn, 0)
+		inLine = firstColumn
+		width = (width + step - 1) // step
+
+	total = int(count.sum())
+	packetStart = numpy.cumsum(count) - count
+	offset = numpy.arange(total, dtype=numpy.intp)
+	offset -= numpy.repeat(packetStart, count)
+
+	dstPos = numpy.repeat(headerLines * width + inLine, count)
+	dstPos += offset
+	if step > 1:
+		offset *= step
+		offset += numpy.repeat(skip, count)
+
+	srcPos = numpy.repeat(headers + 1, count)
+	srcPos += offset * numpy.repeat(literal, count)
+	numpy.minimum(srcPos, last, out=srcPos)
+	dst[dstPos] = src[srcPos]
+
+
+def decodeZip(data, width, height, prediction=False, depth=8):
+	'''
+	Decompresses ZIP (deflate) plane straight into plane buffer.
+	With prediction every scan line stores differences between neighbour
+	pixels, they are summed back row by row.
+	width - size of scan line in bytes.
+	Returns uint8 array of width * height bytes.
+	'''
+	src = toByteArray(data)
+	plane = numpy.zeros(width * height, numpy.uint8)
+	decompressor = zlib.decompressobj()
+	pos = 0
+	for start in range(0, src.size, ZIP_CHUNK):
+		tail = src[start:start + ZIP_CHUNK].tostring()
+		while tail and pos < plane.size:
+			out = decompressor.decompress(tail, min(ZIP_CHUNK, plane.size - pos))
+			plane[pos:pos + len(out)] = numpy.frombuffer(out, numpy.uint8)
+			pos += len(out)
+			tail = decompressor.unconsumed_tail
+		if pos >= plane.size:
+			break
+
+	if prediction and plane.size:
+		decodeZipPrediction(plane, width, height, depth)
+	return plane
+
+
+def readAt(stream, offset, size):
+	'''
+	Reads size bytes at offset as uint8 array. Streams with view() (mapped
+	files) give views without copying.
+	'''
+	stream.seek(offset)
+	if hasattr(stream, "view"):
+		return stream.view(size)
+	return numpy.frombuffer(stream.read(size), numpy.uint8)
+
+def blockRows(rowBytes):
+	return max(1, ROWS_BLOCK_BYTES // max(rowBytes, 1))
+
+def iterRawRows(stream, offset, rowBytes, height):
+	'''
+	Yields scan lines of raw plane at offset, rowBytes bytes each.
+	'''
+	rows = blockRows(rowBytes)
+	for first in range(0, height, rows):
+		count = min(rows, height - first)
+		block = readAt(stream, offset + first * rowBytes, count * rowBytes)
+		for row in block.reshape(count, rowBytes):
+			yield row
+
+def iterPackBitsRows(stream, offset, lineLengths, rowBytes):
+	'''
+	Yields decoded scan lines of RLE plane which compressed data starts at
+	offset. Few lines are read and decoded at a time.
+	'''
+	lineLengths = numpy.asarray(lineLengths, numpy.intp)
+	starts = numpy.cumsum(lineLengths) - lineLengths
+	rows = blockRows(rowBytes)
+	for first in range(0, len(lineLengths), rows):
+		lengths = lineLengths[first:first + rows]
+		data = readAt(stream, offset + starts[first], int(lengths.sum()))
+		block = decodePackBits(data, lengths, rowBytes, len(lengths))
+		for row in block.reshape(len(lengths), rowBytes):
+			yield row
+
+def readPackBitsPreview(stream, offset, lineLengths, rowBytes, step, columnStep=None):
+	'''
+	Decodes every step-th scan line of RLE plane which compressed data
+	starts at offset, keeping every columnStep-th byte of it (step by
+	default). Compressed bytes of the other lines are skipped by their
+	lengths and never decoded.
+	Returns uint8 array of ceil(height / step) x ceil(rowBytes / columnStep).
+	'''
+	if columnStep is None:
+		columnStep = step
+	lineLengths = numpy.asarray(lineLengths, numpy.intp)
+	starts = numpy.cumsum(lineLengths) - lineLengths
+	lines = numpy.arange(0, len(lineLengths), step)
+	plane = numpy.zeros((len(lines), (rowBytes + columnStep - 1) // columnStep), numpy.uint8)
+	if not plane.size:
+		return plane
+	rows = max(1, blockRows(rowBytes) // step)
+	for first in range(0, len(lines), rows):
+		block = lines[first:first + rows]
+		begin = starts[block[0]]
+		size = starts[block[-1]] + lineLengths[block[-1]] - begin
+		data = readAt(stream, offset + begin, size)
+		lineStarts = starts[block] - begin
+		decodePackBitsLines(data, lineStarts, lineStarts + lineLengths[block], rowBytes,
+							plane[first:first + len(block)].reshape(-1), columnStep)
+	return plane
+
+def readPlanePreview(stream, offset, compression, length, lineLengths, width, height, depth, step):
+	'''
+	Every step-th pixel of every step-th scan line of the plane at offset:
+	array of ceil(height / step) x ceil(width / step) values of the plane
+	depth. 8 bits RLE planes decode only these pixels. Other RLE planes
+	decode whole needed lines, raw planes read all the lines and ZIP ones
+	inflate all of them, the rest is dropped.
+	offset - start of the plane data, after the compression field and RLE
+	line lengths.
+	'''
+	rowBytes = planeRowBytes(width, depth)
+	if compression == 1 and depth == 8:
+		return readPackBitsPreview(stream, offset, lineLengths, rowBytes, step)
+
+	if compression == 1:
+		rows = readPackBitsPreview(stream, offset, lineLengths, rowBytes, step, 1)
+	elif compression == 0:
+		rows = islice(iterRawRows(stream, offset, rowBytes, height), 0, None, step)
+	else:
+		rows = islice(iterZipRows(stream, offset, length, rowBytes, height,
+								  prediction=compression == 3, depth=depth), 0, None, step)
+	plane = numpy.zeros(((height + step - 1) // step, (width + step - 1) // step),
+						">u2" if depth == 16 else numpy.uint8)
+	for y, row in enumerate(rows):
+		plane[y] = toPlane(row, width, 1, depth)[::step]
+	return plane
+
+def iterZipRows(stream, offset, length, rowBytes, height, prediction=False, depth=8):
+	'''
+	Yields decoded scan lines of ZIP plane, inflating it chunk by chunk.
+	'''
+	decompressor = zlib.decompressobj()
+	pending = ""
+	start = 0
+	end = offset + length
+	for row in range(height):
+		while len(pending) - start < rowBytes:
+			tail = decompressor.unconsumed_tail
+			if not tail and offset < end:
+				tail = readAt(stream, offset, min(ZIP_CHUNK, end - offset)).tostring()
+				offset += len(tail)
+			if not tail:
+				pending = pending[start:] + "\x00" * (rowBytes - len(pending) + start)
+				start = 0
+				break
+			pending = pending[start:] + decompressor.decompress(tail, ZIP_CHUNK)
+			start = 0
+		line = numpy.frombuffer(pending, numpy.uint8, rowBytes, start)
+		start += rowBytes
+		if prediction:
+			line = decodeZipPrediction(line.copy(), rowBytes, 1, depth)
+		yield line
+
+def placeMask(mask, maskRectangle, rectangle, default):
+	'''
+	Moves flat mask plane of maskRectangle into rectangle, both in document
+	coordinates as makeRectangle makes them. Returns height x width plane
+	of rectangle, default where the mask does not cover it. Short planes
+	are treated as if the missing rows were default.
+	'''
+	placed = numpy.empty((rectangle["height"], rectangle["width"]), mask.dtype)
+	placed[:] = default
+	maskWidth = maskRectangle["width"]
+	if maskWidth <= 0:
+		return placed
+	rowsNum = min(len(mask) // maskWidth, maskRectangle["height"])
+	top = max(rectangle["top"], maskRectangle["top"])
+	bottom = min(rectangle["bottom"], maskRectangle["top"] + rowsNum)
+	left = max(rectangle["left"], maskRectangle["left"])
+	right = min(rectangle["right"], maskRectangle["right"])
+	if top < bottom and left < right:
+		rows = mask[:rowsNum * maskWidth].reshape(rowsNum, maskWidth)
+		placed[top - rectangle["top"]:bottom - rectangle["top"],
+			   left - rectangle["left"]:right - rectangle["left"]] = \
+			rows[top - maskRectangle["top"]:bottom - maskRectangle["top"],
+				 left - maskRectangle["left"]:right - maskRectangle["left"]]
+	return placed
+
+def iterMaskRows(rows, maskRectangle, rectangle, default, dtype):
+	'''
+	Rows of placeMask from rows of the mask plane, which are read only as
+	far as needed.
+	'''
+	rows = iter(rows)
+	maskY = maskRectangle["top"]
+	empty = numpy.zeros(0, dtype)
+	for y in range(rectangle["top"], rectangle["bottom"]):
+		line = None
+		while maskY <= y and maskY < maskRectangle["bottom"]:
+			line = next(rows, None)
+			maskY += 1
+		if line is None or maskY - 1 != y:
+			line = empty
+		yield placeMask(line, dict(maskRectangle, top=y, bottom=y + 1, height=1),
+						dict(rectangle, top=y, bottom=y + 1, height=1), default)[0]
+
+def applyMask(alpha, mask):
+	'''
+	Alpha plane scaled by mask plane of the same size and depth (0 hides,
+	maximum keeps alpha).
+	'''
+	size = min(len(alpha), len(mask))
+	maxValue = float(numpy.iinfo(mask.dtype).max)
+	return (alpha[:size] * (mask[:size] / maxValue)).astype(alpha.dtype)
+
+def decodeZipPrediction(plane, width, height, depth=8):
+	'''
+	Sums differences of neighbour pixels of every row back, in place.
+	width - size of scan line in bytes.
+	'''
+	if depth == 16:
+		rows = plane.view(">u2").reshape(height, -1)
+		rows[:] = numpy.cumsum(rows, axis=1, dtype=numpy.uint16)
+	else:
+		rows = plane.reshape(height, width)
+		numpy.cumsum(rows, axis=1, dtype=numpy.uint8, out=rows)
+	return plane
+
+class PlanesTest(unittest.TestCase):
+	def decodeReference(self, lines, width):
+		result = []
+		for line in lines:
+			out = []
+			i = 0
+			while i < len(line):
+				n = ord(line[i])
+				i += 1
+				if n < 128:
+					out += [ord(b) for b in line[i:i + n + 1]]
+					i += n + 1
+				elif n > 128:
+					out += [ord(line[i])] * (257 - n)
+					i += 1
+			out = out[:width] + [0] * (width - len(out))
+			result += out
+		return result
+
+	def testDecodePackBits(self):
+		lines = ["\x02\x01\x02\x03\xfe\x07",
+				 "\xfb\xff",
+				 "\x00\x05\x80\xfd\x09\x00\x06",
+				 "\x01\x01\x02"]
+		width = 6
+		data = "".join(lines)
+		plane = decodePackBits(data, [len(l) for l in lines], width, len(lines))
+		self.assertEquals(self.decodeReference(lines, width), plane.tolist())
+
+	def testDecodePackBitsBlocks(self):
+		import random
+		global BLOCK_PIXELS
+		rnd = random.Random(7)
+		width = 37
+		lines = []
+		for i in range(50):
+			line = ""
+			left = width
+			while left > 0:
+				n = min(left, rnd.randint(1, 10))
+				if n > 1 and rnd.random() < 0.5:
+					line += chr(257 - n) + chr(rnd.randint(0, 255))
+				else:
+					line += chr(n - 1) + "".join(chr(rnd.randint(0, 255)) for a in range(n))
+				left -= n
+			lines.append(line)
+		saved = BLOCK_PIXELS
+		for BLOCK_PIXELS in [saved, width * 3]:
+			try:
+				plane = decodePackBits("".join(lines), [len(l) for l in lines], width, len(lines))
+			finally:
+				BLOCK_PIXELS = saved
+			self.assertEquals(self.decodeReference(lines, width), plane.tolist())
+
+	def testDecodeZip(self):
+		width, height = 7, 5
+		plane = [(x * 40 + y * 3) % 256 for y in range(height) for x in range(width)]
+		data = zlib.compress("".join(chr(b) for b in plane))
+		self.assertEquals(plane, decodeZip(data, width, height).tolist())
+
+		deltas = []
+		for y in range(height):
+			row = plane[y * width:(y + 1) * width]
+			deltas += [row[0]] + [(b - a) % 256 for a, b in zip(row, row[1:])]
+		data = zlib.compress("".join(chr(b) for b in deltas))
+		self.assertEquals(plane, decodeZip(data, width, height, prediction=True).tolist())
+
+	def testDecodeZip16(self):
+		width, height = 4, 3
+		values = [(x * 20000 + y * 7) % 65536 for y in range(height) for x in range(width)]
+		deltas = []
+		for y in range(height):
+			row = values[y * width:(y + 1) * width]
+			deltas += [row[0]] + [(b - a) % 65536 for a, b in zip(row, row[1:])]
+		data = zlib.compress(numpy.array(deltas, ">u2").tostring())
+		plane = decodeZip(data, width * 2, height, prediction=True, depth=16)
+		self.assertEquals(values, toPlane(plane, width, height, 16).tolist())
+
+	def testToPlane(self):
+		data = "\x12\x34\xff\x00\x00\x80"
+		plane = toPlane(data, 3, 1, 16)
+		self.assertEquals([0x1234, 0xff00, 0x0080], plane.tolist())
+		self.assertEquals([0x12, 0xff, 0x00], to8Bit(plane).tolist())
+		self.assertEquals([0x12, 0xfe, 0x00], to8Bit(plane, exact=True).tolist())
+		self.assertEquals([0, 255, 0, 255, 255, 255, 0, 0, 0, 0],
+						  toPlane("\xa0\x7f", 5, 2, 1).tolist())
+
+	def testIterRows(self):
+		from StringIO import StringIO
+		width, height = 5, 4
+		plane = [(x * 9 + y * 50) % 256 for y in range(height) for x in range(width)]
+		raw = "".join(chr(b) for b in plane)
+		lines = ["\x04" + raw[y * width:(y + 1) * width] for y in range(height)]
+		packed = zlib.compress(raw)
+		stream = StringIO("xx" + raw + "".join(lines) + packed)
+		global ROWS_BLOCK_BYTES
+		saved = ROWS_BLOCK_BYTES
+		ROWS_BLOCK_BYTES = width * 3
+		try:
+			rows = list(iterRawRows(stream, 2, width, height))
+			self.assertEquals(plane, numpy.concatenate(rows).tolist())
+			rows = list(iterPackBitsRows(stream, 2 + len(raw), [width + 1] * height, width))
+			self.assertEquals(plane, numpy.concatenate(rows).tolist())
+			rows = list(iterZipRows(stream, 2 + len(raw) * 2 + height, len(packed), width, height))
+			self.assertEquals(plane, numpy.concatenate(rows).tolist())
+		finally:
+			ROWS_BLOCK_BYTES = saved
+
+
+	def testReadPlanePreview(self):
+		import random
+		from StringIO import StringIO
+		rnd = random.Random(3)
+		width, height = 29, 23
+		lines = []
+		for i in range(height):
+			line = ""
+			left = width
+			while left > 0:
+				n = min(left, rnd.randint(1, 9))
+				if n > 1 and rnd.random() < 0.5:
+					line += chr(257 - n) + chr(rnd.randint(0, 255))
+				else:
+					line += chr(n - 1) + "".join(chr(rnd.randint(0, 255)) for a in range(n))
+				left -= n
+			lines.append(line)
+		plane = numpy.array(self.decodeReference(lines, width), numpy.uint8).reshape(height, width)
+		raw = plane.tostring()
+		packed = zlib.compress(raw)
+		stream = StringIO("".join(lines) + raw + packed)
+		rawOffset = len("".join(lines))
+		lineLengths = [len(l) for l in lines]
+		for step in [1, 2, 3, 8, 40]:
+			expected = plane[::step, ::step].tolist()
+			for compression, offset, length in [(1, 0, 0), (0, rawOffset, 0),
+												(2, rawOffset + len(raw), len(packed))]:
+				preview = readPlanePreview(stream, offset, compression, length, lineLengths,
+										   width, height, 8, step)
+				self.assertEquals(expected, preview.tolist())
+			'''Same bytes taken as 16 bits plane'''
+			preview = readPlanePreview(stream, 0, 1, 0, lineLengths, width // 2, height, 16, step)
+			wide = plane[:, :width // 2 * 2].copy().view(">u2")
+			self.assertEquals(wide[::step, ::step].tolist(), preview.tolist())
+
+	def testPlaceMask(self):
+		mask = numpy.arange(1, 13, dtype=numpy.uint8)
+		maskRectangle = {"top": 1, "left": 2, "bottom": 4, "right": 6, "width": 4, "height": 3}
+		rectangle = {"top": 0, "left": 3, "bottom": 3, "right": 8, "width": 5, "height": 3}
+		expected = [[9, 9, 9, 9, 9],
+					[2, 3, 4, 9, 9],
+					[6, 7, 8, 9, 9]]
+		self.assertEquals(expected, placeMask(mask, maskRectangle, rectangle, 9).tolist())
+		rows = iterMaskRows(mask.reshape(3, 4), maskRectangle, rectangle, 9, numpy.uint8)
+		self.assertEquals(expected, [row.tolist() for row in rows])
+		'''Rows missing from short planes are default'''
+		expected[2] = [9] * 5
+		self.assertEquals(expected, placeMask(mask[:4], maskRectangle, rectangle, 9).tolist())
+		alpha = numpy.array([255, 200, 100], numpy.uint8)
+		mask = numpy.array([255, 128, 0], numpy.uint8)
+		self.assertEquals([255, 100, 0], applyMask(alpha, mask).tolist())
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import struct
+import zlib
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+'''
+Compressed data collected before it is written as IDAT chunk.
+'''
+IDAT_SIZE = 1 << 16
+
+def writeChunk(stream, tag, data):
+	stream.write(struct.pack(">I", len(data)))
+	stream.write(tag)
+	stream.write(data)
+	stream.write(struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+def writePNG(stream, width, height, rows, compression=6):
+	'''
+	Writes 8 bits RGBA image row by row. Rows are compressed as they come,
+	so only one row and one chunk of compressed data are kept in memory.
+	rows - iterable of height rows, width * 4 bytes each (strings or arrays).
+	'''
+	stream.write(PNG_SIGNATURE)
+	'''
+	Width, height, bit depth, color type 6 (RGBA), compression, filter
+	and interlace methods.
+	'''
+	writeChunk(stream, "IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+	compressor = zlib.compressobj(compression)
+	pending = []
+	pendingSize = 0
+	for row in rows:
+		'''Filter type 0 (none) starts every scan line'''
+		data = compressor.compress("\x00" + str(buffer(row)))
+		if data:
+			pending.append(data)
+			pendingSize += len(data)
+		if pendingSize >= IDAT_SIZE:
+			writeChunk(stream, "IDAT", "".join(pending))
+			pending = []
+			pendingSize = 0
+	pending.append(compressor.flush())
+	writeChunk(stream, "IDAT", "".join(pending))
+	writeChunk(stream, "IEND", "")
+
+
+class PNGStreamTest(unittest.TestCase):
+	def testWritePNG(self):
+		from StringIO import StringIO
+		from PIL import Image
+		width, height = 3, 2
+		rows = ["".join(chr((x * 40 + y * 100 + c) % 256) for x in range(width) for c in range(4))
+				for y in range(height)]
+		stream = StringIO()
+		writePNG(stream, width, height, rows)
+		stream.seek(0)
+		image = Image.open(stream)
+		self.assertEquals((width, height), image.size)
+		self.assertEquals("RGBA", image.mode)
+		self.assertEquals("".join(rows), image.tobytes())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -2,7 +2,6 @@ import cProfile
 import pstats
 from psdfile import PSDFile
 import os
-import psyco
 from time import clock
 
 
@@ -3,20 +3,28 @@ import unicodedata
 import string
 import logging
 import logging.config
+import multiprocessing
 
 from sections import *
+from base import MappedStream
+import instrument
 
 logging.config.fileConfig("%s/conf/logging.conf" % os.path.dirname(__file__))
 
 validFilenameChars = "-_.() %s%s" % (string.ascii_letters, string.digits)
 
-def make_valid_filename(path, layer_name, layer_id):
-	old_layer_name = layer_name
-	#layer_name = layer_name.decode()
+def clean_filename(layer_name):
+	'''
+	Layer name without characters not allowed in file names.
+	'''
 	if type(layer_name) == str:
 		layer_name = layer_name.decode()
 	cleanedFilename = unicodedata.normalize('NFKD', layer_name).encode('ASCII', 'ignore')
-	layer_name = ''.join(c for c in cleanedFilename if c in validFilenameChars)
+	return ''.join(c for c in cleanedFilename if c in validFilenameChars)
+
+def make_valid_filename(path, layer_name, layer_id):
+	old_layer_name = layer_name
+	cleanedFilename = layer_name = clean_filename(layer_name)
 
 	#Replace old bad name of layer's name with good one in the path.
 	#Replaces should be only last occurrence (should be filename)
@@ -27,6 +35,56 @@ def make_valid_filename(path, layer_name, layer_id):
 
 	return layer_name
 
+def make_unique_filename(layer_name, layer_id, used, extension="", folder=None):
+	'''
+	Valid file name for the layer, unique in its folder: id of the layer
+	is added if the name is empty or taken. used - lower case names
+	(with extension) already given in the folder, the name is added there.
+	folder - directory on disk the name is for, names existing there are
+	taken as well.
+	'''
+	layer_name = clean_filename(layer_name)
+	if (not layer_name or (layer_name + extension).lower() in used or
+		(folder is not None and os.path.exists(os.path.join(folder, layer_name + extension)))):
+		layer_name += str(layer_id)
+	used.add((layer_name + extension).lower())
+	return layer_name
+
+def layerSelector(ids=None, names=None, visible=None, layerTypes=None, folders=None):
+	'''
+	Predicate of layers for PSDFile.parse. A layer is selected when it
+	matches all the criteria given:
+	ids, names - its layerId or name is in the list;
+	visible - its visibility;
+	layerTypes - its layerType code is in the list;
+	folders - names of folders, the layer is inside one of them at any depth.
+	'''
+	def select(layer):
+		if ids is not None and layer.layerId not in ids:
+			return False
+		if names is not None and layer.name not in names:
+			return False
+		if visible is not None and bool(layer.visible) != visible:
+			return False
+		if layerTypes is not None and layer.layerType["code"] not in layerTypes:
+			return False
+		if folders is not None and not [p for p in layer.parents if p.name in folders]:
+			return False
+		return True
+	return select
+
+def saveLayerImage(task):
+	'''
+	Writes PNG file of a layer, in a worker process by PSDFile.save.
+	Returns error message or None.
+	'''
+	layer, fileName, compression = task
+	try:
+		layer.save_png(fileName, compression)
+	except EnvironmentError, e:
+		return "Can't save %s layer: %s" % (layer.name, e)
+	return None
+
 
 class PSDFile(object):
 	'''
@@ -39,131 +97,285 @@ class PSDFile(object):
 	- Image Data
 	'''
 
-	def __init__(self, fileName = None, stream = None):
-		import psyco
-		psyco.profile()
+	def __init__(self, fileName = None, stream = None, mapped = False):
+		try:
+			import psyco
+			psyco.profile()
+		except ImportError:
+			pass
 		self.logger = logging.getLogger("pypsd.psdfile.PSDFile")
 		self.logger.debug("__init__ method. In: fileName=%s" % fileName)
 
 		self.stream = stream
 		self.fileName = fileName
+		'''
+		Read the file through memory mapping. Raw channels are views of the
+		mapping and compressed ones are decoded right from it.
+		'''
+		self.mapped = mapped
+		self.mappedStream = None
 
 		self.header = None
 		self.colorMode = None
 		self.imageResources = None
 		self.layerMask = None
 		self.imageData = None
+		self.lazy = False
+		'''Predicate of layers to decode while parsing'''
+		self.select = None
 
-	def parse(self):
+	def openStream(self):
+		'''
+		Returns stream given to the constructor or opens the file.
+		'''
+		if self.stream:
+			stream = self.stream
+		elif self.mapped:
+			if self.mappedStream is None:
+				self.mappedStream = MappedStream(self.fileName)
+			stream = self.mappedStream
+		else:
+			stream = open(self.fileName, mode = 'rb')
+		if instrument.current is not None:
+			stream = instrument.InstrumentedStream(stream, instrument.current, self)
+		return stream
+
+	def closeStream(self, stream):
+		stream = getattr(stream, "wrapped", stream)
+		if stream is not self.stream and stream is not self.mappedStream:
+			stream.close()
+
+	def close(self):
+		'''
+		Releases memory mapping of the file.
+		'''
+		if self.mappedStream is not None:
+			self.mappedStream.close()
+			self.mappedStream = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["logger"] = self.logger.name
+		state["stream"] = None
+		state["mappedStream"] = None
+		state["select"] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.logger = logging.getLogger(state["logger"])
+
+	def parse(self, lazy=False, workers=None, select=None):
 		'''
 		Parse PDF file and fill all self field.
+		With lazy=True channel image data and text of text layers are not
+		decoded: layers remember their offsets and decode them on first
+		access to image or channels, text, text_data, wrap_data or
+		styled_text. The file (or stream) has to stay available until
+		then. Without lazy text is decoded during the parse.
+		With workers=N channel image data of layers is decoded by a pool of
+		N processes after all layer records are read.
+		select - predicate of layers to decode, see layerSelector. It gets
+		layers with their records read and grouped (parent, parents). Data
+		of other layers is skipped, they decode it on first access as lazy
+		ones do. The merged image is decoded when select(baseLayer) is true.
 		'''
-		if not self.stream:
-			if self.fileName is None:
-				raise BaseException("File Name not specified.")
-
-			if not os.path.exists(self.fileName):
-				raise IOError("Can't find file specified.")
+		self.lazy = lazy or bool(workers)
+		self.select = select
+		self.checkFile()
 
 		#2.6 with open(self.fileName, mode = 'rb') as stream:
+		stream = self.openStream()
 		try:
-			if not self.stream:
-				stream = open(self.fileName, mode = 'rb')
-			else:
-				stream = self.stream
-
-			stream.seek(0,2)
-			streamsize = stream.tell()
-			stream.seek(0)
-
-			self.logger.debug("File size is: %d bytes" % streamsize)
-
-			self.header = PSDHeader(stream, self)
-			self.logger.debug("Header:\n%s" % self.header)
-
-			self.colorMode = PSDColorMode(stream, self)
-			self.logger.debug("Color mode:%s" % self.colorMode)
-
-			self.imageResources = PSDImageResources(stream, self)
-			self.logger.debug("Image Resources:%s" % self.imageResources)
+			self.readResources(stream)
 
 			self.layerMask = PSDLayerMask(stream, self)
-			self.logger.debug("Layer Masks:%s" % self.layerMask)
+			self.logger.debug("Layer Masks:%s", self.layerMask)
 
 			self.layerMask.groupLayers()
 
+			self.lazy = lazy
+			if workers and not lazy:
+				self.layerMask.decodeLayers(workers, select)
+			if not lazy:
+				self.layerMask.loadTypeTools(stream)
+
 			for l in self.layerMask.layers:
 				if l.is_base_layer:
 					self.logger.debug("Layer 'Canvas'.")
 				else:
-					self.logger.debug("Layer %s\t%d Parent %s" % (l.name, l.layerId,
-									(l.parent.layerId if l.parent else "None")))
+					self.logger.debug("Layer %s\t%s Parent %s", l.name, l.layerId,
+									  l.parent.layerId if l.parent else "None")
 		finally:
-			if not self.stream:
-				stream.close()
+			self.select = None
+			self.closeStream(stream)
 
-	def extractInfo(self):
-		return PsdInfo(self)
-			
+	def checkFile(self):
+		if not self.stream:
+			if self.fileName is None:
+				raise BaseException("File Name not specified.")
 
-	def save(self, dest=None, saveInvis=False, dirName=None, indexNames=False, inFolders=True):
-		initCwd = os.getcwd()
-		if not dest:
-			dest = os.getcwd()
+			if not os.path.exists(self.fileName):
+				raise IOError("Can't find file specified.")
 
-		if not dirName:
-			psdBaseName = os.path.basename(self.fileName)
-			psdFileName = os.path.splitext(psdBaseName)
-			dirName = psdFileName[0] 
+	def readResources(self, stream):
+		'''
+		Header, color mode data and image resources sections.
+		'''
+		stream.seek(0,2)
+		streamsize = stream.tell()
+		stream.seek(0)
 
-		dest = os.path.join(dest, dirName)
+		self.logger.debug("File size is: %d bytes", streamsize)
+
+		self.header = PSDHeader(stream, self)
+		self.logger.debug("Header:\n%s", self.header)
+
+		self.colorMode = PSDColorMode(stream, self)
+		self.logger.debug("Color mode:%s", self.colorMode)
+
+		self.imageResources = PSDImageResources(stream, self)
+		self.logger.debug("Image Resources:%s", self.imageResources)
+
+	def parseResources(self):
+		'''
+		Parses the sections before the layers only: header, color mode data
+		and image resources. Enough for the thumbnail and other resources,
+		layer and image data are not touched.
+		'''
+		self.checkFile()
+		stream = self.openStream()
+		try:
+			self.readResources(stream)
+		finally:
+			self.closeStream(stream)
+
+	def getThumbnail(self):
+		'''
+		PIL image of the embedded thumbnail or None, see
+		PSDImageResources.getThumbnail. Unless the file is parsed already
+		only the sections up to image resources are.
+		'''
+		if self.imageResources is None:
+			self.parseResources()
+		return self.imageResources.getThumbnail()
+
+	def extractInfo(self):
+		return PsdInfo(self)
 
-		if not os.path.exists(dest):
-			os.mkdir(dest)
+	def getPreview(self, factor):
+		'''
+		Merged image of the document reduced factor times, see
+		PSDLayer.getPreview.
+		'''
+		return self.layerMask.baseLayer.getPreview(factor)
+			
 
-		os.chdir(dest)
+	def getOutputTree(self, saveInvis=False, indexNames=False, inFolders=True, root=None):
+		'''
+		Works out what save() writes, before anything is written. Returns
+		list of folders to create and list of (layer, file name, valid
+		layer name or None), paths relative to the output directory.
+		Names are made unique among the names planned for the same folder.
+		root - output directory: names of files and folders existing there
+		are taken too, so an earlier output is not overwritten.
+		'''
+		folders = []
+		files = []
+		'''Current folder and its parents'''
+		path = [""]
+		'''{folder: lower case names of its folders and files}'''
+		used = {"": set()}
+		def onDisk(folder):
+			return None if root is None else os.path.join(root, folder)
 
 		for layer in self.layerMask.layers:
-			name = layer.name
-			id = layer.layerId
 			toSave = True
 			type = layer.layerType["code"]
 			if type != 0 and inFolders:
 				toSave = False
 				if type in [1, 2]:
-					name = make_valid_filename("./%s" % name, name, id)
-					subdir = "./%s" % name
-					if not os.path.exists(subdir):
-						os.mkdir(subdir)
-					os.chdir(subdir)
-				elif type == 3:
-					os.chdir("./..")
-				
+					name = make_unique_filename(layer.name, layer.layerId, used[path[-1]],
+												folder=onDisk(path[-1]))
+					folder = os.path.join(path[-1], name)
+					folders.append(folder)
+					used[folder] = set()
+					path.append(folder)
+				elif type == 3 and len(path) > 1:
+					path.pop()
+
 			if not layer.visible and not saveInvis:
 				toSave = False
 
-			if sum(layer.image.size) == 0:
+			if layer.rectangle["width"] * layer.rectangle["height"] == 0:
 				toSave = False
 
 			if toSave:
-				layer.saved = True
 				if indexNames:
-					try:
-						layer.image.save("%d.png" % layer.layerId, "PNG")
-					except SystemError:
-						self.logger.error("Can't save %s layer." % name)
+					files.append((layer, os.path.join(path[-1], "%d.png" % layer.layerId), None))
 				else:
-					name = make_valid_filename("%s/%s.png" % (os.getcwd(), name), name, id)
-					layer.name = name #if it changes until
-					try:
-						#buffer = layer.image
-						#writer = open("%s/%s.png" % (dest, name), "wb")
-						#writer.write(buffer)
-						layer.image.save("%s/%s.png" % (os.getcwd(), name), "PNG")
-					except SystemError:
-						self.logger.error("Can't save %s layer." % name)
-		
-		os.chdir(initCwd)
+					name = make_unique_filename(layer.name, layer.layerId, used[path[-1]], ".png",
+												onDisk(path[-1]))
+					files.append((layer, os.path.join(path[-1], "%s.png" % name), name))
+		return folders, files
+
+	def save(self, dest=None, saveInvis=False, dirName=None, indexNames=False, inFolders=True,
+			 workers=None, compression=6):
+		'''
+		Saves layers as PNG files into dest/dirName, folders of layers as
+		directories. Files existing in dest/dirName are not overwritten,
+		see getOutputTree. The current directory is never changed.
+		dirName - name of the PSD file without extension by default.
+		workers - encode the images in a pool of so many processes.
+		compression - zlib level of PNG files, 0 to 9.
+		Returns dirName.
+		'''
+		if not dest:
+			dest = os.getcwd()
+
+		if not dirName:
+			psdBaseName = os.path.basename(self.fileName)
+			psdFileName = os.path.splitext(psdBaseName)
+			dirName = psdFileName[0]
+
+		dest = os.path.join(dest, dirName)
+
+		folders, files = self.getOutputTree(saveInvis, indexNames, inFolders, dest)
+		for folder in [dest] + [os.path.join(dest, folder) for folder in folders]:
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+
+		tasks = []
+		for layer, fileName, name in files:
+			layer.saved = True
+			if name is not None:
+				layer.name = name
+			tasks.append((layer, os.path.join(dest, fileName), compression))
+
+		if workers and workers > 1 and len(tasks) > 1:
+			'''
+			Workers read the layers back from the file by offset, see
+			decodeLayers. Without the file they get the decoded layers.
+			'''
+			layers = [layer for layer, fileName, level in tasks]
+			if not self.fileName or self.stream:
+				for layer in layers:
+					if layer._channels is None:
+						layer.loadImageData()
+			copies = self.layerMask.getDetachedLayers(layers)
+			tasks = [(layerCopy,) + task[1:] for layerCopy, task in zip(copies, tasks)]
+			pool = multiprocessing.Pool(workers)
+			try:
+				errors = list(pool.imap_unordered(saveLayerImage, tasks))
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			errors = map(saveLayerImage, tasks)
+
+		for error in errors:
+			if error:
+				self.logger.error(error)
 		return dirName
 
 	def __str__(self):
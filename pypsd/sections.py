@@ -1,10 +1,29 @@
 from __future__ import division
 import logging
-from base import PSDParserBase
+import copy
+import instrument
+import multiprocessing
+from base import PSDParserBase, HEADER_RECORD, LAYER_RECORD, BLEND_RECORD, \
+	MASK_RECORD, MASK_RECORD_REAL, MASK_DISABLED, LARGE_LENGTH_KEYS, RECTANGLE_RECORD, \
+	THUMBNAIL_RECORD, channelsInfoRecord, makeRectangle, ByteCursor
+from planes import decodePackBits, decodeZip, planeRowBytes, toPlane, to8Bit, \
+	readAt, iterRawRows, iterPackBitsRows, iterZipRows, readPlanePreview, \
+	placeMask, iterMaskRows, applyMask
+from pngstream import writePNG
+import numpy
 #Python 3: import io
 import StringIO
 from PIL import Image
 
+def decodeLayerData(layer):
+	'''
+	Decodes channel image data of a layer copy in a worker process and
+	assembles its RGBA pixels. Returns (channels, pixels). Used by
+	PSDLayerMask.decodeLayers.
+	'''
+	layer.loadImageData()
+	return layer.channels, layer.pixels
+
 def validate(label, value, range=None, mustBe=None, list=None):
 	assert label is not None
 	assert value is not None or range is not None or list is not None
@@ -65,60 +84,64 @@ class PSDHeader(PSDParserBase):
 	def parse(self):
 		self.debugMethodInOut("parse")
 
+		'''
+		26 bytes.
+		Whole header is read at once, fields are described below.
+		'''
+		(self.signature, self.version, self.channelsNum, self.height,
+		 self.width, self.depth, colorMode) = self.readRecord(HEADER_RECORD)
+
 		'''
 		4 bytes.
 		Signature: Always equal to '8BPS'.
 		Do not try to read the file if the signature does not match this value.
 		'''
-		self.signature = self.readString(4)
-		self.logger.debug("Signature: %s" % self.signature)
+		self.logger.debug("Signature: %s", self.signature)
 		validate("Signature", self.signature, mustBe=self.SIGNATURE)
 
 		'''
 		2 bytes.
-		Version: Always equal to 1. Do not try to read the file if the version 
-		does not match this value.
+		Version: 1, 2 for large documents (PSB). Do not try to read the file
+		if the version does not match these values.
 		'''
-		self.version = self.readShortInt()
-		self.logger.debug("Version: %d" % self.version)
-		validate("Version", self.version, mustBe=self.VERSION)
+		self.logger.debug("Version: %d", self.version)
+		validate("Version", self.version, list=[self.VERSION, self.VERSION_LARGE])
+		sizeRange = self.SIZE_RANGE_LARGE if self.version == self.VERSION_LARGE else self.SIZE_RANGE
 
 		'''
 		6 bytes.
 		Reserved: Must be zero.'''
-		self.skip(6)
 
 		'''
 		2 bytes.
 		Channels: The number of channels in the image, including any alpha channels.
 		Supported range is 1 to 56.
 		'''
-		self.channelsNum = self.readShortInt()
-		self.logger.debug("Channels #: %d" % self.channelsNum)
+		self.logger.debug("Channels #: %d", self.channelsNum)
 		validate("Channels number", self.channelsNum, range=self.CHANNELS_RANGE)
 
 		'''
 		4 bytes.
-		Height: The height of the image in pixels. Supported range is 1 to 30,000.
+		Height: The height of the image in pixels. Supported range is 1 to 30,000
+		(300,000 in PSB).
 		'''
-		self.height = self.readInt()
-		self.logger.debug("Height: %d" % self.height)
-		validate("Height", self.height, range=self.SIZE_RANGE)
+		self.logger.debug("Height: %d", self.height)
+		validate("Height", self.height, range=sizeRange)
 
 		'''
 		4 bytes.
-		Width: The width of the image in pixels. Supported range is 1 to 30,000.
+		Width: The width of the image in pixels. Supported range is 1 to 30,000
+		(300,000 in PSB).
 		'''
-		self.width = self.readInt()
-		self.logger.debug("Width: %d" % self.width)
-		validate("Width", self.width, range=self.SIZE_RANGE)
+		self.logger.debug("Width: %d", self.width)
+		validate("Width", self.width, range=sizeRange)
 
 		'''
 		2 bytes.
 		Depth: The number of bits per channel. Supported values are 1, 8, and 16.
 		'''
-		self.depth = self.readShortInt() #TODO 1, 8, 16 .check for new versions
-		self.logger.debug("Color Depth: %d" % self.depth)
+		#TODO 1, 8, 16 .check for new versions
+		self.logger.debug("Color Depth: %d", self.depth)
 		validate("Depth", self.depth, list=self.DEPTH_LIST)
 
 		'''
@@ -128,10 +151,9 @@ class PSDHeader(PSDParserBase):
 		colorModeMap = {0:"Bitmap", 1:"Grayscale", 2:"Indexed Color", 
 						   3:"RGB Color", 4:"CMYK Color", 7:"Multichannel", 
 						   8:"Duotone", 9:"Lab Color"}
-		colorMode = self.readShortInt()
 		self.colorMode = self.getCodeLabelPair(colorMode, colorModeMap)
 		
-		self.logger.debug("Color Schema: %s" % self.colorMode)
+		self.logger.debug("Color Schema: %s", self.colorMode)
 
 	def __str__(self):
 		return  ("==Header==\nSignature: %s\n"
@@ -189,6 +211,10 @@ class PSDImageResources(PSDParserBase):
 	The third section of the file contains image resources. As with
 	the color mode data, the section is indicated by a length field
 	followed by the data.
+	Parse only indexes the resources: resources is a list of {"id",
+	"name", "offset", "length", "data"}. Data of resources with a decoder
+	(see RESOURCE_DECODERS) is decoded on first getData and read back
+	from the file with one call; it is None until then.
 	'''
 
 	def __init__(self, stream, psd):
@@ -200,14 +226,25 @@ class PSDImageResources(PSDParserBase):
 
 	def parse(self):
 		self.debugMethodInOut("parse")
-		
+
 		'''
 		4 bytes
 		Length of image resource section.
 		'''
 		length = self.readInt()
 		pos = self.getPos()
-		
+
+		'''
+		The section is read with one call.
+		'''
+		self.stream = ByteCursor(self.stream, length)
+		try:
+			self.readResources(pos, length)
+		finally:
+			self.stream = self.stream.release()
+		self.skipRest(pos, length)
+
+	def readResources(self, pos, length):
 		'''
 		Image resources
 		'''
@@ -230,96 +267,171 @@ class PSDImageResources(PSDParserBase):
 			consists of two bytes of 0)
 			'''
 			name = self.readPascalString()
-			resource = {"id": resId, "name": name, "data":None}
-			
+
 			'''
 			4 bytes
 			Actual size of resource data that follows
 			'''
 			data_length = self.readInt(returnEven=True)
 			data_start = self.getPos()
-			
+
 			'''
 			The resource data, described in the sections on the individual resource
 			types. It is padded to make the size even.
 			'''
-			
-			if resId == 1050: #Slices
-				slice_data = {}
-				'''
-				4 bytes.
-				Version ( = 6)
-				'''
-				ver = self.readInt()
-				validate("Photoshop Version for slices", ver, mustBe=6)
-				
-				'''
-				4 * 4 bytes.
-				Bounding rectangle for all of the slices: top, left, bottom, right of all the slices
-				'''
-				slice_data["rectangle"] = self.getRectangle()
-				'''
-				Name of group of slices: Unicode string
-				'''
-				slice_data["group_name"] = self.readUnicodeString()
+			resource = {"id": resId, "name": name, "offset": data_start,
+						"length": data_length, "data": None}
+			self.resources.append(resource)
+
+			self.skipRest(data_start, data_length)
+
+	def getResource(self, resId):
+		'''
+		The first resource with the id or None.
+		'''
+		for resource in self.resources:
+			if resource["id"] == resId:
+				return resource
+		return None
+
+	def getData(self, resId):
+		'''
+		Decoded data of the resource, None if there is no such resource or
+		no decoder for it.
+		'''
+		resource = self.getResource(resId)
+		if resource is None:
+			return None
+		decoder = RESOURCE_DECODERS.get(resId)
+		if resource["data"] is None and decoder is not None:
+			stream = self.psd.openStream()
+			try:
+				stream.seek(resource["offset"])
+				self.stream = ByteCursor(stream, resource["length"])
+				resource["data"] = decoder(self, resource)
+			finally:
+				self.stream = stream
+				self.psd.closeStream(stream)
+		return resource["data"]
+
+	def getThumbnail(self):
+		'''
+		PIL image of the thumbnail Photoshop embeds (JPEG), None if there
+		is none.
+		'''
+		thumbnail = self.getData(1036) or self.getData(1033)
+		if thumbnail is None:
+			return None
+		if thumbnail["format"] == 1:
+			image = Image.open(StringIO.StringIO(thumbnail["data"]))
+		else:
+			image = Image.frombuffer("RGB", (thumbnail["width"], thumbnail["height"]),
+									 thumbnail["data"], "raw", "RGB", thumbnail["widthBytes"], 1)
+		if thumbnail["bgr"]:
+			'''Photoshop 4.0 thumbnail (1033) keeps blue, green, red'''
+			blue, green, red = image.convert("RGB").split()
+			image = Image.merge("RGB", (red, green, blue))
+		return image
+
+	def readSlices(self, resource):
+		slice_data = {}
+		'''
+		4 bytes.
+		Version ( = 6)
+		'''
+		ver = self.readInt()
+		validate("Photoshop Version for slices", ver, mustBe=6)
+
+		'''
+		4 * 4 bytes.
+		Bounding rectangle for all of the slices: top, left, bottom, right of all the slices
+		'''
+		slice_data["rectangle"] = self.getRectangle()
+		'''
+		Name of group of slices: Unicode string
+		'''
+		slice_data["group_name"] = self.readUnicodeString()
+		'''
+		4 bytes.
+		Number of slices to follow.
+		'''
+		slices_num = self.readInt()
+		slices = [{}] * slices_num
+		for i in range(slices_num):
+			slice = {}
+			''' 4 bytes. ID'''
+			slice["id"] = self.readInt()
+			''' 4 bytes. Group ID'''
+			slice["group_id"] = self.readInt()
+			''' 4 bytes. Origin'''
+			slice["origin"] = self.readInt()
+			''' 4 bytes. Origin'''
+			if slice["origin"] == 1:
 				'''
 				4 bytes.
-				Number of slices to follow.
+				Associated Layer ID
+				NOTE: Only present if Origin = 1
 				'''
-				slices_num = self.readInt()
-				slices = [{}] * slices_num 
-				for i in range(slices_num):
-					slice = {}
-					''' 4 bytes. ID'''
-					slice["id"] = self.readInt()
-					''' 4 bytes. Group ID'''
-					slice["group_id"] = self.readInt()
-					''' 4 bytes. Origin'''
-					slice["origin"] = self.readInt()
-					''' 4 bytes. Origin'''
-					if slice["origin"] == 1:
-						'''
-						4 bytes.
-						Associated Layer ID
-						NOTE: Only present if Origin = 1
-						'''
-						slice["assoc_layer_id"] = self.readInt()
-					''' Name: Unicode string '''
-					slice["name"] = self.readUnicodeString()
-					''' 4 bytes. Name '''
-					slice["type"] = self.readInt()
-					'''
-					4 * 4 bytes.
-					Left, top, right, bottom positions
-					'''
-					slice["position"] = self.getRectangle()
-					'''
-					Unicode Strings: Url, Target, Message, Alt Tag
-					'''
-					slice["URL"] = self.readUnicodeString()
-					slice["target"] = self.readUnicodeString()
-					slice["message"] = self.readUnicodeString()
-					slice["alt"] = self.readUnicodeString()
-					''' 1 byte. Cell text is HTML: Boolean'''
-					slice["cell_is_HTML"] = self.readBoolean()
-					''' Unicode. Cell text: Unicode string'''
-					slice["cell_text"] = self.readUnicodeString()
-					''' 4 bytes. Horizontal alignment'''
-					slice["hor_align"] = self.readInt()
-					''' 4 bytes. Vertical alignment'''
-					slice["ver_align"] = self.readInt()
-					slice["argb"] = [self.readTinyInt() for a in range(4)]
-					
-					slices[i] = slice
-			
-			self.resources.append(resource)
-			
-			self.skipRest(data_start, data_length)
-		self.skipRest(pos, length)
+				slice["assoc_layer_id"] = self.readInt()
+			''' Name: Unicode string '''
+			slice["name"] = self.readUnicodeString()
+			''' 4 bytes. Name '''
+			slice["type"] = self.readInt()
+			'''
+			4 * 4 bytes.
+			Left, top, right, bottom positions
+			'''
+			left, top, right, bottom = self.readRecord(RECTANGLE_RECORD)
+			slice["position"] = makeRectangle(top, left, bottom, right)
+			'''
+			Unicode Strings: Url, Target, Message, Alt Tag
+			'''
+			slice["URL"] = self.readUnicodeString()
+			slice["target"] = self.readUnicodeString()
+			slice["message"] = self.readUnicodeString()
+			slice["alt"] = self.readUnicodeString()
+			''' 1 byte. Cell text is HTML: Boolean'''
+			slice["cell_is_HTML"] = self.readBoolean()
+			''' Unicode. Cell text: Unicode string'''
+			slice["cell_text"] = self.readUnicodeString()
+			''' 4 bytes. Horizontal alignment'''
+			slice["hor_align"] = self.readInt()
+			''' 4 bytes. Vertical alignment'''
+			slice["ver_align"] = self.readInt()
+			slice["argb"] = [self.readTinyInt() for a in range(4)]
+
+			slices[i] = slice
+		slice_data["slices"] = slices
+		return slice_data
+
+	def readThumbnail(self, resource):
+		'''
+		4 bytes. Format: 1 = JPEG RGB, 0 = raw RGB.
+		4 bytes each. Width, height, row size in bytes (padded to 4).
+		4 bytes each. Total size, size after compression.
+		2 bytes each. Bits per pixel (24), number of planes (1).
+		Then the JPEG data or the rows.
+		'''
+		(format, width, height, widthBytes, size, compressedSize,
+		 bits, planes) = self.readRecord(THUMBNAIL_RECORD)
+		return {"format": format, "width": width, "height": height,
+				"widthBytes": widthBytes, "bgr": resource["id"] == 1033,
+				"data": self.stream.read(compressedSize if format == 1 else widthBytes * height)}
 
 	def __str__(self):
 		return "==Image Resources=="
 
+'''
+Decoders of image resources data by resource id: functions of
+(PSDImageResources reading the data, resource) returning the data.
+Other resources can be registered here.
+'''
+RESOURCE_DECODERS = {
+	1050: PSDImageResources.readSlices,
+	1033: PSDImageResources.readThumbnail,
+	1036: PSDImageResources.readThumbnail,
+}
+
 
 class PSDLayerMask(PSDParserBase):
 	'''
@@ -334,6 +446,8 @@ class PSDLayerMask(PSDParserBase):
 		self.debugMethodInOut("__init__")
 
 		self.layers = []
+		'''Merged image of the document'''
+		self.baseLayer = None
 
 		super(PSDLayerMask, self).__init__(stream, psd)
 
@@ -341,64 +455,191 @@ class PSDLayerMask(PSDParserBase):
 		self.debugMethodInOut("parse")
 		
 		'''
-		4 bytes.
+		4 bytes (8 bytes in PSB).
 		Length of the layer and mask information section.
 		'''
-		layerMaskSize = self.readInt()
+		layerMaskSize = self.readLength()
 		pos = self.getPos()
 		
 		if layerMaskSize > 0:
 			'''
-			4 bytes.
+			4 bytes (8 bytes in PSB).
 			Length of the layers info section, rounded up to a multiple of 2. 
 			'''
-			layerInfoSize = self.readInt(returnEven=True)
-			
-			if layerInfoSize > 0:
-				'''
-				2 bytes.
-				Layers count.
-				'''
-				layersCount = self.readShortInt()
+			layerInfoSize = self.readLength(returnEven=True)
+			layerInfoPos = self.getPos()
+			self.readLayerInfo(layerInfoSize)
+			self.skipRest(layerInfoPos, layerInfoSize)
 
+			if not self.layers:
 				'''
-				If it is a negative number, its absolute value is the number of
-				layers and the first alpha channel contains the transparency data for the
-				merged result.
+				Layers of 16 bits documents are in a tagged block.
 				'''
-				if layersCount < 0:
-					#TODO Process this if needed.
-					layersCount = abs(layersCount)
-
-				for i in range(layersCount):
-					layer = PSDLayer(self.stream, self.psd)
-					self.layers.append(layer)
-					self.logger.debug(layer)
-				
-				for layer in self.layers:
-					layer.getImageData(needReadPlaneInfo=True, lineLengths=[]) 
-				
-				self.layers.reverse()
+				self.readTaggedBlocks(pos + layerMaskSize)
 			
 			self.skipRest(pos, layerMaskSize)
 		
 		baseLayer = PSDLayer(self.stream, self.psd, is_base_layer=True)
-		rle = self.readShortInt() == 1
-		height = baseLayer.rectangle["height"]
-		if rle:
-			nLines = height * len(baseLayer.channelsInfo)
-			lineLengths = []
-			for h in range(nLines):
-				lineLength = self.readShortInt()
-				lineLengths.append(lineLength)
-			baseLayer.getImageData(False, lineLengths)
-		else:
-			baseLayer.getImageData(False)
-		
+		baseLayer.dataOffset = self.getPos()
+		self.baseLayer = baseLayer
 		if not self.layers:
 			self.layers.append(baseLayer)
+
+		if not self.psd.lazy and (self.psd.select is None or self.psd.select(baseLayer)):
+			baseLayer.getBaseImageData()
 		
 	
+	def readLayerInfo(self, layerInfoSize):
+		'''
+		Layer info: layer records and channel image data of the layers,
+		layerInfoSize bytes from the current position.
+		'''
+		layerInfoPos = self.getPos()
+		if layerInfoSize > 0:
+			'''
+			2 bytes.
+			Layers count.
+			'''
+			layersCount = self.readShortInt()
+
+			'''
+			If it is a negative number, its absolute value is the number of
+			layers and the first alpha channel contains the transparency data for the
+			merged result.
+			'''
+			if layersCount < 0:
+				#TODO Process this if needed.
+				layersCount = abs(layersCount)
+
+			'''
+			Layer records are read in blocks, not field by field.
+			'''
+			cursor = ByteCursor(self.stream, limit=layerInfoPos + layerInfoSize)
+			try:
+				for i in range(layersCount):
+					layer = PSDLayer(cursor, self.psd)
+					self.layers.append(layer)
+					self.logger.debug(layer)
+			finally:
+				self.stream = cursor.release()
+			for layer in self.layers:
+				layer.stream = self.stream
+			
+			'''
+			Channel image data of every layer follows the records. Lazy
+			parse only remembers where it starts.
+			'''
+			offset = self.getPos()
+			for layer in self.layers:
+				layer.dataOffset = offset
+				offset += layer.getDataLength()
+			self.layers.reverse()
+
+			if not self.psd.lazy:
+				'''
+				Layers not selected are skipped by seek to the data of the
+				next selected one, they are decoded on first access.
+				'''
+				select = self.psd.select
+				if select is not None:
+					self.groupLayers()
+				for layer in reversed(self.layers):
+					if select is None or select(layer):
+						self.skipRest(layer.dataOffset, 0)
+						layer.readLayerData()
+			self.skipRest(offset, 0)
+
+	def readTaggedBlocks(self, end):
+		'''
+		Tagged blocks which follow the global layer mask info up to end.
+		Only layer info of the Lr16 block is read: Photoshop keeps layers
+		of 16 bits documents there and leaves the layer info empty.
+		'''
+		
+		'''
+		4 bytes.
+		Length of global layer mask info.
+		'''
+		self.skip(self.readInt())
+		while self.getPos() + 12 <= end:
+			signature = self.readString(4)
+			if signature not in [self.SIGNATIRE_8BIM, "8B64"]:
+				break
+			tag = self.readString(4)
+			if tag in LARGE_LENGTH_KEYS:
+				size = self.readLength(True)
+			else:
+				size = self.readInt(True)
+			blockPos = self.getPos()
+			if tag == "Lr16" and not self.layers:
+				self.readLayerInfo(size)
+			self.skipRest(blockPos, size)
+	
+	def decodeLayers(self, workers, select=None):
+		'''
+		Decodes channel image data of all not yet decoded layers and of the
+		merged image in a pool of workers processes, which assemble their
+		RGBA pixels as well. PIL images share the pixels memory and are made
+		on first access. Every worker reads its layer back from the file by
+		offset, so the file should be given by name.
+		select - predicate of layers to decode, all of them by default.
+		'''
+		layers = self.layers
+		if self.baseLayer not in layers:
+			'''Documents without layers have it in layers already'''
+			layers = layers + [self.baseLayer]
+		layers = [l for l in layers if l._channels is None]
+		if select is not None:
+			layers = [l for l in layers if select(l)]
+		if not self.psd.fileName or self.psd.stream:
+			for layer in layers:
+				layer.loadImageData()
+			return
+
+		tasks = self.getDetachedLayers(layers)
+		pool = multiprocessing.Pool(workers)
+		try:
+			for layer, (channels, pixels) in zip(layers, pool.imap(decodeLayerData, tasks)):
+				layer._channels = channels
+				layer._pixels = pixels
+		finally:
+			pool.close()
+			pool.join()
+
+	def getDetachedLayers(self, layers):
+		'''
+		Copies of layers to send to worker processes: without the rest of
+		the document and the layers tree.
+		'''
+		psd = copy.copy(self.psd)
+		psd.colorMode = psd.imageResources = psd.layerMask = None
+		copies = []
+		for layer in layers:
+			layerCopy = copy.copy(layer)
+			layerCopy.psd = psd
+			layerCopy.parent = None
+			layerCopy.parents = []
+			copies.append(layerCopy)
+		return copies
+
+	def loadTypeTools(self, stream=None):
+		'''
+		Parses type tool data of all layers which have it deferred, in the
+		file order, from stream or from the file opened once.
+		'''
+		layers = [l for l in self.layers if l.typeToolOffset is not None]
+		if not layers:
+			return
+		opened = stream is None
+		if opened:
+			stream = self.psd.openStream()
+		try:
+			for layer in sorted(layers, key=lambda l: l.typeToolOffset):
+				layer.loadTypeTool(stream)
+		finally:
+			if opened:
+				self.psd.closeStream(stream)
+
 	def groupLayers(self):
 		parents = [None]
 		for layer in self.layers:
@@ -452,13 +693,39 @@ class PSDLayer(PSDParserBase):
 		self.name = None
 		
 		'''Channel image data. {"a":[],"r":[],"g":[],"b":[]}'''
-		self.channels = {}
+		self._channels = None
+		'''RGBA pixels. uint8 array of height x width x 4'''
+		self._pixels = None
+		self._image = None
+		'''Position of the channel image data in the file'''
+		self.dataOffset = None
 		
 		self.layerId = None
 		self.layerType = {"code":0, "label":"other"}
+		'''
+		User mask (channel -2): rectangle, default color 0 or 255 outside
+		it, flags. Real user mask (channel -3) comes with vector masks.
+		'''
+		self.maskRectangle = None
+		self.maskDefaultColor = 255
+		self.maskFlags = 0
+		self.realMaskRectangle = None
+		self.realMaskDefaultColor = 255
+		self.realMaskFlags = 0
+		'''Folder of the layer and all its folders, see groupLayers'''
 		self.parent = None
+		self.parents = []
 		self.saved = False
-		self.text = None
+		'''
+		Position and size of the type tool data (TySh). It is parsed on
+		first access to text, text_data, wrap_data or styled_text.
+		'''
+		self.typeToolOffset = None
+		self.typeToolSize = 0
+		self._text = None
+		self._text_data = None
+		self._wrap_data = None
+		self._styled_text = None
 		
 		super(PSDLayer, self).__init__(stream, psd)
 	
@@ -472,47 +739,50 @@ class PSDLayer(PSDParserBase):
 		4 * 4 bytes.
 		Rectangle containing the contents of the layer. Specified as top, left,
 		bottom, right coordinates.
-		'''
-		self.rectangle = self.getRectangle()
-
-		'''
 		2 bytes.
 		The number of channels in the layer.
 		'''
-		chanelsCount = self.readShortInt()
+		top, left, bottom, right, chanelsCount = self.readRecord(LAYER_RECORD)
+		self.rectangle = makeRectangle(top, left, bottom, right)
 
 		'''
 		6 * number of channels bytes
-		Channel information. Six bytes per channel.
+		Channel information. Six bytes per channel: 2 bytes id, 4 bytes length
+		(ten bytes, 8 bytes length in PSB).
 		'''
-		self.channelsInfo = []
-		for i in range(chanelsCount):
-			channelId = self.readShortInt()
-			channelLength = self.readInt()
-			self.channelsInfo.append((channelId, channelLength))
+		channelsInfo = self.readRecord(channelsInfoRecord(chanelsCount, self.isLarge()))
+		self.channelsInfo = zip(channelsInfo[::2], channelsInfo[1::2])
 
+		'''
+		12 bytes.
+		Blend mode signature, key, opacity, clipping, flags and filler read
+		at once. Fields are described below.
+		'''
+		(bimSignature, blendCode, self.opacity, clipping, flags,
+		 filler) = self.readRecord(BLEND_RECORD)
 
 		'''
 		4 bytes.
 		Blend mode signature. 
 		'''
-		bimSignature = self.readString(4)
 		validate("Blend mode signature", bimSignature, mustBe=self.SIGNATIRE_8BIM)
 
 		'''
 		4 bytes.
 		Blend mode key.
 		'''
-		blendMap = {"norm":"normal",  "dark":"darken", "lite":"lighten",
+		blendMap = {"pass":"pass through", "norm":"normal",  "dark":"darken", "lite":"lighten",
 					"hue":"hue", "sat":"saturation", "colr":"color",
 					"lum":"luminosity", "mul":"multiply", "scrn":"screen",
 					"diss":"dissolve", "over":"overlay", "hLit":"hard light",
 					"sLit":"soft light", "diff":"difference","smud":"exclusion",
-					"div ":"color dodge", "idiv":"color burn", 
+					"div":"color dodge", "idiv":"color burn", 
 					"lbrn":"linear burn", "lddg":"linear dodge", 
 					"vLit":"vivid light", "lLit":"linear light", 
-					"pLit":"pin light", "hMix":"hard mix"}
-		blendCode = self.readString(4).strip()
+					"pLit":"pin light", "hMix":"hard mix",
+					"dkCl":"darker color", "lgCl":"lighter color",
+					"fsub":"subtract", "fdiv":"divide"}
+		blendCode = blendCode.strip()
 		self.blendMode = self.getCodeLabelPair(blendCode, blendMap)
 		validate("Blend mode key", blendCode, list=blendMap.keys())
 
@@ -520,14 +790,13 @@ class PSDLayer(PSDParserBase):
 		1 byte.
 		Opacity. 0 = transparent ... 255 = opaque
 		'''
-		self.opacity = self.readTinyInt()
 		validate("Opacity", self.opacity, range=self.OPACITY_RANGE)
 
 		'''
 		1 byte.
 		Clipping. 0 (false) = base, 1 (true) = non-base
 		'''
-		self.clipping = self.readTinyInt() != 0
+		self.clipping = clipping != 0
 
 		'''
 		1 byte.
@@ -537,20 +806,19 @@ class PSDLayer(PSDParserBase):
 		bit 3 = 1 for Photoshop 5.0 and later, tells if bit 4 has useful information;
 		bit 4 = pixel data irrelevant to appearance of document
 		'''
-		flagsBits = self.readBits(1)
-		self.transpProtected = flagsBits[0] != 0
-		self.visible =  flagsBits[1] == 0
-		self.obsolete =  flagsBits[2] != 0
+		self.transpProtected = flags & 0x01 != 0
+		self.visible =  flags & 0x02 == 0
+		self.obsolete =  flags & 0x04 != 0
 		'''bit 3 = 1 for Photoshop 5.0 and later, tells if bit 4 has useful 
 		information'''
-		if flagsBits[3] != 0:
-			self.pixelDataIrrelevant = flagsBits[4] != 0 
+		if flags & 0x08 != 0:
+			self.pixelDataIrrelevant = flags & 0x10 != 0 
 		
 		'''
 		1 bytes.
 		Filler (zero).
 		'''
-		validate("Filler (zero)", self.readTinyInt(), mustBe=0)
+		validate("Filler (zero)", filler, mustBe=0)
 		
 		# ---- Extra Fields Parsing.
 		
@@ -587,10 +855,13 @@ class PSDLayer(PSDParserBase):
 			tag = self.readString(4)
 			
 			'''
-			4 bytes.
+			4 bytes (8 bytes for some keys in PSB).
 			Length data below, rounded up to an even byte count.
 			'''
-			size = self.readInt(True) 
+			if tag in LARGE_LENGTH_KEYS:
+				size = self.readLength(True)
+			else:
+				size = self.readInt(True)
 			prevPos = self.getPos()
 			
 			if tag == "lyid":
@@ -621,8 +892,8 @@ class PSDLayer(PSDParserBase):
 				'''
 				self.readVectorMask()
 			elif tag == 'TySh':
-				self.readTypeTool()
-				self.text = self.text_data["Txt"]["value"]
+				self.typeToolOffset = prevPos
+				self.typeToolSize = size
 			
 			self.skipRest(prevPos, size)
 		 
@@ -645,8 +916,8 @@ class PSDLayer(PSDParserBase):
 		rectangle = [0]*4
 		for i in range(4):
 			rectangle[i] = self.readDouble()
-		self.text_data = text_data
-		self.wrap_data = wrap_data
+		self._text_data = text_data
+		self._wrap_data = wrap_data
 		styled_text = []
 		#try:
 		
@@ -663,7 +934,7 @@ class PSDLayer(PSDParserBase):
 
 			return font
 		
-		ps_dict = self.text_data["EngineData"]["value"]
+		ps_dict = text_data["EngineData"]["value"]
 		text = ps_dict["EngineDict"]["Editor"]["Text"]
 		style_run = ps_dict["EngineDict"]["StyleRun"]
 		styles_list = style_run["RunArray"]
@@ -695,7 +966,7 @@ class PSDLayer(PSDParserBase):
 									'paragraphEnds': piese[-1] in ["\n", "\r"],
 								}})
 			start += styles_run_list[i]
-		self.styled_text = styled_text
+		self._styled_text = styled_text
 		#except:
 		#	pass
 	
@@ -716,15 +987,19 @@ class PSDLayer(PSDParserBase):
 		if size == 0:
 			return
 		
-		self.maskRectangle = self.getRectangle()
-		maskDefaultColor = self.readTinyInt()
-		flagsBits = self.readBits(1)
+		'''
+		Rectangle, default color, flags, then 2 bytes padding or, for 36
+		bytes, real flags, real user mask background and real rectangle.
+		'''
 		if size == 20:
-			self.maskPadding = self.readShortInt()
+			(top, left, bottom, right, self.maskDefaultColor, self.maskFlags,
+			 self.maskPadding) = self.readRecord(MASK_RECORD)
 		else:
-			realFlags = self.readTinyInt()
-			realUserMaskBack = self.readTinyInt()
-			maskRectangle2 = self.getRectangle()
+			(top, left, bottom, right, self.maskDefaultColor, self.maskFlags,
+			 self.realMaskFlags, self.realMaskDefaultColor, realTop, realLeft,
+			 realBottom, realRight) = self.readRecord(MASK_RECORD_REAL)
+			self.realMaskRectangle = makeRectangle(realTop, realLeft, realBottom, realRight)
+		self.maskRectangle = makeRectangle(top, left, bottom, right)
 	
 	def parse_base_layer(self):
 		header = self.psd.header
@@ -797,45 +1072,220 @@ class PSDLayer(PSDParserBase):
 		self.layerType = self.getCodeLabelPair(typeCode, typesMap)
 	
 	
+	def __getstate__(self):
+		'''
+		Pixels and image are rebuilt from channels on demand.
+		'''
+		state = super(PSDLayer, self).__getstate__()
+		state["_pixels"] = None
+		state["_image"] = None
+		return state
+
+	def getDataLength(self):
+		'''
+		Size of the channel image data of the layer, compression fields
+		included.
+		'''
+		return sum([length for channelId, length in self.channelsInfo])
+
+	def getChannels(self):
+		if self._channels is None:
+			self.loadImageData()
+		return self._channels
+
+	channels = property(getChannels)
+
+	def getPixels(self):
+		if self._pixels is None:
+			self.makePixels()
+		return self._pixels
+
+	pixels = property(getPixels)
+
+	def getImage(self):
+		if self._image is None:
+			self.makeImage()
+		return self._image
+
+	image = property(getImage)
+
+	def loadTypeTool(self, stream=None):
+		'''
+		Parses type tool data skipped by the layer records parse. The data
+		is read back from stream with one call. Without stream the file is
+		opened once for the deferred text of all layers of the document,
+		see PSDLayerMask.loadTypeTools.
+		'''
+		if self.typeToolOffset is None:
+			return
+		if stream is None:
+			if self.psd.layerMask is not None:
+				self.psd.layerMask.loadTypeTools()
+				if self.typeToolOffset is None:
+					return
+			stream = self.psd.openStream()
+			try:
+				return self.loadTypeTool(stream)
+			finally:
+				self.psd.closeStream(stream)
+
+		stream.seek(self.typeToolOffset)
+		self.stream = ByteCursor(stream, self.typeToolSize)
+		try:
+			self.readTypeTool()
+			if self._text_data is not None:
+				self._text = self._text_data["Txt"]["value"]
+			self.typeToolOffset = None
+		finally:
+			self.stream = stream
+
+	def getText(self):
+		self.loadTypeTool()
+		return self._text
+
+	text = property(getText)
+
+	def getTextData(self):
+		self.loadTypeTool()
+		return self._text_data
+
+	text_data = property(getTextData)
+
+	def getWrapData(self):
+		self.loadTypeTool()
+		return self._wrap_data
+
+	wrap_data = property(getWrapData)
+
+	def getStyledText(self):
+		self.loadTypeTool()
+		return self._styled_text
+
+	styled_text = property(getStyledText)
+
+	def loadImageData(self):
+		'''
+		Decodes channel image data skipped by the lazy parse. The data is
+		read back from the file at dataOffset.
+		'''
+		stream = self.psd.openStream()
+		try:
+			self.stream = stream
+			stream.seek(self.dataOffset)
+			if self.is_base_layer:
+				self.getBaseImageData()
+			else:
+				self.readLayerData()
+		finally:
+			self.psd.closeStream(stream)
+
+	def readLayerData(self):
+		'''
+		Channel image data of the layer. Unless the stream is mapped, it is
+		read with one call.
+		'''
+		cursor = None
+		if not hasattr(self.stream, "view"):
+			cursor = ByteCursor(self.stream, self.getDataLength())
+			self.stream = cursor
+		try:
+			self.getImageData(needReadPlaneInfo=True, lineLengths=[])
+		finally:
+			if cursor is not None:
+				cursor.seek(self.dataOffset + self.getDataLength())
+				self.stream = cursor.release()
+
+	def getBaseImageData(self):
+		'''
+		Image data section. Compression is common for all channels. For RLE
+		it is followed by the byte counts of all the scan lines of all
+		channels, then by the planes. ZIP compressed data of all the planes
+		is one deflate stream taking the rest of the file.
+		'''
+		compression = self.readShortInt()
+		validate("Compression", compression, range=[0,3])
+		if compression == 1:
+			nLines = self.rectangle["height"] * len(self.channelsInfo)
+			lineLengths = self.readLineLengths(nLines)
+			self.getImageData(False, lineLengths)
+		elif compression in [2, 3]:
+			depth = self.psd.header.depth
+			pos = self.getPos()
+			self.stream.seek(0, 2)
+			length = self.getPos() - pos
+			self.stream.seek(pos)
+			'''Prediction works by scan lines, planes are decoded as one'''
+			planes = decodeZip(self.readByteArray(length),
+							   planeRowBytes(self.rectangle["width"], depth),
+							   self.rectangle["height"] * len(self.channelsInfo),
+							   prediction=compression == 3, depth=depth)
+			stream = self.stream
+			self.stream = StringIO.StringIO(planes.tostring())
+			try:
+				self.getImageData(False)
+			finally:
+				self.stream = stream
+		else:
+			self.getImageData(False)
+
 	def getImageData(self, needReadPlaneInfo=True, lineLengths=[]):
+		hooks = instrument.current
+		if hooks is None:
+			return self.decodeImageData(needReadPlaneInfo, lineLengths)
+		hooks.enter(self.psd, "channels")
+		try:
+			self.decodeImageData(needReadPlaneInfo, lineLengths)
+			hooks.decoded(self.psd, self.rectangle["width"] * self.rectangle["height"])
+		finally:
+			hooks.leave()
+
+	def decodeImageData(self, needReadPlaneInfo=True, lineLengths=[]):
 		'''
 		Channel image data. Contains one or more image data records for each 
 		layer. The layers are in the same order as in the layer information.
+		Planes keep depth of the document: 16 bits ones are uint16 arrays.
+		Masks are moved into the layer rectangle and multiplied into alpha,
+		see getMaskInfo.
 		'''
-		self.channels = {"a":[],"r":[],"g":[],"b":[]}
+		noData = numpy.zeros(0, numpy.uint8)
+		self._channels = {"a":noData,"r":noData,"g":noData,"b":noData}
 		opacity_devider = self.opacity / 255
 		for i, channelTuple in enumerate(self.channelsInfo):
 			channelId, length = channelTuple
-			if channelId < -1:
-				width = self.maskRectangle["width"]
-				height = self.maskRectangle["height"]
-			else:
-				width = self.rectangle["width"]
-				height = self.rectangle["height"]
+			width, height = self.getChannelSize(channelId)
 				
-			channel = self.readColorPlane(needReadPlaneInfo, lineLengths, i, height=height, width=width)
+			channel = self.readColorPlane(needReadPlaneInfo, lineLengths, i,
+										  height=height, width=width, length=length)
 			if channelId == -1:
-				self.channels["a"] = [int(ch * opacity_devider) for ch in channel]  
+				if self.opacity != 255:
+					channel = (channel * opacity_devider).astype(channel.dtype)
+				self._channels["a"] = channel
 			elif channelId == 0:
-				self.channels["r"] = channel
+				self._channels["r"] = channel
 			elif channelId == 1:
-				self.channels["g"] = channel
+				self._channels["g"] = channel
 			elif channelId == 2:
-				self.channels["b"] = channel
+				self._channels["b"] = channel
 			elif channelId < -1:
-				self.channels["a"] = [int(a * (c/255)) for a, c in zip(self.channels["a"], channel)]
+				maskRectangle, default, disabled = self.getMaskInfo(channelId)
+				if not disabled:
+					mask = placeMask(channel, maskRectangle, self.rectangle, default)
+					self._channels["a"] = applyMask(self._channels["a"], mask.ravel())
 				
 		self.debugMethodInOut("getImageData", 
 							  invars={"needReadPlaneInfo":needReadPlaneInfo,
 									  "lineLengths":lineLengths})
-		self.makeImage()
-		#self.makePngImage()
 		
 				
-	def readColorPlane(self, needReadPlaneInfo=True, lineLengths=[], planeNum=-1, height=None, width=None):
+	def readColorPlane(self, needReadPlaneInfo=True, lineLengths=[], planeNum=-1, height=None, width=None, length=None):
+		'''
+		length - size of the channel data with compression field, from
+		channelsInfo. Needed for ZIP compressed planes.
+		'''
 		self.debugMethodInOut("readColorPlane")
 
-		size = width  * height
+		depth = self.psd.header.depth
+		rowBytes = planeRowBytes(width, depth)
 		imageData = []
 		rleEncoded = None
 		
@@ -854,88 +1304,293 @@ class PSDLayer(PSDParserBase):
 			'''
 			If the compression code is 1, the image data starts with the byte 
 			counts for all the scan lines in the channel (LayerBottom LayerTop), 
-			with each count stored as a two byte value.
+			with each count stored as a two byte value (four bytes in PSB).
 			'''	
 			rleEncoded = compression == 1 
 			if rleEncoded: #RLE compressed
-				if not lineLengths:
-					lineLengths = [self.readShortInt() for a in range(height)]
+				if not len(lineLengths):
+					lineLengths = self.readLineLengths(height)
+			elif compression in [2, 3]:
+				'''
+				ZIP compressed data takes the rest of the channel.
+				'''
+				data = self.readByteArray(length - 2)
+				imageData = decodeZip(data, rowBytes, height,
+									  prediction=compression == 3, depth=depth)
+				return toPlane(imageData, width, height, depth)
 			planeNum = 0
-			#TODO raise NotImplementedError("Zip compression is not working yet.")
 		else:
-			rleEncoded = lineLengths != []
+			rleEncoded = len(lineLengths) > 0
 		
 		if rleEncoded:
-			imageData = self.readPlaneCompressed(lineLengths, planeNum, h=height, w=width)
+			imageData = self.readPlaneCompressed(lineLengths, planeNum, h=height, w=rowBytes)
 		else:
-			imageData = self.readBytesList(size)
+			imageData = self.readByteArray(rowBytes * height)
 		
-		return imageData
+		return toPlane(imageData, width, height, depth)
 	
 	def readPlaneCompressed(self, lineLengths, planeNum, h=None, w=None):
-		b = [0] * (w*h)
-		s = [] #w * 2
-		pos = 0
+		'''
+		Reads compressed bytes of all scan lines of the plane at once and
+		decodes them in bulk.
+		w - size of scan line in bytes.
+		'''
 		lineIndex = planeNum * h
-		for i in range(h):
-			len = lineLengths[lineIndex]
-			lineIndex += 1
-			s = self.readBytesList(len) + [0] * (w * 2 - len)
-			self.decodeRLE(s, 0, len, b, pos) 
-			pos += w
-		
-		return b
-	
-	def decodeRLE(self, src, sindex, slen, dst, dindex):
-		#try:
-		max = sindex + slen
-		while sindex < max:
-			b = src[sindex]
-			sindex += 1
-			n = b
-			if b > 127:
-				n = 255 - n + 2
-				b = src[sindex]
-				sindex += 1
-				for i in range(n):
-					dst[dindex] = b
-					dindex += 1
-			else:
-				n = n + 1
-				dst[dindex:dindex+n] = src[sindex:sindex+n]
-				dindex += n
-				sindex += n
-		#except Exception:
-		#	raise BaseException("RLE Decoding fatal error.")
+		lineLengths = lineLengths[lineIndex:lineIndex + h]
+		data = self.readByteArray(int(sum(lineLengths)))
+		return decodePackBits(data, lineLengths, w, h)
 
-	def makeImage(self):
+	def makePixels(self):
+		'''
+		Interleaves channel planes into RGBA pixels. Missing channels and
+		short planes are filled with 255. 16 bits planes are converted to
+		8 bits.
+		'''
 		width = self.rectangle["width"] 
 		height = self.rectangle["height"]
+		size = height * width
 		
-		self.image = Image.new("RGBA", (width, height))
-		imageData = [0]* (height * width)
-		white_rgba = [255] * 4
-		rgba_letters = ["r", "g","b","a"]
-		rgba_on_arr = [ len(self.channels[c]) for c in rgba_letters]
-				
-		for i in range(height * width):
-			rgba = [255] * 4
-			for j, c in enumerate(rgba_letters):
-				if rgba_on_arr[j] > i:
-					rgba[j] = self.channels[c][i]
-			imageData[i] = tuple(rgba)
-		
-		self.image.putdata(imageData)
-		
-#		for i, a in enumerate(self.channels["a"]):
-#			r = self.channels["r"][i]
-#			g = self.channels["g"][i]
-#			b = self.channels["b"][i]
-#			rgba = (r,g,b,a)
-#			imageData.append(rgba)
-		        
+		self._pixels = numpy.empty((height, width, 4), numpy.uint8)
+		pixels = self._pixels.reshape(size, 4)
+		for j, c in enumerate(["r", "g", "b", "a"]):
+			plane = to8Bit(self.channels[c][:size])
+			pixels[:len(plane), j] = plane
+			pixels[len(plane):, j] = 255
+
+	def makeImage(self):
+		'''
+		PIL image sharing memory with pixels.
+		'''
+		width = self.rectangle["width"] 
+		height = self.rectangle["height"]
 		
+		if width * height == 0:
+			self._image = Image.new("RGBA", (width, height))
+		else:
+			self._image = Image.frombuffer("RGBA", (width, height), self.pixels,
+										   "raw", "RGBA", 0, 1)
 		
+	def getChannelSize(self, channelId):
+		if channelId < -1:
+			rectangle = self.getMaskInfo(channelId)[0]
+			return rectangle["width"], rectangle["height"]
+		return self.rectangle["width"], self.rectangle["height"]
+
+	def getMaskInfo(self, channelId):
+		'''
+		Mask channel channelId (-2 user mask, -3 real user mask): its
+		rectangle in document coordinates, value outside it in the depth of
+		planes and whether the mask is disabled.
+		'''
+		if channelId == -3 and self.realMaskRectangle is not None:
+			rectangle, default, flags = (self.realMaskRectangle, self.realMaskDefaultColor,
+										 self.realMaskFlags)
+		else:
+			rectangle, default, flags = self.maskRectangle, self.maskDefaultColor, self.maskFlags
+		if self.psd.header.depth == 16:
+			default *= 257
+		return rectangle, default, bool(flags & MASK_DISABLED)
+
+	def getChannelLayout(self, stream):
+		'''
+		Where channel planes are in stream: list of (channelId, compression,
+		offset of plane data, its length, RLE line lengths or None), in the
+		file order. Compression fields and line lengths are read from stream
+		at dataOffset. None for ZIP compressed merged image data, its planes
+		can't be read apart.
+		'''
+		depth = self.psd.header.depth
+		lineCountType = numpy.dtype(self.getLineCountType())
+		countSize = lineCountType.itemsize
+		offset = self.dataOffset
+		layout = []
+		if self.is_base_layer:
+			'''
+			Image data section: compression common for all channels, RLE line
+			lengths of all channels, then planes one after another.
+			'''
+			width, height = self.getChannelSize(0)
+			rowBytes = planeRowBytes(width, depth)
+			compression = readAt(stream, offset, 2).view(">u2")[0]
+			offset += 2
+			if compression == 1:
+				linesNum = height * len(self.channelsInfo)
+				lineLengths = readAt(stream, offset, linesNum * countSize).view(lineCountType)
+				lineLengths = lineLengths.astype(numpy.intp)
+				offset += linesNum * countSize
+			elif compression in [2, 3]:
+				return None
+			else:
+				compression = 0
+			for i, (channelId, length) in enumerate(self.channelsInfo):
+				if compression == 1:
+					lengths = lineLengths[i * height:(i + 1) * height]
+					length = int(lengths.sum())
+				else:
+					lengths = None
+					length = rowBytes * height
+				layout.append((channelId, compression, offset, length, lengths))
+				offset += length
+			return layout
+
+		for channelId, length in self.channelsInfo:
+			height = self.getChannelSize(channelId)[1]
+			compression = readAt(stream, offset, 2).view(">u2")[0]
+			if compression == 1:
+				lineLengths = readAt(stream, offset + 2, height * countSize).view(lineCountType)
+				layout.append((channelId, compression, offset + 2 + height * countSize,
+							   length - 2 - height * countSize, lineLengths.astype(numpy.intp)))
+			else:
+				layout.append((channelId, compression, offset + 2, length - 2, None))
+			offset += length
+		return layout
+
+	def iterChannelRows(self, stream):
+		'''
+		Row iterators of channel planes read from stream at dataOffset.
+		Returns list of (channelId, rows) in the file order, None if planes
+		can't be read apart (see getChannelLayout).
+		'''
+		depth = self.psd.header.depth
+		layout = self.getChannelLayout(stream)
+		if layout is None:
+			return None
+		channels = []
+		for channelId, compression, offset, length, lineLengths in layout:
+			width, height = self.getChannelSize(channelId)
+			rowBytes = planeRowBytes(width, depth)
+			if compression == 1:
+				rows = iterPackBitsRows(stream, offset, lineLengths, rowBytes)
+			elif compression == 0:
+				rows = iterRawRows(stream, offset, rowBytes, height)
+			else:
+				rows = iterZipRows(stream, offset, length, rowBytes, height,
+								   prediction=compression == 3, depth=depth)
+			channels.append((channelId, rows))
+		return channels
+
+	def getPreview(self, factor):
+		'''
+		RGBA pixels of the layer reduced factor times: every factor-th pixel
+		of every factor-th row, uint8 array of ceil(height / factor) x
+		ceil(width / factor) x 4. Unless channels are decoded already, only
+		the needed scan lines and pixels are decoded from the file, see
+		readPlanePreview.
+		'''
+		if self._channels is not None:
+			return self.pixels[::factor, ::factor].copy()
+
+		depth = self.psd.header.depth
+		width, height = self.getChannelSize(0)
+		preview = numpy.empty(((height + factor - 1) // factor, (width + factor - 1) // factor, 4),
+							  numpy.uint8)
+		preview[:] = 255
+		stream = self.psd.openStream()
+		try:
+			layout = self.getChannelLayout(stream)
+			if layout is None:
+				return self.pixels[::factor, ::factor].copy()
+			alpha = None
+			for channelId, compression, offset, length, lineLengths in layout:
+				channelWidth, channelHeight = self.getChannelSize(channelId)
+				if channelId < -1:
+					maskRectangle, default, disabled = self.getMaskInfo(channelId)
+					if alpha is None or disabled:
+						continue
+					'''
+					Mask rows and columns do not line up with the sampled ones
+					of the layer, the whole mask is decoded and then sampled.
+					'''
+					mask = readPlanePreview(stream, offset, compression, length, lineLengths,
+											channelWidth, channelHeight, depth, 1).ravel()
+					mask = placeMask(mask, maskRectangle, self.rectangle, default)
+					alpha = applyMask(alpha, mask[::factor, ::factor].ravel())
+					continue
+				if channelId > 2:
+					continue
+
+				plane = readPlanePreview(stream, offset, compression, length, lineLengths,
+										 channelWidth, channelHeight, depth, factor)
+				if channelId in [0, 1, 2]:
+					preview[..., channelId] = to8Bit(plane)
+				elif channelId == -1:
+					alpha = plane.ravel()
+					if self.opacity != 255:
+						alpha = (alpha * (self.opacity / 255)).astype(alpha.dtype)
+			if alpha is not None:
+				preview.reshape(-1, 4)[:len(alpha), 3] = to8Bit(alpha)
+		finally:
+			self.psd.closeStream(stream)
+		return preview
+
+	def iter_rows(self):
+		'''
+		Yields RGBA rows of the layer as pixels has them: width x 4 uint8
+		arrays. Scan lines are read and decoded few at a time straight from
+		the file, so memory does not depend on the layer size.
+		'''
+		if self._channels is not None:
+			for row in self.pixels:
+				yield row
+			return
+
+		depth = self.psd.header.depth
+		width, height = self.getChannelSize(0)
+		stream = self.psd.openStream()
+		try:
+			channelRows = self.iterChannelRows(stream)
+			if channelRows is None:
+				for row in self.pixels:
+					yield row
+				return
+			channels = []
+			for channelId, rows in channelRows:
+				if channelId > 2:
+					'''Extra channels are not part of RGBA, as in decodeImageData'''
+					continue
+				channelWidth = self.getChannelSize(channelId)[0]
+				rows = (toPlane(row, channelWidth, 1, depth) for row in rows)
+				if channelId < -1:
+					maskRectangle, default, disabled = self.getMaskInfo(channelId)
+					if disabled:
+						continue
+					rows = iterMaskRows(rows, maskRectangle, self.rectangle, default,
+										">u2" if depth == 16 else numpy.uint8)
+				channels.append((channelId, rows))
+
+			opacity_devider = self.opacity / 255
+			for y in range(height):
+				row = numpy.empty((width, 4), numpy.uint8)
+				row[:] = 255
+				alpha = None
+				for channelId, rows in channels:
+					line = next(rows, None)
+					if channelId in [0, 1, 2]:
+						row[:, channelId] = to8Bit(line)
+					elif channelId == -1:
+						alpha = line
+						if self.opacity != 255:
+							alpha = (alpha * opacity_devider).astype(alpha.dtype)
+					elif alpha is not None and channelId < -1:
+						alpha = applyMask(alpha, line)
+				if alpha is not None:
+					row[:len(alpha), 3] = to8Bit(alpha)
+				yield row
+		finally:
+			self.psd.closeStream(stream)
+
+	def save_png(self, fileName, compression=6):
+		'''
+		Writes the layer to PNG file row by row, see iter_rows.
+		compression - zlib level, 0 to 9.
+		'''
+		width, height = self.getChannelSize(0)
+		stream = open(fileName, "wb")
+		try:
+			writePNG(stream, width, height, self.iter_rows(), compression)
+		finally:
+			stream.close()
+
 #	def makePngImage(self):
 #		width = self.rectangle["width"] 
 #		height = self.rectangle["height"]
@@ -1,13 +1,76 @@
 import logging
 import unittest
 import tempfile
+import shutil
 import os.path
-from psdfile import PSDFile, make_valid_filename
+import sys
+from psdfile import PSDFile, make_valid_filename, layerSelector
+from cache import ParseCache, CACHE_MAGIC, CACHE_VERSION
+from batch import collectFiles, runBatch
+from composite import Compositor
+from index import MetadataIndex, decodePath, readMetadata, main as indexMain
+from benchmark import runFile, compare, PHASE_NAMES
+import instrument
 from sections import *
 from cPickle import dumps, loads
+from StringIO import StringIO
+import struct
+import zlib
+import numpy
+from PIL import Image
 
 logging.config.fileConfig("%s/conf/logging.conf" % os.path.dirname(__file__))
 
+def makeTestPSD(width, height, planes, depth=8, version=1, rle=False, tagged=False):
+	'''
+	Minimal RGB document with one layer covering the canvas. Planes are
+	stored raw or RLE compressed (literal packets only). version 2 makes
+	a large document (PSB). tagged puts the layer into Lr16 tagged block
+	and leaves the layer info empty, as Photoshop saves 16 bits documents.
+	planes - {channelId: string of plane bytes}
+	'''
+	lengthFormat, countFormat = (">Q", ">I") if version == 2 else (">I", ">H")
+	rowBytes = len(planes[0]) // height
+	def packLines(plane):
+		lines = []
+		for y in range(height):
+			row = plane[y * rowBytes:(y + 1) * rowBytes]
+			lines.append("".join(chr(len(row[x:x + 128]) - 1) + row[x:x + 128]
+								 for x in range(0, len(row), 128)))
+		return lines
+	def encode(plane):
+		if not rle:
+			return struct.pack(">H", 0) + plane
+		lines = packLines(plane)
+		return (struct.pack(">H", 1) + "".join(struct.pack(countFormat, len(l)) for l in lines) +
+				"".join(lines))
+
+	channels = sorted(planes.items())
+	record = struct.pack(">4iH", 0, 0, height, width, len(channels))
+	for channelId, plane in channels:
+		record += struct.pack(">h", channelId) + struct.pack(lengthFormat, len(encode(plane)))
+	name = "\x05layer\x00\x00"
+	extra = struct.pack(">II", 0, 0) + name
+	record += "8BIMnorm" + struct.pack(">BBBBI", 255, 0, 0, 0, len(extra)) + extra
+	data = "".join(encode(plane) for channelId, plane in channels)
+	layerInfo = struct.pack(">h", 1) + record + data
+	if tagged:
+		layerInfo += "\x00" * (-len(layerInfo) % 4)
+		layerMask = (struct.pack(lengthFormat, 0) + struct.pack(">I", 0) +
+					 "8BIMLr16" + struct.pack(lengthFormat, len(layerInfo)) + layerInfo)
+	else:
+		layerMask = struct.pack(lengthFormat, len(layerInfo)) + layerInfo + struct.pack(">I", 0)
+	if rle:
+		lines = [packLines(planes[c]) for c in [0, 1, 2]]
+		image = (struct.pack(">H", 1) +
+				 "".join(struct.pack(countFormat, len(l)) for c in lines for l in c) +
+				 "".join("".join(c) for c in lines))
+	else:
+		image = struct.pack(">H", 0) + "".join(planes[c] for c in [0, 1, 2])
+	header = struct.pack(">4sH6xHIIHH", "8BPS", version, 3, height, width, depth, 3)
+	return StringIO(header + struct.pack(">II", 0, 0) +
+					struct.pack(lengthFormat, len(layerMask)) + layerMask + image)
+
 class PSDTest(unittest.TestCase):
 	def setUp(self):
 		self.testPSDFileName2 = "./../samples/5x5.psd"
@@ -48,6 +111,512 @@ class PSDTest(unittest.TestCase):
 		v = dumps(extract)
 		p = loads(v)
 	
+	def test_lazy_parse(self):
+		psd = PSDFile(self.test_psd_slices)
+		psd.parse()
+		lazy_psd = PSDFile(self.test_psd_slices)
+		lazy_psd.parse(lazy=True)
+
+		layers = psd.layerMask.layers
+		lazy_layers = lazy_psd.layerMask.layers
+		self.assertEquals(len(layers), len(lazy_layers))
+		for layer in lazy_layers:
+			self.assertEquals(layer._channels, None)
+		for layer, lazy_layer in zip(layers, lazy_layers):
+			self.assertEquals(layer.name, lazy_layer.name)
+			self.assertEquals(list(layer.image.getdata()), list(lazy_layer.image.getdata()))
+		self.assertEquals(list(psd.layerMask.baseLayer.image.getdata()),
+						  list(lazy_psd.layerMask.baseLayer.image.getdata()))
+
+	def test_mapped_parse(self):
+		psd = PSDFile(self.test_psd_slices)
+		psd.parse()
+		mapped_psd = PSDFile(self.test_psd_slices, mapped=True)
+		mapped_psd.parse(lazy=True)
+		for layer, mapped_layer in zip(psd.layerMask.layers, mapped_psd.layerMask.layers):
+			for c in ["r", "g", "b", "a"]:
+				self.assertEquals(layer.channels[c].tolist(), mapped_layer.channels[c].tolist())
+		mapped_psd.close()
+
+	def test_parallel_parse(self):
+		psd = PSDFile(self.test_psd_slices)
+		psd.parse()
+		parallel_psd = PSDFile(self.test_psd_slices)
+		parallel_psd.parse(workers=2)
+		layers = psd.layerMask.layers + [psd.layerMask.baseLayer]
+		parallel_layers = parallel_psd.layerMask.layers + [parallel_psd.layerMask.baseLayer]
+		for layer, parallel_layer in zip(layers, parallel_layers):
+			self.assertNotEquals(parallel_layer._channels, None)
+			self.assertTrue(parallel_layer._pixels is not None)
+			self.assertEquals(layer.pixels.tolist(), parallel_layer.pixels.tolist())
+		'''Without layers the merged image is decoded once'''
+		psd = PSDFile("./../all_samples/back_only.psd")
+		psd.parse(lazy=True)
+		layerMask = psd.layerMask
+		decoded = []
+		getDetachedLayers = PSDLayerMask.getDetachedLayers
+		PSDLayerMask.getDetachedLayers = lambda self, layers: (decoded.extend(layers) or
+																getDetachedLayers(self, layers))
+		try:
+			layerMask.decodeLayers(2)
+		finally:
+			PSDLayerMask.getDetachedLayers = getDetachedLayers
+		self.assertEquals([layerMask.baseLayer], decoded)
+		self.assertTrue(layerMask.baseLayer._pixels is not None)
+
+	def test_zip_merged_image(self):
+		width, height = 5, 3
+		planes = dict((c, (numpy.arange(width * height) * (c + 3) * 7).astype(numpy.uint8).tostring())
+					  for c in [-1, 0, 1, 2])
+		raw = makeTestPSD(width, height, planes).getvalue()
+		imageSize = 2 + 3 * width * height
+		data = "".join(planes[c] for c in [0, 1, 2])
+		rows = numpy.frombuffer(data, numpy.uint8).reshape(-1, width)
+		deltas = numpy.diff(rows.astype(numpy.int16), axis=1).astype(numpy.uint8)
+		predicted = numpy.hstack([rows[:, :1], deltas]).tostring()
+		for compression, plain in [(2, data), (3, predicted)]:
+			document = raw[:-imageSize] + struct.pack(">H", compression) + zlib.compress(plain)
+			psd = PSDFile(stream=StringIO(document))
+			psd.parse(lazy=True)
+			base = psd.layerMask.baseLayer
+			rows = numpy.array(list(base.iter_rows()))
+			self.assertEquals(planes[2], base.channels["b"].tostring())
+			self.assertTrue(numpy.all(rows == base.pixels))
+			self.assertTrue(numpy.all(base.pixels[::2, ::2] == base.getPreview(2)))
+
+	def test_16_bits(self):
+		values = numpy.array([0, 0x1234, 0x80ff, 0xffff, 0x0100, 0xff00], ">u2")
+		planes = dict((c, values.tostring()) for c in [-1, 0, 1, 2])
+		for version, tagged in [(1, False), (1, True), (2, True)]:
+			psd = PSDFile(stream=makeTestPSD(3, 2, planes, depth=16, version=version, tagged=tagged))
+			psd.parse()
+			self.assertEquals(1, len(psd.layerMask.layers))
+			layer = psd.layerMask.layers[0]
+			self.assertFalse(layer.is_base_layer)
+			self.assertEquals(layer.name, "layer")
+			self.assertEquals(layer.channels["r"].tolist(), values.tolist())
+			self.assertEquals(layer.pixels[:, :, 0].ravel().tolist(), [0, 0x12, 0x80, 0xff, 0x01, 0xff])
+			self.assertEquals(psd.layerMask.baseLayer.channels["g"].tolist(), values.tolist())
+			lazy = PSDFile(stream=makeTestPSD(3, 2, planes, depth=16, version=version, tagged=tagged))
+			lazy.parse(lazy=True)
+			rows = numpy.array(list(lazy.layerMask.layers[0].iter_rows()))
+			self.assertTrue(numpy.all(rows == layer.pixels))
+
+	def test_iter_rows(self):
+		psd = PSDFile(self.test_psd_slices)
+		psd.parse()
+		lazy_psd = PSDFile(self.test_psd_slices)
+		lazy_psd.parse(lazy=True)
+		layers = psd.layerMask.layers + [psd.layerMask.baseLayer]
+		lazy_layers = lazy_psd.layerMask.layers + [lazy_psd.layerMask.baseLayer]
+		for layer, lazy_layer in zip(layers, lazy_layers):
+			rows = [row.tolist() for row in lazy_layer.iter_rows()]
+			self.assertEquals(layer.pixels.tolist(), rows)
+			self.assertEquals(lazy_layer._channels, None)
+
+		base_layer = lazy_psd.layerMask.baseLayer
+		file_name = os.path.join(tempfile.gettempdir(), "pypsd_canvas.png")
+		base_layer.save_png(file_name)
+		image = Image.open(file_name)
+		self.assertEquals(list(psd.layerMask.baseLayer.image.getdata()), list(image.getdata()))
+		os.remove(file_name)
+
+	def test_parse_cache(self):
+		directory = tempfile.mkdtemp()
+		psd = PSDFile(self.test_psd_slices)
+		psd.parse()
+		cache = ParseCache(directory, planes=True)
+		cache.parse(self.test_psd_slices)
+		cached_psd = cache.parse(self.test_psd_slices)
+		self.assertEquals((1, 1), (cache.hits, cache.misses))
+		layers = psd.layerMask.layers
+		cached_layers = cached_psd.layerMask.layers
+		self.assertEquals([l.name for l in layers], [l.name for l in cached_layers])
+		self.assertNotEquals(cached_layers[0]._channels, None)
+		self.assertFalse("OPACITY_RANGE" in cached_layers[0].__dict__)
+		self.assertEquals([0, 255], cached_layers[0].OPACITY_RANGE)
+		for layer, cached_layer in zip(layers, cached_layers):
+			if cached_layer.parent:
+				self.assertTrue(cached_layer.parent in cached_layers)
+			self.assertEquals(layer.pixels.tolist(), cached_layer.pixels.tolist())
+
+		cache.clear()
+		cache = ParseCache(directory)
+		cache.parse(self.test_psd_slices)
+		cached_psd = cache.parse(self.test_psd_slices)
+		cached_layer = cached_psd.layerMask.layers[0]
+		self.assertEquals(None, cached_layer._channels)
+		self.assertEquals(layers[0].pixels.tolist(), cached_layer.pixels.tolist())
+		'''Bad memo reference and missing module'''
+		for pickle in ["g99\n.", "cnosuchmodule\nPSDFile\n."]:
+			stream = open(cache.getEntryName(self.test_psd_slices), "wb")
+			stream.write(CACHE_MAGIC + chr(CACHE_VERSION) + zlib.compress(pickle))
+			stream.close()
+			misses = cache.misses
+			self.assertEquals(None, cache.load(self.test_psd_slices))
+			self.assertEquals(misses + 1, cache.misses)
+			self.assertEquals([], cache.getEntries())
+		cache.parse(self.test_psd_slices)
+		cache.maxSize = 0
+		cache.evict()
+		self.assertEquals([], cache.getEntries())
+		os.rmdir(directory)
+
+	def test_select_layers(self):
+		psd = PSDFile("./../all_samples/test1.psd")
+		psd.parse()
+		selected = PSDFile("./../all_samples/test1.psd")
+		selected.parse(select=layerSelector(folders=["Rus"], layerTypes=[0]))
+		decoded = [l.name for l in selected.layerMask.layers if l._channels is not None]
+		self.assertEquals(["Layer 12", "Layer 11"], decoded)
+		self.assertEquals(None, selected.layerMask.baseLayer._channels)
+		self.assertEquals(None, selected.select)
+		for layer, selected_layer in zip(psd.layerMask.layers, selected.layerMask.layers):
+			self.assertEquals(layer.pixels.tolist(), selected_layer.pixels.tolist())
+
+		selected = PSDFile("./../all_samples/test1.psd")
+		selected.parse(workers=2, select=layerSelector(names=["Layer 16"], visible=True))
+		decoded = [l.name for l in selected.layerMask.layers if l._channels is not None]
+		self.assertEquals(["Layer 16"], decoded)
+
+	def test_save(self):
+		directory = tempfile.mkdtemp()
+		cwd = os.getcwd()
+		psd = PSDFile("./../all_samples/test1.psd")
+		psd.parse(lazy=True)
+		folders, files = psd.getOutputTree()
+		self.assertTrue(os.path.join("Languages", "Sources", "Rus") in folders)
+		names = [fileName.lower() for layer, fileName, name in files]
+		self.assertEquals(len(set(names)), len(names))
+		self.assertEquals(os.path.join("Languages", "Sources", "Rus", "Layer 12.png"),
+						  [fileName for layer, fileName, name in files if layer.name == "Layer 12"][0])
+
+		psd.save(dest=directory, dirName="serial", compression=1)
+		psd.save(dest=directory, dirName="parallel", workers=2)
+		self.assertEquals(cwd, os.getcwd())
+		for layer, fileName, name in files:
+			image = Image.open(os.path.join(directory, "parallel", fileName))
+			self.assertEquals(layer.image.tobytes(), image.convert("RGBA").tobytes())
+			image = Image.open(os.path.join(directory, "serial", fileName))
+			self.assertEquals(layer.image.tobytes(), image.convert("RGBA").tobytes())
+		'''Second output into the same directory does not overwrite the first'''
+		serial = os.path.join(directory, "serial")
+		folders, files = psd.getOutputTree(root=serial)
+		paths = folders + [fileName for layer, fileName, name in files]
+		self.assertEquals([], [path for path in paths if os.path.exists(os.path.join(serial, path))])
+		psd.save(dest=directory, dirName="serial", compression=1)
+		for path in paths:
+			self.assertTrue(os.path.exists(os.path.join(serial, path)))
+		shutil.rmtree(directory)
+
+	def test_metadata_index(self):
+		directory = tempfile.mkdtemp()
+		copy_name = os.path.join(directory, "copy.psd")
+		shutil.copy(self.test_psd_slices, copy_name)
+		'''8 bits file and layer names'''
+		planes = dict((c, "\x80" * 6) for c in [-1, 0, 1, 2])
+		data = makeTestPSD(3, 2, planes).getvalue().replace("\x05layer", "\x05l\xe9yer")
+		accented_name = os.path.join(directory, "caf\xc3\xa9.psd")
+		stream = open(accented_name, "wb")
+		stream.write(data)
+		stream.close()
+		index = MetadataIndex(os.path.join(directory, "index.sqlite"), contentHash=True)
+		self.assertEquals((8, 0, 0), index.update(["./../samples", directory], workers=1))
+		self.assertEquals((0, 8, 0), index.update(["./../samples", directory], workers=1))
+		self.assertEquals([decodePath(os.path.abspath(accented_name))],
+						  [path for path, layerId in index.findLayers(u"l\xe9yer")])
+		self.assertEquals([], index.getStale([os.path.join(directory, "gone.psd")]))
+		self.assertEquals([os.path.abspath("./../samples/text_test.psd")], index.findFilesByFont("Arial"))
+		self.assertEquals(["copy.psd", "slices.psd"],
+						  sorted([os.path.basename(path) for path, layerId in index.findLayers("Layer 2")]))
+		slices = index.query("SELECT slice_id, rect_top, rect_left, rect_bottom, rect_right FROM slices "
+							 "JOIN files ON files.id = slices.file_id WHERE path = ? AND name = ?",
+							 (copy_name, "slice3"))
+		self.assertEquals([(36, 0, 240, 120, 350)], slices)
+		self.assertEquals(7, len(index.findFiles(minWidth=5)))
+		self.assertEquals(0, len(index.findFiles(minHeight=5000)))
+
+		os.remove(copy_name)
+		self.assertEquals((0, 7, 1), index.update(["./../samples", directory], workers=1))
+		self.assertEquals(["slices.psd"],
+						  [os.path.basename(path) for path, layerId in index.findLayers("Layer 2")])
+		index.close()
+		shutil.rmtree(directory)
+
+	def test_metadata_index_main(self):
+		directory = tempfile.mkdtemp()
+		'''Slices resource of an unknown version'''
+		planes = dict((c, "\x80" * 6) for c in [-1, 0, 1, 2])
+		data = makeTestPSD(3, 2, planes).getvalue()
+		resource = "8BIM" + struct.pack(">H", 1050) + "\x00\x00" + struct.pack(">II", 4, 7)
+		data = data[:30] + struct.pack(">I", len(resource)) + resource + data[34:]
+		file_name = os.path.join(directory, "sliced.psd")
+		stream = open(file_name, "wb")
+		stream.write(data)
+		stream.close()
+		name, rows, error = readMetadata(file_name)
+		self.assertEquals(None, error)
+		self.assertEquals(1, len(rows["layers"]))
+		self.assertEquals([], rows["slices"])
+
+		database = os.path.join(directory, "index.sqlite")
+		stdout, stderr = sys.stdout, sys.stderr
+		sys.stdout, sys.stderr = output, errors = StringIO(), StringIO()
+		try:
+			indexMain(["-d", database, "-j", "1", directory])
+			indexMain(["-d", database, "--layer", "%"])
+		finally:
+			sys.stdout, sys.stderr = stdout, stderr
+		self.assertEquals("%s\t\n" % os.path.abspath(file_name), output.getvalue())
+		shutil.rmtree(directory)
+
+	def test_batch(self):
+		directory = tempfile.mkdtemp()
+		broken_name = os.path.join(directory, "broken.psd")
+		broken = open(broken_name, "wb")
+		broken.write("8BPS broken")
+		broken.close()
+		files = collectFiles([self.test_psd_slices, directory])
+		self.assertEquals([(self.test_psd_slices, ""), (broken_name, ".")], files)
+		options = {"output": directory, "info": True, "invisible": False, "cache": None}
+		reports = dict((r["file"], r) for r in runBatch(files, options, workers=2))
+		self.assertEquals("ok", reports[self.test_psd_slices]["status"])
+		self.assertEquals(2, reports[self.test_psd_slices]["layers"])
+		self.assertEquals("error", reports[broken_name]["status"])
+		info_name = os.path.join(directory, "slices.json")
+		self.assertTrue(os.path.exists(info_name))
+		for name in [broken_name, info_name]:
+			os.remove(name)
+		os.rmdir(directory)
+
+	def test_batch_output_names(self):
+		'''PSD and PSB files of the same name'''
+		directory = tempfile.mkdtemp()
+		for name in ["same.psd", "same.psb"]:
+			shutil.copy(self.test_psd_slices, os.path.join(directory, name))
+		for info in [True, False]:
+			output = os.path.join(directory, "output")
+			options = {"output": output, "info": info, "invisible": False, "cache": None}
+			reports = runBatch(collectFiles([directory]), options, workers=1)
+			self.assertEquals(["ok", "ok"], [r["status"] for r in reports])
+			if info:
+				self.assertEquals(["same.json", "same.psb.json"], sorted(os.listdir(output)))
+			else:
+				self.assertEquals(["same", "same.psb"], sorted(os.listdir(output)))
+			shutil.rmtree(output)
+		shutil.rmtree(directory)
+
+	def test_collect_files(self):
+		directory = tempfile.mkdtemp()
+		os.mkdir(os.path.join(directory, "sub"))
+		names = ["a.psd", os.path.join("sub", "b.PSB"), "c.psb.txt"]
+		for name in names:
+			open(os.path.join(directory, name), "wb").close()
+		self.assertEquals([(os.path.join(directory, "a.psd"), "."),
+						   (os.path.join(directory, "sub", "b.PSB"), "sub")],
+						  collectFiles([directory]))
+		shutil.rmtree(directory)
+
+	def test_benchmark(self):
+		result = runFile(self.test_psd_slices)
+		self.assertEquals(2, result["layers"])
+		self.assertEquals(sorted(PHASE_NAMES), sorted(result["phases"]))
+		self.assertTrue(sum(result["phases"].values()) <= result["seconds"])
+		old = {"files": {"slices.psd": result}, "total": result}
+		slower = dict(result, seconds=result["seconds"] * 2 + 1)
+		new = {"files": {"slices.psd": slower}, "total": result}
+		lines = compare(old, new)
+		self.assertEquals(1, len(lines))
+		self.assertTrue(lines[0].startswith("slices.psd seconds"))
+		self.assertTrue(lines[0].endswith("REGRESSION"))
+
+	def test_instrumentation(self):
+		hooks = instrument.enable()
+		try:
+			psd = PSDFile(self.test_psd_slices)
+			psd.parse()
+		finally:
+			instrument.disable()
+		sections = hooks.summary()
+		self.assertEquals(26, sections["PSDHeader"]["bytes"])
+		self.assertEquals(1, sections["PSDHeader"]["reads"])
+		layers = psd.layerMask.layers + [psd.layerMask.baseLayer]
+		pixels = sum([l.rectangle["width"] * l.rectangle["height"] for l in layers])
+		self.assertEquals(pixels, sections["channels"]["pixels"])
+		files = hooks.summary(by="file")
+		self.assertEquals([self.test_psd_slices], files.keys())
+		self.assertTrue(files[self.test_psd_slices]["bytes"] > 0)
+		'''Length and the whole section'''
+		self.assertEquals(2, sections["PSDImageResources"]["reads"])
+
+		counters = dict(hooks.counters)
+		psd = PSDFile(self.test_psd_slices)
+		psd.parse()
+		self.assertEquals(counters, hooks.counters)
+
+	def test_deferred_text(self):
+		psd = PSDFile("./../samples/text_test.psd")
+		psd.parse(lazy=True)
+		text_layers = [l for l in psd.layerMask.layers if l.typeToolOffset is not None]
+		self.assertTrue(text_layers)
+		for layer in text_layers:
+			self.assertEquals(None, layer._text_data)
+		'''First access loads the text of all layers'''
+		text_layers[-1].text
+		for layer in text_layers:
+			self.assertEquals(None, layer.typeToolOffset)
+			styled_text = layer.styled_text
+			engine_text = layer.text_data["EngineData"]["value"]["EngineDict"]["Editor"]["Text"]
+			self.assertEquals(engine_text, "".join([piece["text"] for piece in styled_text]))
+			self.assertEquals(layer.text_data["Txt"]["value"], layer.text)
+		'''Eager parse decodes text, the stream is not needed afterwards'''
+		stream = open("./../samples/text_test.psd", "rb")
+		eager = PSDFile(stream=stream)
+		eager.parse()
+		stream.close()
+		eager_layers = [l for l in eager.layerMask.layers if l.text is not None]
+		self.assertEquals([l.text for l in text_layers], [l.text for l in eager_layers])
+
+	def test_pixels(self):
+		psd = PSDFile(self.test_psd_slices)
+		psd.parse()
+		for layer in psd.layerMask.layers:
+			pixels = layer.pixels
+			width, height = layer.image.size
+			self.assertEquals(pixels.shape, (height, width, 4))
+			self.assertEquals(pixels.dtype, numpy.uint8)
+			if width * height:
+				self.assertEquals(tuple(pixels[-1, -1]), layer.image.getpixel((width - 1, height - 1)))
+
+	def test_large_document(self):
+		'''PSB wider than PSD allows, RLE line counts of 4 bytes'''
+		width, height = 40000, 3
+		planes = {}
+		for channelId in [-1, 0, 1, 2]:
+			planes[channelId] = numpy.arange(channelId + 1, channelId + 1 + width * height,
+											 dtype=numpy.uint32).astype(numpy.uint8).tostring()
+		for rle in [False, True]:
+			psd = PSDFile(stream=makeTestPSD(width, height, planes, version=2, rle=rle))
+			psd.parse(lazy=True)
+			self.assertEquals((2, width), (psd.header.version, psd.header.width))
+			layer = psd.layerMask.layers[0]
+			self.assertEquals(planes[0], layer.channels["r"].tostring())
+			self.assertEquals(planes[-1], layer.channels["a"].tostring())
+			rows = numpy.array(list(psd.layerMask.layers[0].iter_rows()))
+			self.assertTrue(numpy.all(rows == layer.pixels))
+			self.assertTrue(numpy.all(layer.pixels[::7, ::7] == layer.getPreview(7)))
+			base = psd.layerMask.baseLayer
+			self.assertEquals(planes[2], base.channels["b"].tostring())
+		psd = PSDFile(stream=makeTestPSD(width, height, planes, rle=True))
+		self.assertRaises(BaseException, psd.parse)
+
+	def test_extra_channel(self):
+		'''Channels past blue are skipped, not taken as masks'''
+		planes = dict((c, chr(c + 2) * 6) for c in [-1, 0, 1, 2])
+		planes[3] = "\x00" * 6
+		for rle in [False, True]:
+			psd = PSDFile(stream=makeTestPSD(3, 2, planes, rle=rle))
+			psd.parse(lazy=True)
+			layer = psd.layerMask.layers[0]
+			rows = numpy.array(list(layer.iter_rows()))
+			self.assertEquals(None, layer._channels)
+			self.assertTrue(numpy.all(rows == layer.pixels))
+			self.assertTrue(numpy.all(layer.pixels[..., 3] == 1))
+			self.assertTrue(numpy.all(layer.pixels == layer.getPreview(1)))
+
+	def test_masks(self):
+		'''Mask rectangles differ from layer ones'''
+		for fileName, name in [("test2.psd", "Layer 2"), ("test1.psd", "Layer 21")]:
+			layers = []
+			for disabled in [False, True]:
+				psd = PSDFile("./../all_samples/" + fileName)
+				psd.parse(lazy=True)
+				layer = [l for l in psd.layerMask.layers if l.name == name][0]
+				if disabled:
+					layer.maskFlags |= MASK_DISABLED
+				layers.append(layer)
+			layer, unmasked = layers
+			self.assertNotEquals(layer.rectangle, layer.maskRectangle)
+			rows = numpy.array(list(layer.iter_rows()))
+			self.assertEquals(None, layer._channels)
+			self.assertTrue(numpy.all(rows[::3, ::3] == layer.getPreview(3)))
+			self.assertTrue(numpy.all(rows == layer.pixels))
+			self.assertTrue(numpy.all(unmasked.pixels[..., :3] == layer.pixels[..., :3]))
+			self.assertTrue(numpy.any(unmasked.pixels[..., 3] != layer.pixels[..., 3]))
+			'''Outside the mask the default color (white) keeps alpha'''
+			top = layer.maskRectangle["top"] - layer.rectangle["top"]
+			if top > 0:
+				self.assertTrue(numpy.all(unmasked.pixels[:top] == layer.pixels[:top]))
+
+	def test_preview(self):
+		psd = PSDFile("./../all_samples/test2.psd")
+		psd.parse()
+		lazy = PSDFile("./../all_samples/test2.psd")
+		lazy.parse(lazy=True)
+		layers = zip(psd.layerMask.layers + [psd.layerMask.baseLayer],
+					 lazy.layerMask.layers + [lazy.layerMask.baseLayer])
+		for factor in [1, 3, 8]:
+			for layer, lazyLayer in layers:
+				preview = lazyLayer.getPreview(factor)
+				self.assertEquals(None, lazyLayer._channels)
+				self.assertTrue(numpy.all(layer.pixels[::factor, ::factor] == preview))
+			self.assertEquals(preview.shape, lazy.getPreview(factor).shape)
+
+	def test_resources(self):
+		psd = PSDFile("./../samples/slices.psd")
+		image = psd.getThumbnail()
+		self.assertEquals(None, psd.layerMask)
+		self.assertEquals((160, 160), image.size)
+		self.assertEquals("RGB", image.mode)
+		resources = psd.imageResources
+		self.assertEquals(None, resources.getResource(1050)["data"])
+		slices = resources.getData(1050)
+		self.assertEquals([u"", u"slice2", u"slice1", u"slice3"], [s["name"] for s in slices["slices"]][:4])
+		self.assertTrue(resources.getResource(1050)["data"] is slices)
+		self.assertEquals(None, resources.getData(1005))
+		self.assertEquals(None, PSDFile("./../all_samples/Aristo-24.psd").getThumbnail())
+
+	def test_composite(self):
+		psd = PSDFile("./../all_samples/mask_test.psd")
+		psd.parse()
+		pixels = Compositor(psd).render(background=(255, 255, 255))
+		self.assertTrue(numpy.all(pixels == psd.layerMask.baseLayer.pixels))
+
+		psd = PSDFile("./../samples/boxes.psd")
+		psd.parse()
+		compositor = Compositor(psd)
+		background = psd.layerMask.layers[-1]
+		self.assertFalse(background.visible)
+		self.assertEquals(0, compositor.render()[..., 3].min())
+		self.assertEquals(255, compositor.render(hidden=True)[..., 3].min())
+		self.assertEquals(0, compositor.render(layers=[])[..., 3].max())
+		for layer in psd.layerMask.layers[:-1]:
+			pixels = compositor.render(layers=[layer])
+			rectangle = layer.rectangle
+			region = pixels[rectangle["top"]:rectangle["bottom"], rectangle["left"]:rectangle["right"]]
+			self.assertTrue(numpy.all(region[..., 3] == layer.pixels[..., 3]))
+			self.assertEquals(region[..., 3].sum(), pixels[..., 3].sum(dtype=int))
+
+		'''Folder buffers are as large as their layers and reused'''
+		psd = PSDFile("./../all_samples/test1.psd")
+		psd.parse()
+		compositor = Compositor(psd)
+		pixels = compositor.render()
+		folder = [l for l in psd.layerMask.layers if l.name == "Rus"][0]
+		color, alpha = compositor.buffers[folder]
+		top, left, bottom, right = compositor.getGroupBounds(folder, None, False)
+		self.assertEquals((bottom - top, right - left), alpha.shape)
+		self.assertTrue(alpha.size < psd.header.width * psd.header.height)
+		self.assertTrue(numpy.all(pixels == compositor.render()))
+		self.assertTrue(compositor.buffers[folder][1] is alpha)
+		'''Prepared layers are kept within maxSize'''
+		self.assertEquals(compositor.preparedSize,
+						  sum(p[2].nbytes + p[3].nbytes for p in compositor.prepared.values() if p))
+		compositor = Compositor(psd, maxSize=alpha.nbytes * 4)
+		self.assertTrue(numpy.all(pixels == compositor.render()))
+		self.assertTrue(compositor.preparedSize <= compositor.maxSize)
+		self.assertTrue(len(compositor.prepared) < len(psd.layerMask.layers))
+
 	def test_everything(self):
 		psd = PSDFile(self.test_psd_scroll)
 		psd.parse()